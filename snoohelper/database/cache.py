@@ -0,0 +1,176 @@
+from collections import OrderedDict
+from threading import RLock
+
+from snoohelper.database.models import UserModel
+import snoohelper.database.writer as writer
+from snoohelper.utils.reddit import SQLITE_MAX_VARIABLES, chunks
+
+_MISSING = object()
+
+
+def _add_to_counters(rows, deltas, subreddit):
+    if rows:
+        for chunk in chunks(rows, SQLITE_MAX_VARIABLES // len(rows[0])):
+            UserModel.insert_many(chunk).on_conflict('IGNORE').execute()
+
+    for username, counters in deltas.items():
+        increments = dict((name, getattr(UserModel, name) + n) for name, n in counters.items() if n)
+        if increments:
+            UserModel.update(**increments).where(UserModel.username == username.lower(),
+                                                 UserModel.subreddit == subreddit).execute()
+
+
+class UserCache:
+    """
+    Write-through, bounded cache of UserModel rows keyed by (subreddit, username)
+    Also remembers users that have no row, since most authors seen by the scans are not in the database
+    """
+
+    def __init__(self, max_size=10000):
+        """
+        :param max_size: maximum number of users remembered, least recently used are evicted first
+        """
+        self.max_size = max_size
+        self._users = OrderedDict()
+        self._lock = RLock()
+
+    @staticmethod
+    def _key(username, subreddit):
+        return subreddit, username.lower()
+
+    def _lookup(self, key):
+        with self._lock:
+            try:
+                self._users.move_to_end(key)
+                return self._users[key]
+            except KeyError:
+                return None
+
+    def _store(self, key, value):
+        with self._lock:
+            self._users[key] = value
+            self._users.move_to_end(key)
+            while len(self._users) > self.max_size:
+                self._users.popitem(last=False)
+
+    def get(self, username, subreddit):
+        """
+        Get a user row, from memory if possible
+
+        :param username: Reddit username
+        :param subreddit: subreddit display name
+        :return: UserModel instance, None if the user has no row
+        """
+        key = self._key(username, subreddit)
+        user = self._lookup(key)
+
+        if user is None:
+            try:
+                user = UserModel.get(UserModel.username == key[1], UserModel.subreddit == subreddit)
+            except UserModel.DoesNotExist:
+                user = _MISSING
+            self._store(key, user)
+
+        if user is _MISSING:
+            return None
+        return user
+
+    def prefetch(self, usernames, subreddit):
+        """
+        Resolve many users of a subreddit at once, reading the ones not in memory with a single query
+
+        :param usernames: iterable of Reddit usernames
+        :param subreddit: subreddit display name
+        :return: dict of lowercased username to UserModel instance, or None if the user has no row
+        """
+        resolved = dict()
+        missing = list()
+
+        for username in set(username.lower() for username in usernames):
+            user = self._lookup(self._key(username, subreddit))
+            if user is None:
+                missing.append(username)
+            else:
+                resolved[username] = None if user is _MISSING else user
+
+        for chunk in chunks(missing, SQLITE_MAX_VARIABLES - 1):
+            found = dict()
+            for user in UserModel.select().where(UserModel.username << chunk, UserModel.subreddit == subreddit):
+                found[user.username] = user
+
+            for username in chunk:
+                user = found.get(username)
+                self._store(self._key(username, subreddit), _MISSING if user is None else user)
+                resolved[username] = user
+
+        return resolved
+
+    def add_to_counters(self, deltas, subreddit):
+        """
+        Add aggregated counter deltas to many users of a subreddit in one DatabaseWriter operation
+        Users without a row are created, each user gets a single UPDATE ... SET col = col + ?
+        The rows are then re-read and replace the cached ones. Instances read before keep their own values and dirty
+        fields, so a later save() of one of them only writes the fields its caller changed
+
+        :param deltas: dict of username to dict of UserModel counter field name to increment
+        :param subreddit: subreddit display name
+        :return: list of the affected UserModel instances, re-read after the update
+        """
+        if not deltas:
+            return list()
+
+        usernames = [username.lower() for username in deltas]
+        existing = self.prefetch(usernames, subreddit)
+        defaults = dict((field.name, field.default) for field in UserModel._meta.sorted_fields
+                        if field.default is not None and not callable(field.default))
+        rows = list()
+        for username in usernames:
+            if existing[username] is None:
+                row = dict(defaults)
+                row.update(username=username, subreddit=subreddit)
+                rows.append(row)
+
+        writer.submit(_add_to_counters, rows, deltas, subreddit).wait()
+
+        for username in usernames:
+            self.invalidate(username, subreddit)
+        refreshed = self.prefetch(usernames, subreddit)
+        return [refreshed[username] for username in usernames]
+
+    def get_or_create(self, username, subreddit):
+        """
+        Get a user row, creating it if it doesn't exist
+
+        :param username: Reddit username
+        :param subreddit: subreddit display name
+        :return: UserModel instance
+        """
+        user = self.get(username, subreddit)
+
+        if user is None:
+            key = self._key(username, subreddit)
+            user, _ = writer.submit(UserModel.get_or_create, username=key[1], subreddit=subreddit).wait()
+            self._store(key, user)
+        return user
+
+    def save(self, user):
+        """
+        Keep a user row cached and queue its write
+
+        :param user: UserModel instance
+        """
+        writer.submit(user.save)
+        self._store(self._key(user.username, user.subreddit), user)
+
+    def invalidate(self, username, subreddit):
+        """
+        Forget a user so that the next lookup reads it from the database
+
+        :param username: Reddit username
+        :param subreddit: subreddit display name
+        """
+        with self._lock:
+            self._users.pop(self._key(username, subreddit), None)
+
+
+users = UserCache()
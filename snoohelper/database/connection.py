@@ -0,0 +1,241 @@
+import configparser
+import functools
+import os
+import re
+from contextlib import contextmanager
+from threading import Lock, local
+
+from peewee import SqliteDatabase, OperationalError
+
+from snoohelper.database.models import db, create_indexes, add_missing_columns, merge_duplicate_users, index_exists, \
+    UserModel, AlreadyDoneModel, SubmissionModel, UnflairedSubmissionModel, PendingSubmissionModel, FilterModel, \
+    WatermarkModel, FlairTemplateModel
+
+DEFAULT_PRAGMAS = (('journal_mode', 'wal'),
+                   ('synchronous', 'normal'),
+                   ('cache_size', -16000),
+                   ('mmap_size', 67108864),
+                   ('busy_timeout', 30000))
+
+_router = None
+
+
+def get_database_option(option, default=None, config_name='config.ini', section='database'):
+    """
+    Get an option from the [database] section of the .ini file
+
+    :param option: option name
+    :param default: value returned if the section or option is missing
+    :param config_name: name of the .ini file
+    :param section: section holding the database options
+    :return: option value as a string, or default
+    """
+    config = configparser.ConfigParser()
+    config.read(config_name)
+    try:
+        return config.get(section, option)
+    except (configparser.NoSectionError, configparser.NoOptionError):
+        return default
+
+
+def get_pragmas(config_name='config.ini', section='database'):
+    """
+    Get the SQLite pragmas to apply to every connection, from the [database] section of the .ini file if present
+
+    :param config_name: name of the .ini file
+    :param section: section holding the pragma values
+    :return: tuple of (pragma, value) tuples
+    """
+    return tuple((pragma, get_database_option(pragma, default, config_name, section))
+                 for pragma, default in DEFAULT_PRAGMAS)
+
+
+def create_database(db_name, pragmas=None):
+    """
+    :param db_name: database file name
+    :param pragmas: tuple of (pragma, value) tuples, read from the .ini file if None
+    :return: SqliteDatabase instance
+    """
+    if pragmas is None:
+        pragmas = get_pragmas()
+    return SqliteDatabase(db_name, pragmas=pragmas, threadlocals=True, check_same_thread=False, timeout=30)
+
+
+def create_tables():
+    """
+    Create missing tables, columns and indexes in the database the proxy currently points to
+    """
+    ensure_connection()
+    FilterModel.create_table(True)
+    SubmissionModel.create_table(True)
+    WatermarkModel.create_table(True)
+    FlairTemplateModel.create_table(True)
+    PendingSubmissionModel.create_table(True)
+    try:
+        db.create_tables(models=[UserModel, AlreadyDoneModel, UnflairedSubmissionModel])
+    except OperationalError:
+        pass
+    add_missing_columns([UnflairedSubmissionModel])
+    if not index_exists(UserModel, ('username', 'subreddit'), unique=True):
+        merge_duplicate_users()
+    create_indexes([UserModel, AlreadyDoneModel, UnflairedSubmissionModel])
+
+
+class ShardRouter:
+    """
+    Database the proxy is initialized with when sharding is enabled. Every subreddit gets its own SQLite file, and
+    each thread selects the file it works on with use_shard(), threads that haven't selected one use the master file
+    """
+
+    def __init__(self, master_name, shard_dir, pragmas):
+        """
+        :param master_name: file name of the master database
+        :param shard_dir: directory holding one database file per subreddit
+        :param pragmas: tuple of (pragma, value) tuples applied to every connection
+        """
+        self.shard_dir = shard_dir
+        self.pragmas = pragmas
+        self.master_database = create_database(master_name, pragmas)
+        self.shard_databases = dict()
+        self._shard_lock = Lock()
+        self._thread_shard = local()
+
+    @staticmethod
+    def shard_key(subreddit):
+        return subreddit.lower()
+
+    def shard_path(self, key):
+        return os.path.join(self.shard_dir, re.sub(r'[^a-z0-9_]', '', key) + '.db')
+
+    def shard_database(self, key):
+        """
+        Get the database of a shard, creating the file and its tables on first use
+
+        :param key: shard key, see shard_key()
+        :return: SqliteDatabase instance
+        """
+        with self._shard_lock:
+            database = self.shard_databases.get(key)
+            if database is not None:
+                return database
+
+            os.makedirs(self.shard_dir, exist_ok=True)
+            database = create_database(self.shard_path(key), self.pragmas)
+            self.shard_databases[key] = database
+
+        with self.use_shard(key):
+            create_tables()
+        return database
+
+    def current_shard(self):
+        return getattr(self._thread_shard, 'key', None)
+
+    def current_database(self):
+        key = self.current_shard()
+        if key is None:
+            return self.master_database
+        return self.shard_database(key)
+
+    @contextmanager
+    def use_shard(self, key):
+        previous = self.current_shard()
+        self._thread_shard.key = key
+        try:
+            yield
+        finally:
+            self._thread_shard.key = previous
+
+    def shard_keys(self):
+        """
+        :return: list of the keys of all shards on disk or open, None standing for the master database
+        """
+        keys = set(self.shard_databases)
+        if os.path.isdir(self.shard_dir):
+            keys.update(name[:-3] for name in os.listdir(self.shard_dir) if name.endswith('.db'))
+        return [None] + sorted(keys)
+
+    def __getattr__(self, name):
+        return getattr(self.current_database(), name)
+
+
+def init_database(db_name, sharding=None, shard_dir=None):
+    """
+    Initialize the database proxy with a tuned SqliteDatabase, create missing tables and indexes
+    If 'sharding' is enabled in the [database] section, each subreddit gets its own file in 'shard_dir'
+    Only the first call has an effect, all teams share the same proxy
+
+    :param db_name: database file name, the master database when sharding
+    :param sharding: whether to use one database file per subreddit, read from the .ini file if None
+    :param shard_dir: directory holding the shard files, read from the .ini file if None
+    """
+    global _router
+
+    if db.obj is not None:
+        return
+
+    if sharding is None:
+        sharding = get_database_option('sharding', 'no').lower() in ('1', 'yes', 'true', 'on')
+    if shard_dir is None:
+        shard_dir = get_database_option('shard_dir', 'shards')
+
+    if sharding:
+        _router = ShardRouter(db_name, shard_dir, get_pragmas())
+        db.initialize(_router)
+    else:
+        db.initialize(create_database(db_name))
+    create_tables()
+
+
+def ensure_connection():
+    """
+    Open this thread's connection if it isn't open yet, connections are kept open and reused between scans
+    """
+    if db.is_closed():
+        db.connect()
+
+
+def current_shard():
+    """
+    :return: shard key selected by this thread, None when not sharding or using the master database
+    """
+    if _router is None:
+        return None
+    return _router.current_shard()
+
+
+@contextmanager
+def use_shard(key):
+    """
+    Context manager that points this thread's database proxy to a shard, does nothing when not sharding
+
+    :param key: shard key or subreddit name, None for the master database
+    """
+    if _router is None:
+        yield
+    else:
+        with _router.use_shard(None if key is None else ShardRouter.shard_key(key)):
+            yield
+
+
+def shard_keys():
+    """
+    :return: list of shard keys to iterate over for maintenance, [None] when not sharding
+    """
+    if _router is None:
+        return [None]
+    return _router.shard_keys()
+
+
+def subreddit_shard(func):
+    """
+    Decorator for methods of objects with a subreddit_name attribute, runs them on that subreddit's shard
+
+    :param func: method
+    :return: wrapped method
+    """
+    @functools.wraps(func)
+    def wrapped_f(self, *args, **kwargs):
+        with use_shard(self.subreddit_name):
+            return func(self, *args, **kwargs)
+
+    return wrapped_f
@@ -1,4 +1,5 @@
-from peewee import IntegerField, TextField, Model, BooleanField, TimestampField, Proxy
+from peewee import IntegerField, TextField, Model, BooleanField, TimestampField, Proxy, fn
+from playhouse.migrate import SqliteMigrator, migrate
 
 db = Proxy()
 
@@ -21,6 +22,10 @@ class UserModel(BaseModel):
     last_warned = TimestampField(default=0, null=True)
     subreddit = TextField()
 
+    class Meta:
+        indexes = ((('username', 'subreddit'), True),)
+        only_save_dirty = True
+
 
 class SubmissionModel(BaseModel):
     submission_id = TextField()
@@ -36,6 +41,31 @@ class UnflairedSubmissionModel(BaseModel):
     submission_id = TextField()
     comment_id = TextField()
     subreddit = TextField()
+    created_utc = TimestampField(null=True)
+    author = TextField(null=True)
+
+    class Meta:
+        indexes = ((('subreddit',), False),)
+
+
+class PendingSubmissionModel(BaseModel):
+    submission_id = TextField(unique=True)
+    subreddit = TextField()
+    created_utc = TimestampField()
+
+    class Meta:
+        indexes = ((('subreddit',), False),)
+
+
+class FlairTemplateModel(BaseModel):
+    subreddit = TextField()
+    template_id = TextField()
+    flair_text = TextField()
+    position = IntegerField()
+    fetched_at = TimestampField()
+
+    class Meta:
+        indexes = ((('subreddit',), False),)
 
 
 class FilterModel(BaseModel):
@@ -49,3 +79,90 @@ class AlreadyDoneModel(BaseModel):
     thing_id = TextField(unique=True)
     timestamp = TimestampField()
     subreddit = TextField()
+
+    class Meta:
+        indexes = ((('subreddit', 'timestamp'), False),)
+
+
+class WatermarkModel(BaseModel):
+    subreddit = TextField()
+    listing = TextField()
+    thing_id = TextField()
+    created = TimestampField()
+
+    class Meta:
+        indexes = ((('subreddit', 'listing'), True),)
+
+
+def create_indexes(models):
+    """
+    Create the indexes declared in each model's Meta.indexes if they don't exist yet
+    create_table() skips tables that already exist, so databases created before an index was declared need this
+
+    :param models: list of model classes
+    """
+    for model in models:
+        table = model._meta.db_table
+        for fields, unique in model._meta.indexes:
+            columns = [model._meta.fields[field].db_column for field in fields]
+            db.execute_sql('CREATE {}INDEX IF NOT EXISTS "{}" ON "{}" ({})'.format(
+                "UNIQUE " if unique else "", "_".join([table] + columns), table,
+                ", ".join('"{}"'.format(column) for column in columns)))
+
+
+def index_exists(model, fields, unique=False):
+    """
+    :param model: model class
+    :param fields: tuple of field names the index covers, in order
+    :param unique: whether the index must be unique
+    :return: True if the model's table has an index on exactly these columns
+    """
+    columns = [model._meta.fields[field].db_column for field in fields]
+    return any(index.columns == columns and (index.unique or not unique)
+               for index in db.get_indexes(model._meta.db_table))
+
+
+def add_missing_columns(models):
+    """
+    Add the columns declared in each model but missing from its table, the new columns must be nullable
+    create_table() skips tables that already exist, so databases created before a field was declared need this
+
+    :param models: list of model classes
+    """
+    migrator = SqliteMigrator(db)
+    for model in models:
+        if not model.table_exists():
+            continue
+        table = model._meta.db_table
+        existing = set(column.name for column in db.get_columns(table))
+        for field in model._meta.sorted_fields:
+            if field.db_column not in existing:
+                migrate(migrator.add_column(table, field.db_column, field))
+
+
+def merge_duplicate_users():
+    """
+    Merge UserModel rows sharing the same (username, subreddit) into the oldest one
+    Needed before the unique index can be created on databases that accumulated duplicates, once the index exists
+    there can't be any, so create_tables() only runs this while it is missing
+    """
+    counters = ('removed_comments', 'removed_submissions', 'approved_comments', 'approved_submissions', 'bans')
+    flags = ('shadowbanned', 'tracked', 'warnings_muted')
+
+    duplicates = UserModel.select(UserModel.username, UserModel.subreddit).\
+        group_by(UserModel.username, UserModel.subreddit).having(fn.COUNT(UserModel.id) > 1)
+
+    with db.atomic():
+        for duplicate in list(duplicates):
+            rows = list(UserModel.select().where(UserModel.username == duplicate.username,
+                                                 UserModel.subreddit == duplicate.subreddit).order_by(UserModel.id))
+            user = rows[0]
+            for row in rows[1:]:
+                for counter in counters:
+                    setattr(user, counter, getattr(user, counter) + getattr(row, counter))
+                for flag in flags:
+                    setattr(user, flag, getattr(user, flag) or getattr(row, flag))
+                if row.last_warned and (not user.last_warned or row.last_warned > user.last_warned):
+                    user.last_warned = row.last_warned
+                row.delete_instance()
+            user.save()
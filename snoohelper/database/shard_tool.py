@@ -0,0 +1,59 @@
+""" Run this file to split an existing master database into one database file per subreddit """
+
+import argparse
+
+from snoohelper.database.connection import ShardRouter, init_database, use_shard
+from snoohelper.database.models import db, UserModel, SubmissionModel, UnflairedSubmissionModel, FilterModel, \
+    AlreadyDoneModel, WatermarkModel, FlairTemplateModel, PendingSubmissionModel
+from snoohelper.utils.reddit import SQLITE_MAX_VARIABLES, chunks
+
+SHARDED_MODELS = (UserModel, SubmissionModel, UnflairedSubmissionModel, FilterModel, AlreadyDoneModel, WatermarkModel,
+                  FlairTemplateModel, PendingSubmissionModel)
+
+
+def split_master(master_name, shard_dir):
+    """
+    Copy the rows of every model from the master database into the shard of their subreddit
+    No rows are removed from the master database, but it is opened like on startup, so missing tables, columns
+    and indexes are added to it first. Rows clashing with a unique index of their shard are skipped
+
+    :param master_name: file name of the master database
+    :param shard_dir: directory to create the shard files in
+    :return: dict of shard key to number of rows actually inserted
+    """
+    init_database(master_name, sharding=True, shard_dir=shard_dir)
+    copied = dict()
+
+    for model in SHARDED_MODELS:
+        if not model.table_exists():
+            continue
+
+        subreddits = [row.subreddit for row in model.select(model.subreddit).distinct()]
+        for subreddit in subreddits:
+            rows = list(model.select().where(model.subreddit == subreddit).dicts())
+            key = ShardRouter.shard_key(subreddit)
+            step = SQLITE_MAX_VARIABLES // len(model._meta.sorted_fields)
+
+            with use_shard(key):
+                before = model.select().count()
+                with db.atomic():
+                    for chunk in chunks(rows, step):
+                        model.insert_many(chunk).on_conflict('IGNORE').execute()
+                inserted = model.select().count() - before
+            copied[key] = copied.get(key, 0) + inserted
+
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split a SnooHelper master database into per-subreddit shards")
+    parser.add_argument("master", help="file name of the master database, e.g. snoohelper_master.db")
+    parser.add_argument("shard_dir", help="directory to write the shard files to")
+    args = parser.parse_args()
+
+    for key, n in sorted(split_master(args.master, args.shard_dir).items()):
+        print("{}: copied {} rows".format(key, n))
+
+
+if __name__ == "__main__":
+    main()
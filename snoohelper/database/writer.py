@@ -0,0 +1,208 @@
+import atexit
+import queue
+from collections import OrderedDict
+import time
+import traceback
+from threading import Thread, Event, Lock
+
+from peewee import OperationalError, InterfaceError
+
+from snoohelper.database.models import db
+from snoohelper.database.connection import ensure_connection, current_shard, use_shard
+
+
+class PendingWrite:
+    """
+    A write operation submitted to the DatabaseWriter, wait() on it to get its result
+    """
+
+    def __init__(self, func, args, kwargs):
+        self.shard = current_shard()
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exception = None
+        self._done = Event()
+
+    def run(self):
+        self.result = self.func(*self.args, **self.kwargs)
+
+    def finish(self, exception=None):
+        self.exception = exception
+        self._done.set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the operation has been committed
+
+        :param timeout: seconds to wait, None to wait forever
+        :return: return value of the operation
+        :raises TimeoutError: if the operation wasn't committed within timeout
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("Write not committed after {} seconds".format(timeout))
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+class DatabaseWriter:
+    """
+    Owns all database writes. Team threads submit operations to a queue and a single thread commits them in groups,
+    flushing every max_batch operations or every max_delay seconds, so scan threads never wait on the write lock
+    Operations are committed on the shard they were submitted on, each shard's group in its own transaction
+    The writer is closed at exit, so operations still queued then are committed before the process ends
+    """
+
+    _instance = None
+    _instance_lock = Lock()
+
+    def __init__(self, max_batch=200, max_delay=0.05, retries=5):
+        """
+        :param max_batch: maximum number of operations committed in one transaction
+        :param max_delay: seconds to wait for more operations before committing a group
+        :param retries: attempts to commit a group while the database is busy
+        """
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.retries = retries
+        self.queue = queue.Queue()
+        self.closed = False
+        self._submit_lock = Lock()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls):
+        """
+        Get the process-wide writer, starting it on first use
+
+        :return: DatabaseWriter instance
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+                atexit.register(cls._instance.close)
+            return cls._instance
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue a write operation, it runs on the writer thread inside a group transaction
+
+        :param func: callable performing the write
+        :return: PendingWrite instance
+        """
+        pending = PendingWrite(func, args, kwargs)
+        with self._submit_lock:
+            if self.closed:
+                raise RuntimeError("DatabaseWriter is closed")
+            self.queue.put(pending)
+        return pending
+
+    def flush(self, timeout=None):
+        """
+        Block until every operation submitted so far has been committed
+
+        :param timeout: seconds to wait, None to wait forever
+        """
+        self.submit(lambda: None).wait(timeout)
+
+    def close(self, timeout=None):
+        """
+        Commit the operations still queued and stop the writer thread, further submits raise RuntimeError
+
+        :param timeout: seconds to wait for the queued operations, None to wait forever
+        """
+        with self._instance_lock:
+            if DatabaseWriter._instance is self:
+                DatabaseWriter._instance = None
+
+        with self._submit_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(None)
+        self.thread.join(timeout)
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_delay
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, batch):
+        errors = dict()
+        with db.atomic():
+            for pending in batch:
+                try:
+                    with db.atomic():
+                        pending.run()
+                except (OperationalError, InterfaceError):
+                    raise
+                except Exception as e:
+                    errors[pending] = e
+        return errors
+
+    def _commit_group(self, group):
+        for attempt in range(self.retries):
+            try:
+                ensure_connection()
+                errors = self._commit(group)
+                break
+            except (OperationalError, InterfaceError) as e:
+                print("DatabaseWriter: failed to commit {} operations, attempt {}: {}".format(len(group),
+                                                                                         attempt + 1, e))
+                errors = dict((pending, e) for pending in group)
+                time.sleep(0.5 * 2 ** attempt)
+
+        for pending in group:
+            exception = errors.get(pending)
+            if exception is not None:
+                print(''.join(traceback.format_exception(type(exception), exception, exception.__traceback__)))
+            pending.finish(exception)
+
+    def run(self):
+        while True:
+            batch = self._next_batch()
+
+            # None is queued by close() after the last operation
+            closing = batch[-1] is None
+            groups = OrderedDict()
+            for pending in batch:
+                if pending is not None:
+                    groups.setdefault(pending.shard, list()).append(pending)
+
+            for shard, group in groups.items():
+                with use_shard(shard):
+                    self._commit_group(group)
+
+            if closing:
+                return
+
+
+def submit(func, *args, **kwargs):
+    """
+    Queue a write operation on the process-wide DatabaseWriter
+
+    :param func: callable performing the write
+    :return: PendingWrite instance
+    """
+    return DatabaseWriter.get().submit(func, *args, **kwargs)
+
+
+def flush(timeout=None):
+    """
+    Block until every operation submitted so far to the process-wide DatabaseWriter has been committed
+
+    :param timeout: seconds to wait, None to wait forever
+    """
+    DatabaseWriter.get().flush(timeout)
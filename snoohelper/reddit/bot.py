@@ -1,26 +1,32 @@
+import functools
 import re
 import time
-from threading import Thread
+from collections import Counter
+from threading import Thread, Event
 import traceback
 import imgurpython.helpers.error
 import praw
 import praw.exceptions
 import prawcore.exceptions
 import puni
-from peewee import OperationalError, IntegrityError, DoesNotExist, SqliteDatabase
 import datetime
 import requests.exceptions
 from retrying import retry
 
-from snoohelper.database.models import UserModel, AlreadyDoneModel, SubmissionModel, UnflairedSubmissionModel, db, Proxy
-from snoohelper.database.models import FilterModel
-from snoohelper.utils.reddit import AlreadyDoneHelper, is_banned
+from snoohelper.database.models import UserModel, SubmissionModel
+from snoohelper.database.connection import init_database, subreddit_shard, use_shard, ensure_connection
+import snoohelper.database.writer as writer
+from snoohelper.database.cache import users
+from snoohelper.utils.reddit import AlreadyDoneHelper, AlreadyDonePruner, ListingWatermark, AdaptivePollInterval, \
+    is_banned, MODLOG_ACTIONS
 from snoohelper.utils.slack import own_thread
+from snoohelper.reddit.scheduler import create_reddit, interactive
 import snoohelper.utils.slack
 import snoohelper.utils.exceptions
 import snoohelper.utils.reddit
 import snoohelper.utils.credentials
 from .bot_modules.flair_enforcer import FlairEnforcer
+from .bot_modules.flair_catalog import FlairCatalog
 from .bot_modules.summary_generator import SummaryGenerator
 from .bot_modules.user_warnings import UserWarnings
 from .bot_modules.filters import FiltersController
@@ -31,6 +37,25 @@ REDDIT_APP_SECRET = snoohelper.utils.credentials.get_token("REDDIT_APP_SECRET",
 REDDIT_REDIRECT_URI = snoohelper.utils.credentials.get_token("REDDIT_REDIRECT_URI", "credentials")
 
 
+def get_author_name(thing):
+    """
+    Lowercased author name of a submission or comment, None if the author is deleted
+    """
+    if thing.author is None:
+        return None
+    return thing.author.name.lower()
+
+
+def save_submission(submission_id, subreddit, **fields):
+    """
+    Create or update a SubmissionModel row, meant to run on the DatabaseWriter
+    """
+    submission, _ = SubmissionModel.get_or_create(submission_id=submission_id, subreddit=subreddit)
+    for name, value in fields.items():
+        setattr(submission, name, value)
+    submission.save()
+
+
 def retry_if_connection_error(exc):
     if isinstance(exc, requests.exceptions.ConnectionError) or isinstance(exc, prawcore.exceptions.RequestException):
         print("Connection error")
@@ -41,61 +66,100 @@ def retry_if_connection_error(exc):
 
 class SnooHelperBot:
 
-    def __init__(self, team, db_name, user_summaries=True):
+    def __init__(self, team, db_name, user_summaries=True, start=True):
         self.config = team
         if db_name == "snoohelper_test.db":
             user_agent = "Snoohelper 0.3 by /u/Santi871 - unittesting"
         else:
             user_agent = "Snoohelper 0.3 by /u/Santi871 - bot of /r/" + self.config.subreddit
 
-        if isinstance(db, Proxy):
-            db.initialize(SqliteDatabase(db_name, threadlocals=True, check_same_thread=False, timeout=30))
-            db.connect()
-            FilterModel.create_table(True)
-            SubmissionModel.create_table(True)
-            try:
-                db.create_tables(models=[UserModel, AlreadyDoneModel, UnflairedSubmissionModel])
-            except OperationalError:
-                pass
-            db.close()
+        init_database(db_name)
+        AlreadyDonePruner.start()
 
         self.db_name = db_name
-        self.halt = False
+        self._halt_event = Event()
+        self._halt_callbacks = [writer.flush]
+        self.last_warned_modqueue = 0
         self.webhook = self.config.webhook
         self.user_summaries = user_summaries
 
         if self.config.reddit_refresh_token:
-            self.r = praw.Reddit(user_agent=user_agent,
-                                 client_id=REDDIT_APP_ID, client_secret=REDDIT_APP_SECRET,
-                                 refresh_token=self.config.reddit_refresh_token)
+            self.r = create_reddit(self.config.subreddit, user_agent=user_agent,
+                                   client_id=REDDIT_APP_ID, client_secret=REDDIT_APP_SECRET,
+                                   refresh_token=self.config.reddit_refresh_token)
 
-            self.thread_r = praw.Reddit(user_agent=user_agent,
-                                 client_id=REDDIT_APP_ID, client_secret=REDDIT_APP_SECRET,
-                                 refresh_token=self.config.reddit_refresh_token)
+            self.thread_r = create_reddit(self.config.subreddit, user_agent=user_agent,
+                                          client_id=REDDIT_APP_ID, client_secret=REDDIT_APP_SECRET,
+                                          refresh_token=self.config.reddit_refresh_token)
 
         else:
-            self.r = praw.Reddit(user_agent=user_agent,
-                                 client_id=REDDIT_APP_ID, client_secret=REDDIT_APP_SECRET,
-                                 redirect_uri=REDDIT_REDIRECT_URI)
+            self.r = create_reddit(self.config.subreddit, user_agent=user_agent,
+                                   client_id=REDDIT_APP_ID, client_secret=REDDIT_APP_SECRET,
+                                   redirect_uri=REDDIT_REDIRECT_URI)
 
-            self.thread_r = praw.Reddit(user_agent=user_agent,
-                                 client_id=REDDIT_APP_ID, client_secret=REDDIT_APP_SECRET,
-                                 redirect_uri=REDDIT_REDIRECT_URI)
+            self.thread_r = create_reddit(self.config.subreddit, user_agent=user_agent,
+                                          client_id=REDDIT_APP_ID, client_secret=REDDIT_APP_SECRET,
+                                          redirect_uri=REDDIT_REDIRECT_URI)
 
         self.subreddit = self.thread_r.subreddit(self.config.subreddit)
         self.subreddit_name = self.subreddit.display_name
-        self.already_done_helper = AlreadyDoneHelper()
 
-        if db_name != "snoohelper_test.db":
-            t = Thread(target=self._init_modules, daemon=False)
+        with use_shard(self.subreddit_name):
+            self.already_done_helper = AlreadyDoneHelper(self.subreddit_name)
+            self.submissions_watermark = ListingWatermark(self.subreddit_name, 'submissions', initial_limit=50)
+            self.comments_watermark = ListingWatermark(self.subreddit_name, 'comments')
+            self.watermarks = {'submissions': self.submissions_watermark, 'comments': self.comments_watermark}
+            for action in MODLOG_ACTIONS:
+                listing = 'modlog:' + action
+                self.watermarks[listing] = ListingWatermark(self.subreddit_name, listing)
+        self.poll_intervals = dict((listing, AdaptivePollInterval()) for listing in self.watermarks)
+        self.next_poll = dict()
+        self.listing_group = None
+
+        if start:
+            self.start()
+
+    def start(self):
+        """
+        Start the bot's polling loop on its own thread, or in the calling thread when unit testing
+        """
+        if self.db_name != "snoohelper_test.db":
+            t = Thread(target=self.run, daemon=False)
             t.start()
         else:
-            self._init_modules()
+            self.run()
+
+    @property
+    def halt(self):
+        return self._halt_event.is_set()
+
+    @halt.setter
+    def halt(self, value):
+        """
+        Setting halt to True stops the bot right away, waking it up if it is waiting for its next cycle
+        """
+        if not value:
+            self._halt_event.clear()
+            return
+
+        self._halt_event.set()
+        for callback in self._halt_callbacks:
+            callback()
+
+    def add_halt_callback(self, callback):
+        """
+        Register a function to call when the bot is halted, used by runtimes that don't wait on a thread
 
-    def _init_modules(self):
+        :param callback: function taking no arguments
+        """
+        self._halt_callbacks.append(callback)
+
+    @subreddit_shard
+    def init_modules(self):
         self.user_warnings = None
         self.spam_cruncher = None
         self.flair_enforcer = None
+        self.flair_catalog = None
         self.botbans = False
         self.watch_stickies = False
         self.un = None
@@ -112,8 +176,9 @@ class SnooHelperBot:
             users_tracked = True
 
         if "flairenforce" in self.config.modules:
-            sample_submission = list(self.subreddit.new(limit=1))[0]
-            self.flair_enforcer = FlairEnforcer(self.r, self.subreddit_name, sample_submission)
+            self.flair_catalog = FlairCatalog(self.r, self.subreddit_name)
+            self.add_halt_callback(self.flair_catalog.stop)
+            self.flair_enforcer = FlairEnforcer(self.r, self.subreddit_name, self.flair_catalog)
 
         if "usernotes" in self.config.modules:
             self.un = puni.UserNotes(self.r, self.subreddit)
@@ -122,7 +187,9 @@ class SnooHelperBot:
             self.floodgate = Floodgate(faq_term_count_threshold=2)
 
         if "filters" in self.config.modules:
-            self.filters_controller = FiltersController(self.subreddit_name)
+            self.filters_controller = FiltersController(self.subreddit_name,
+                                                        check_selftext="filterselftext" in self.config.modules,
+                                                        check_comments="filtercomments" in self.config.modules)
 
         if "summaries" in self.config.modules:
             try:
@@ -136,8 +203,9 @@ class SnooHelperBot:
                 raise
 
         print("Done initializing | " + self.config.subreddit)
-        self.do_work()
 
+    @interactive
+    @subreddit_shard
     def botban(self, user, author, replace_original=False):
         response = snoohelper.utils.slack.SlackResponse(replace_original=replace_original)
         try:
@@ -148,10 +216,10 @@ class SnooHelperBot:
             return response
 
         if self.botbans:
-            user, _ = UserModel.get_or_create(username=redditor.name.lower(), subreddit=self.subreddit_name)
+            user = users.get_or_create(redditor.name, self.subreddit_name)
             if not user.shadowbanned:
                 user.shadowbanned = True
-                user.save()
+                users.save(user)
                 attachment = response.add_attachment(title="User /u/%s has been botbanned." % user.username,
                                         title_link="https://reddit.com/u/" + user.username, color='good',
                                                      callback_id="botban")
@@ -162,6 +230,8 @@ class SnooHelperBot:
             response.add_attachment(text='Error: botbans are not enabled for this team.', color='danger')
         return response
 
+    @interactive
+    @subreddit_shard
     def unbotban(self, user, author, replace_original=False):
         response = snoohelper.utils.slack.SlackResponse(replace_original=replace_original)
         try:
@@ -172,10 +242,10 @@ class SnooHelperBot:
             return response
 
         if self.botbans:
-            user, _ = UserModel.get_or_create(username=redditor.name.lower(), subreddit=self.subreddit_name)
+            user = users.get_or_create(redditor.name, self.subreddit_name)
             if user.shadowbanned:
                 user.shadowbanned = False
-                user.save()
+                users.save(user)
                 attachment = response.add_attachment(title="User /u/%s has been unbotbanned." % user.username,
                                                      title_link="https://reddit.com/u/" + user.username, color='good',
                                                      callback_id="unbotban")
@@ -186,6 +256,8 @@ class SnooHelperBot:
             response.add_attachment(text='Error: botbans are not enabled for this team.', color='danger')
         return response
 
+    @interactive
+    @subreddit_shard
     def track_user(self, user, replace_original=False):
         response = snoohelper.utils.slack.SlackResponse(replace_original=replace_original)
         try:
@@ -196,10 +268,10 @@ class SnooHelperBot:
             return response
 
         if self.user_warnings is not None:
-            user, _ = UserModel.get_or_create(username=redditor.name.lower(), subreddit=self.subreddit_name)
+            user = users.get_or_create(redditor.name, self.subreddit_name)
             if not user.tracked:
                 user.tracked = True
-                user.save()
+                users.save(user)
                 response.add_attachment(title="User /u/%s has been marked for tracking." % user.username,
                                         title_link="https://reddit.com/u/" + user.username, color='good')
             else:
@@ -208,6 +280,8 @@ class SnooHelperBot:
             response.add_attachment(text='Error: user tracking is not enabled for this team.', color='danger')
         return response
 
+    @interactive
+    @subreddit_shard
     def untrack_user(self, user, replace_original=False):
         response = snoohelper.utils.slack.SlackResponse(replace_original=replace_original)
         try:
@@ -218,10 +292,10 @@ class SnooHelperBot:
             return response
 
         if self.user_warnings is not None:
-            user, _ = UserModel.get_or_create(username=redditor.name.lower(), subreddit=self.subreddit_name)
+            user = users.get_or_create(redditor.name, self.subreddit_name)
             if user.tracked:
                 user.tracked = False
-                user.save()
+                users.save(user)
                 response.add_attachment(title="Ceasing to track user /u/%s." % user.username,
                                         title_link="https://reddit.com/u/" + user.username, color='good')
             else:
@@ -231,6 +305,7 @@ class SnooHelperBot:
         return response
 
     @own_thread
+    @interactive
     def inspect_ban(self, user, request):
         response = snoohelper.utils.slack.SlackResponse()
         try:
@@ -244,61 +319,67 @@ class SnooHelperBot:
         attachment.add_field("Ban date", value=str(datetime.datetime.fromtimestamp(banned_user.date)))
         request.delayed_response(response)
 
+    @subreddit_shard
     def mute_user_warnings(self, user):
         self.user_warnings.mute_user_warnings(user, self.subreddit_name)
 
+    @subreddit_shard
     def unmute_user_warnings(self, user):
         self.user_warnings.unmute_user_warnings(user, self.subreddit_name)
 
+    @subreddit_shard
     def add_filter(self, filter_string, use_regex, expires):
         self.filters_controller.add_filter(filter_string, use_regex, expires)
 
+    @subreddit_shard
     def remove_filter(self, filter_string):
         self.filters_controller.remove_filter(filter_string)
 
     @own_thread
+    @interactive
+    @subreddit_shard
     def quick_user_summary(self, user, request):
         response = self.summary_generator.generate_quick_summary(user)
         request.delayed_response(response)
 
     @own_thread
+    @interactive
+    @subreddit_shard
     def expanded_user_summary(self, request, limit, username):
         response = snoohelper.utils.slack.SlackResponse('Processing your request... please allow a few seconds.',
                                                         replace_original=False)
         self.summary_generator.generate_expanded_summary(username, limit, request)
         return response
 
+    @subreddit_shard
     def scan_submissions(self):
-        db.connect()
-        submissions = self.subreddit.new(limit=50)
+        submissions = self._fetch('submissions', self.subreddit.new)
         self.check_timed_submissions()
         if self.flair_enforcer is not None:
             self.flair_enforcer.check_submissions()
 
-        if self.floodgate is not None:
-            self.floodgate.check_all()
+        new_ids = set(self.already_done_helper.add_many([submission.id for submission in submissions],
+                                                        self.subreddit_name))
+        authors = users.prefetch([get_author_name(submission) for submission in submissions
+                                  if submission.id in new_ids and submission.author is not None],
+                                 self.subreddit_name)
+        filtered = self.check_filters([submission for submission in submissions if submission.id in new_ids])
 
         for submission in submissions:
             if self.flair_enforcer is not None and submission.link_flair_text is None:
                 self.flair_enforcer.add_submission(submission)
 
-            try:
-                self.already_done_helper.add(submission.id, self.subreddit_name)
-            except IntegrityError:
+            if submission.id not in new_ids:
                 continue
 
-            if self.filters_controller is not None:
-                results = self.filters_controller.check_all(submission.title)
-                if results:
-                    self.subreddit.mod.remove(submission)
+            if submission in filtered:
+                self.subreddit.mod.remove(submission)
 
             if self.floodgate is not None:
                 self.floodgate.accumulate_title(submission.title, submission.created_utc)
 
-            try:
-                user = UserModel.get(UserModel.username == submission.author.name.lower() and
-                                     UserModel.subreddit == submission.subreddit.display_name)
-            except DoesNotExist:
+            user = authors.get(get_author_name(submission))
+            if user is None:
                 continue
 
             if user.shadowbanned:
@@ -309,65 +390,68 @@ class SnooHelperBot:
                     self.user_warnings.send_warning(submission)
 
                 self.user_warnings.check_user_offenses(user)
-        db.close()
-
-    def scan_modlog(self):
-        subreddit = self.subreddit
-        relevant_actions = ('removecomment', 'removelink', 'approvelink', 'approvecomment', 'banuser')
 
-        db.connect()
-        modlog = list(subreddit.mod.log(limit=100))
-        new_items = 0
+        if self.floodgate is not None:
+            self.check_floodgate()
+        self.submissions_watermark.advance(submissions)
+        return submissions
+
+    @subreddit_shard
+    def scan_modlog(self, action):
+        """
+        Process the new modlog entries of one action type, each type is requested and paged separately
+
+        :param action: modlog action type, one of MODLOG_ACTIONS
+        :return: list of the fetched entries
+        """
+        listing = 'modlog:' + action
+        modlog = self._fetch(listing, functools.partial(self.subreddit.mod.log, action=action))
+        new_ids = set(self.already_done_helper.add_many([item.id for item in modlog], self.subreddit_name))
+
+        counters = {'removecomment': 'removed_comments', 'removelink': 'removed_submissions',
+                    'approvelink': 'approved_submissions', 'approvecomment': 'approved_comments', 'banuser': 'bans'}
+        deltas = dict()
 
         for item in modlog:
-            try:
-                self.already_done_helper.add(item.id, item.subreddit)
-                new_items += 1
-            except IntegrityError:
+            if item.id not in new_ids or item.action != action:
                 continue
 
-            if item.action in relevant_actions:
-                user, _ = UserModel.get_or_create(username=item.target_author.lower(), subreddit=item.subreddit)
-
-                if item.action == 'removecomment':
-                    user.removed_comments += 1
-                elif item.action == 'removelink':
-                    user.removed_submissions += 1
-                elif item.action == 'approvelink':
-                    user.approved_submissions += 1
-                elif item.action == 'approvecomment':
-                    user.approved_comments += 1
-                elif item.action == 'banuser':
-                    try:
-                        ban_length = int(re.findall('\d+', item.details)[0])
-                    except IndexError:
-                        ban_length = None
-
-                    ban_target = item.target_author
-                    ban_author = item._mod
-                    ban_reason = item.description + " | /u/" + ban_author
-
-                    if ban_target != "[deleted]" and is_banned(self.subreddit, user) and \
-                                     "| /u/" not in item.description:
-
-                        # Change to True to issue bans
-                        if False:
-                            self.subreddit.banned.add(ban_target, ban_reason=ban_reason, duration=ban_length)
-
-                        print("Banned: {}, reason: {}, duration: {}".format(ban_target, ban_reason, ban_length))
-
-                    if self.un is not None:
-                        snoohelper.utils.reddit.add_ban_note(self.un, item)
-                    user.bans += 1
-                elif item.action == 'unbanuser':
-                    if self.un is not None:
-                        snoohelper.utils.reddit.add_ban_note(self.un, item, unban=True)
-                user.save()
-                self.user_warnings.check_user_offenses(user)
+            if action in counters:
+                deltas.setdefault(item.target_author.lower(), Counter())[counters[action]] += 1
+
+            if action == 'banuser':
+                try:
+                    ban_length = int(re.findall('\d+', item.details)[0])
+                except IndexError:
+                    ban_length = None
+
+                ban_target = item.target_author
+                ban_author = item._mod
+                ban_reason = item.description + " | /u/" + ban_author
+
+                if ban_target != "[deleted]" and is_banned(self.subreddit, ban_target) and \
+                                 "| /u/" not in item.description:
 
-        db.close()
+                    # Change to True to issue bans
+                    if False:
+                        self.subreddit.banned.add(ban_target, ban_reason=ban_reason, duration=ban_length)
+
+                    print("Banned: {}, reason: {}, duration: {}".format(ban_target, ban_reason, ban_length))
+
+                if self.un is not None:
+                    snoohelper.utils.reddit.add_ban_note(self.un, item)
+            elif action == 'unbanuser':
+                if self.un is not None:
+                    snoohelper.utils.reddit.add_ban_note(self.un, item, unban=True)
+
+        for user in users.add_to_counters(deltas, self.subreddit_name):
+            self.user_warnings.check_user_offenses(user)
+
+        self.watermarks[listing].advance(modlog)
+        return modlog
 
     @own_thread
+    @interactive
     def message_modmail(self, message, author, request):
         response = snoohelper.utils.slack.SlackResponse("Message sent.")
 
@@ -379,135 +463,134 @@ class SnooHelperBot:
         request.delayed_response(response)
 
     @own_thread
+    @interactive
+    @subreddit_shard
     def import_botbans(self, botbans_string, request):
         botbans_string = botbans_string.replace("'", "")
         botbans_string = botbans_string.replace('"', "")
         botbans_string = botbans_string.replace("[", "")
         botbans_string = botbans_string.replace("]", "")
         botbans_string = botbans_string.replace(" ", "")
-        users = botbans_string.split(',')
+        usernames = botbans_string.split(',')
         n = 0
-        db.connect()
-        for user in users:
-            user_record, _ = UserModel.get_or_create(username=user.lower(), subreddit=self.subreddit_name)
+        ensure_connection()
+        for username in usernames:
+            user_record = users.get_or_create(username, self.subreddit_name)
             user_record.shadowbanned = True
-            user_record.save()
+            users.save(user_record)
             n += 1
-        db.close()
 
         response = snoohelper.utils.slack.SlackResponse()
         response.add_attachment(text="Botbans imported successfully. Number of botbans imported: {}.".format(n),
                                 color='good')
         request.delayed_response(response)
 
+    @subreddit_shard
     def export_botbans(self):
         exported_string = "["
-        db.connect()
-        for user in UserModel.select().where(UserModel.shadowbanned and UserModel.subreddit == self.subreddit_name):
+        ensure_connection()
+        for user in UserModel.select().where(UserModel.shadowbanned == True,
+                                                UserModel.subreddit == self.subreddit_name):
             s = "'{}',".format(user.username)
             exported_string += s
-        db.close()
         exported_string = exported_string[:-1] + "]"
         return snoohelper.utils.slack.SlackResponse(exported_string)
 
     @own_thread
+    @interactive
+    @subreddit_shard
     def add_watched_comment(self, comment_id, request):
         comment = self.r.comment(comment_id)
-        db.connect()
-        submission, _ = SubmissionModel.get_or_create(submission_id=comment.submission.id,
-                                                      subreddit=self.subreddit_name)
-        submission.sticky_cmt_id = comment.id
-        submission.save()
-        db.close()
+        writer.submit(save_submission, comment.submission.id, self.subreddit_name, sticky_cmt_id=comment.id)
         response = snoohelper.utils.slack.SlackResponse("Will remove replies to comment: " + comment.id)
         request.delayed_response(response)
 
+    @subreddit_shard
     def check_timed_submissions(self):
-        db.connect()
-        submissions = SubmissionModel.select().where(SubmissionModel.subreddit == self.subreddit_name and
-                                                     SubmissionModel.approve_at)
+        submissions = SubmissionModel.select().where(SubmissionModel.subreddit == self.subreddit_name,
+                                                     SubmissionModel.approve_at != 0)
         for submission in submissions:
             if time.time() > submission.approve_at.timestamp():
-                submission.delete_instance()
+                writer.submit(submission.delete_instance)
                 submission = self.r.submission(submission.submission_id)
                 self.subreddit.mod.approve(submission)
                 message = snoohelper.utils.slack.SlackResponse("Approved timed submission: " + submission.permalink)
                 self.webhook.send_message(message)
 
-        submissions = SubmissionModel.select().where(SubmissionModel.subreddit == self.subreddit_name and
-                                                     SubmissionModel.unlock_at)
+        submissions = SubmissionModel.select().where(SubmissionModel.subreddit == self.subreddit_name,
+                                                     SubmissionModel.unlock_at != 0)
         for submission in submissions:
             if time.time() > submission.unlock_at.timestamp():
-                submission.delete_instance()
+                writer.submit(submission.delete_instance)
                 submission = self.r.submission(submission.submission_id)
                 self.subreddit.mod.unlock(submission)
                 message = snoohelper.utils.slack.SlackResponse("Unlocked timed submission: " + submission.permalink)
                 self.webhook.send_message(message)
 
-        submissions = SubmissionModel.select().where(SubmissionModel.subreddit == self.subreddit_name and
-                                                     SubmissionModel.lock_at)
+        submissions = SubmissionModel.select().where(SubmissionModel.subreddit == self.subreddit_name,
+                                                     SubmissionModel.lock_at != 0)
         for submission in submissions:
             if time.time() > submission.lock_at.timestamp():
-                submission.delete_instance()
+                writer.submit(submission.delete_instance)
                 submission = self.r.submission(submission.submission_id)
                 self.subreddit.mod.lock(submission)
                 message = snoohelper.utils.slack.SlackResponse("Locked timed submission: " + submission.permalink)
                 self.webhook.send_message(message)
-        db.close()
 
     @own_thread
+    @interactive
+    @subreddit_shard
     def add_timed_submission(self, submission_id, action, hours, request):
-        db.connect()
         response = None
         if action == "approve":
             submission = self.r.submission(submission_id)
             self.subreddit.mod.remove(submission)
-            submission, _ = SubmissionModel.get_or_create(submission_id=submission_id, subreddit=self.subreddit_name)
-            submission.approve_at = hours * 3600 + time.time()
-            submission.save()
+            writer.submit(save_submission, submission_id, self.subreddit_name, approve_at=hours * 3600 + time.time())
             response = snoohelper.utils.slack.SlackResponse("Will approve in {} hours.".format(hours))
         elif action == "unlock":
             submission = self.r.submission(submission_id)
             self.subreddit.mod.lock(submission)
-            submission, _ = SubmissionModel.get_or_create(submission_id=submission_id, subreddit=self.subreddit_name)
-            submission.unlock_at = hours * 3600 + time.time()
-            submission.save()
+            writer.submit(save_submission, submission_id, self.subreddit_name, unlock_at=hours * 3600 + time.time())
             response = snoohelper.utils.slack.SlackResponse("Will unlock in {} hours.".format(hours))
         elif action == "lock":
-            submission, _ = SubmissionModel.get_or_create(submission_id=submission_id, subreddit=self.subreddit_name)
-            submission.lock_at = hours * 3600 + time.time()
-            submission.save()
+            writer.submit(save_submission, submission_id, self.subreddit_name, lock_at=hours * 3600 + time.time())
             response = snoohelper.utils.slack.SlackResponse("Will lock in {} hours.".format(hours))
-        db.close()
         request.delayed_response(response)
 
+    @subreddit_shard
     def scan_comments(self):
-        db.connect()
-        comments = self.subreddit.comments(limit=100)
+        comments = self._fetch('comments', self.subreddit.comments)
         sticky_comments_ids = ["t1_" + submission.sticky_cmt_id for submission in
                                SubmissionModel.select().where(SubmissionModel.sticky_cmt_id)]
+        new_ids = set(self.already_done_helper.add_many([comment.id for comment in comments], self.subreddit_name))
+        authors = users.prefetch([get_author_name(comment) for comment in comments
+                                  if comment.id in new_ids and comment.author is not None],
+                                 self.subreddit_name)
+        filtered = self.check_filters([comment for comment in comments if comment.id in new_ids])
 
         for comment in comments:
-            try:
-                self.already_done_helper.add(comment.id, self.subreddit_name)
-            except IntegrityError:
+            if comment.id not in new_ids:
                 continue
 
-            try:
-                user = UserModel.get(UserModel.username == comment.author.name.lower(),
-                                     UserModel.subreddit == comment.subreddit.display_name)
-            except DoesNotExist:
+            if comment in filtered:
+                self.subreddit.mod.remove(comment)
+
+            user = authors.get(get_author_name(comment))
+            if user is None:
                 continue
 
             if user.shadowbanned:
                 self.subreddit.mod.remove(comment)
-            if user.tracked:
-                self.user_warnings.send_warning(comment)
             if comment.parent_id in sticky_comments_ids:
                 self.subreddit.mod.remove(comment)
 
-            self.user_warnings.check_user_offenses(user)
-        db.close()
+            if self.user_warnings is not None:
+                if user.tracked:
+                    self.user_warnings.send_warning(comment)
+
+                self.user_warnings.check_user_offenses(user)
+        self.comments_watermark.advance(comments)
+        return comments
 
     def monitor_queue(self, last_warned_modqueue):
         modqueue = list(self.subreddit.mod.modqueue(limit=100))
@@ -519,33 +602,130 @@ class SnooHelperBot:
             self.webhook.send_message(message)
         return last_warned_modqueue
 
-    def do_work(self):
-        last_warned_modqueue = 0
-        while not self.halt:
-            try:
-                if self.user_warnings is not None:
+    def check_floodgate(self):
+        """
+        Report to the team the groups of similar titles that flooded the subreddit since the last check
+
+        :return: list of clusters of titles, newest first, None if there are none
+        """
+        clusters = self.floodgate.check_all()
+        if clusters is not None:
+            message = snoohelper.utils.slack.SlackResponse("Many similar submissions posted recently in /r/" +
+                                                           self.subreddit_name + ", consider adding them to the FAQ")
+            for titles in clusters:
+                message.add_attachment(title="{} submissions like: {}".format(len(titles), titles[0]),
+                                       text="\n".join(titles[1:]), color='warning')
+            self.webhook.send_message(message)
+        return clusters
+
+    def check_filters(self, items):
+        """
+        Check a batch of new submissions or comments against the subreddit's filters, the items matching one are
+        reported to the team in a single webhook message
+
+        :param items: list of praw Submission or Comment instances
+        :return: dict of matching item to the Filter it matched
+        """
+        if self.filters_controller is None:
+            return dict()
+
+        hits = self.filters_controller.check_items(items)
+        if hits:
+            message = snoohelper.utils.slack.SlackResponse("Removed {} item(s) matching filters in /r/{}".format(
+                len(hits), self.subreddit_name))
+            for item, filter_obj in hits:
+                author = get_author_name(item) or "[deleted]"
+                title = getattr(item, 'title', None)
+                if title is None:
+                    message.add_attachment(title="Comment by /u/" + author, text=item.body, color='warning',
+                                           footer="Filter: " + filter_obj.filter_string)
+                else:
+                    message.add_attachment(title=title, title_link=item.permalink, text="Submission by /u/" + author,
+                                           color='warning', footer="Filter: " + filter_obj.filter_string)
+            self.webhook.send_message(message)
+        return dict(hits)
+
+    def _shares_listings(self):
+        return self.listing_group is not None and self.listing_group.is_shared()
+
+    def _fetch(self, listing, listing_func):
+        """
+        Fetch the new items of a listing, from the combined listing of the team's group when it shares one
+
+        :param listing: name of the listing, key of self.watermarks
+        :param listing_func: praw listing method of this subreddit
+        :return: list of items, newest first
+        """
+        if self._shares_listings():
+            return self.listing_group.fetch(self, listing)
+        return self.watermarks[listing].fetch(listing_func)
+
+    def _poll(self, listing, scan):
+        """
+        Run a scan if its listing is due, then schedule the listing's next poll from its arrival rate
+        Listings shared with a group are due when the group polls them next
+
+        :param listing: name of the listing, key of self.watermarks
+        :param scan: scan method returning the new items it processed
+        """
+        if time.time() < self.next_poll.get(listing, 0):
+            return
+
+        if self._shares_listings():
+            scan()
+            self.next_poll[listing] = self.listing_group.next_poll(listing)
+            return
+
+        fallback = float(getattr(self.config, 'sleep', 20))
+        poll_interval = self.poll_intervals[listing]
+        self.watermarks[listing].probe_limit = poll_interval.page_size(fallback)
+
+        items = scan()
+        poll_interval.record(items)
+        self.next_poll[listing] = time.time() + poll_interval.interval(fallback)
+
+    @subreddit_shard
+    def run_cycle(self):
+        """
+        Run the enabled scans whose listings are due
+
+        :return: seconds to wait until the next listing is due
+        """
+        try:
+            if self.user_warnings is not None:
+                for action in MODLOG_ACTIONS:
                     try:
-                        self.scan_modlog()
+                        self._poll('modlog:' + action, functools.partial(self.scan_modlog, action))
                     except TypeError:
                         pass
 
-                if self.user_warnings is not None or self.botbans or self.flair_enforcer is not None:
-                    self.scan_submissions()
+            if self.user_warnings is not None or self.botbans or self.flair_enforcer is not None:
+                self._poll('submissions', self.scan_submissions)
 
-                if self.botbans or self.user_warnings:
-                    self.scan_comments()
+            if self.botbans or self.user_warnings or \
+                    (self.filters_controller is not None and self.filters_controller.check_comments):
+                self._poll('comments', self.scan_comments)
 
-                if "watchqueues" in self.config.modules:
-                    last_warned_modqueue = self.monitor_queue(last_warned_modqueue)
+            if "watchqueues" in self.config.modules:
+                self.last_warned_modqueue = self.monitor_queue(self.last_warned_modqueue)
 
-                if self.db_name == "snoohelper_test.db":
-                    break
-                time.sleep(20)
-            except (requests.exceptions.ConnectionError, requests.exceptions.RequestException,
-                    prawcore.exceptions.RequestException):
-                time.sleep(2)
-                continue
-            except:
-                print(traceback.format_exc())
-                time.sleep(5)
-                continue
+            if not self.next_poll:
+                return 20
+            return max(1, min(self.next_poll.values()) - time.time())
+        except (requests.exceptions.ConnectionError, requests.exceptions.RequestException,
+                prawcore.exceptions.RequestException):
+            return 2
+        except:
+            print(traceback.format_exc())
+            return 5
+
+    def do_work(self):
+        while not self.halt:
+            delay = self.run_cycle()
+            if self.db_name == "snoohelper_test.db":
+                break
+            self._halt_event.wait(delay)
+
+    def run(self):
+        self.init_modules()
+        self.do_work()
@@ -1,7 +1,29 @@
-from snoohelper.database.models import FilterModel, db
+import heapq
+import itertools
+from collections import OrderedDict
+from threading import RLock, Timer
+from snoohelper.database.models import FilterModel
+from snoohelper.database.connection import use_shard
+from snoohelper.utils.reddit import chunks, SQLITE_MAX_VARIABLES
+from snoohelper.utils.text import AhoCorasick, normalize
+import snoohelper.database.writer as writer
 import time
 import re
 
+# Patterns that can't share a combined pattern with others: backreferences and named groups depend on group numbers
+# and names, global flags must come first
+SEPARATE_PATTERN = re.compile(r'\\[1-9]|\(\?P[<=]|^\(\?[aiLmsux]+\)')
+
+
+def delete_filter(filter_string, subreddit):
+    FilterModel.delete().where(FilterModel.filter_string == filter_string,
+                               FilterModel.subreddit == subreddit).execute()
+
+
+def delete_filters(filter_strings, subreddit):
+    for chunk in chunks(filter_strings, SQLITE_MAX_VARIABLES - 1):
+        FilterModel.delete().where(FilterModel.filter_string << chunk, FilterModel.subreddit == subreddit).execute()
+
 
 class Filter:
 
@@ -12,6 +34,7 @@ class Filter:
         self.subreddit = subreddit
         self.split_filter = None
         self.split_regex = None
+        self._matcher = None
 
         if not use_regex:
             self.split_filter = self.filter_string.split(',')
@@ -19,19 +42,13 @@ class Filter:
             self.filter_string = self.filter_string.replace('"', "")
             self.filter_string = self.filter_string.replace("'", "")
             self.split_regex = self.filter_string.split(',')
-        self.save()
 
     def save(self):
-        db.connect()
-        FilterModel.create(filter_string=self.filter_string, subreddit=self.subreddit, expires=self.expires,
-                           use_regex=self.use_regex)
-        db.close()
+        writer.submit(FilterModel.create, filter_string=self.filter_string, subreddit=self.subreddit,
+                      expires=self.expires, use_regex=self.use_regex)
 
     def remove(self):
-        db.connect()
-        filter_obj = FilterModel.get(filter_string=self.filter_string, subreddit=self.subreddit)
-        filter_obj.delete_instance()
-        db.close()
+        writer.submit(delete_filter, self.filter_string, self.subreddit)
 
     def has_expired(self):
         if time.time() > self.expires and self.expires:
@@ -39,47 +56,227 @@ class Filter:
         return False
 
     def check_filter(self, text):
-        if not self.use_regex:
-            for word in self.split_filter:
-                if word in text:
-                    return True
-            return False
-        else:
-            for regex_pattern in self.split_regex:
-                results = re.findall(regex_pattern, text)
-                if results:
-                    return True
-            return False
+        if self._matcher is None:
+            self._matcher = FilterMatcher()
+            self._matcher.add(self)
+        return self._matcher.match(normalize(text)) is self
+
+
+class FilterMatcher:
+    """
+    Every filter of a subreddit compiled for a single pass over a text: the keywords of all keyword filters in one
+    Aho-Corasick automaton and the patterns of all regex filters in one pattern, with a named group per pattern
+    Texts are expected normalized with normalize(), keywords are normalized the same way and patterns ignore case
+    """
+
+    def __init__(self):
+        self.keywords = AhoCorasick()
+        self.patterns = OrderedDict()
+        self.separate_patterns = list()
+        self.combined = None
+        self._next_group = 0
+        self._dirty = False
+        self._lock = RLock()
+
+    def add(self, filter_obj):
+        """
+        :param filter_obj: Filter instance
+        """
+        with self._lock:
+            if not filter_obj.use_regex:
+                for word in filter_obj.split_filter:
+                    self.keywords.add(normalize(word), filter_obj)
+                return
+
+            for pattern in filter_obj.split_regex:
+                try:
+                    compiled = re.compile(pattern, re.IGNORECASE)
+                except re.error as e:
+                    print("Ignoring invalid filter pattern {}: {}".format(pattern, e))
+                    continue
+
+                if SEPARATE_PATTERN.search(pattern):
+                    self.separate_patterns.append((compiled, filter_obj))
+                else:
+                    self.patterns['f{}'.format(self._next_group)] = (pattern, filter_obj)
+                    self._next_group += 1
+                    self._dirty = True
+
+    def remove(self, filter_obj):
+        """
+        :param filter_obj: Filter instance previously added
+        """
+        with self._lock:
+            if not filter_obj.use_regex:
+                for word in filter_obj.split_filter:
+                    self.keywords.remove(normalize(word), filter_obj)
+                return
+
+            self.separate_patterns = [(compiled, other) for compiled, other in self.separate_patterns
+                                      if other is not filter_obj]
+            for name in [name for name, (_, other) in self.patterns.items() if other is filter_obj]:
+                del self.patterns[name]
+                self._dirty = True
+
+    def _compile(self):
+        self._dirty = False
+        if not self.patterns:
+            self.combined = None
+            return
+
+        try:
+            self.combined = re.compile('|'.join('(?P<{}>{})'.format(name, pattern)
+                                                for name, (pattern, _) in self.patterns.items()), re.IGNORECASE)
+        except re.error:
+            self.separate_patterns.extend((re.compile(pattern, re.IGNORECASE), filter_obj)
+                                          for pattern, filter_obj in self.patterns.values())
+            self.patterns.clear()
+            self.combined = None
+
+    def match(self, text):
+        """
+        :param text: normalized text to check
+        :return: the Filter matching the text, None if no filter matches
+        """
+        with self._lock:
+            filter_obj = self.keywords.first(text)
+            if filter_obj is not None:
+                return filter_obj
+
+            if self._dirty:
+                self._compile()
+
+            if self.combined is not None:
+                match = self.combined.search(text)
+                if match is not None:
+                    return self.patterns[match.lastgroup][1]
+
+            for compiled, filter_obj in self.separate_patterns:
+                if compiled.search(text) is not None:
+                    return filter_obj
+            return None
+
+    def match_many(self, texts):
+        """
+        :param texts: list of normalized texts to check
+        :return: list holding, for each text, the Filter matching it or None
+        """
+        with self._lock:
+            return [self.match(text) for text in texts]
 
 
 class FiltersController:
+    """
+    Holds the filters of a subreddit. Expiry deadlines are kept in a min-heap drained by a timer, which removes
+    expired filters from memory and from the database in one batch, so checking a text never looks at timestamps
+    """
 
-    def __init__(self, subreddit):
+    def __init__(self, subreddit, check_selftext=False, check_comments=False):
+        """
+        :param subreddit: subreddit display name
+        :param check_selftext: also check the selftext of submissions, not only their title
+        :param check_comments: also check comment bodies
+        """
         self.subreddit = subreddit
-        self.filters = list()
+        self.check_selftext = check_selftext
+        self.check_comments = check_comments
+        self.filters = OrderedDict()
+        self.matcher = FilterMatcher()
+        self.expiry_heap = list()
+        self.expiry_timer = None
+        self._sequence = itertools.count()
+        self._lock = RLock()
 
         for filter_instance in FilterModel.select().where(FilterModel.subreddit == subreddit):
-            self.add_filter(filter_string=filter_instance.filter_string, use_regex=filter_instance.use_regex,
-                            expires=filter_instance.expires.timestamp())
+            # TimestampField reads a stored 0, a filter that never expires, back as None
+            expires = 0
+            if filter_instance.expires is not None:
+                expires = filter_instance.expires.timestamp()
+            self._add(Filter(filter_string=filter_instance.filter_string, use_regex=filter_instance.use_regex,
+                             subreddit=self.subreddit, expires=expires))
+
+    def _add(self, filter_obj):
+        with self._lock:
+            previous = self.filters.pop(filter_obj.filter_string, None)
+            if previous is not None:
+                self.matcher.remove(previous)
+
+            self.filters[filter_obj.filter_string] = filter_obj
+            self.matcher.add(filter_obj)
+            if filter_obj.expires:
+                heapq.heappush(self.expiry_heap, (filter_obj.expires, next(self._sequence), filter_obj))
+                if self.expiry_heap[0][2] is filter_obj:
+                    self._schedule_expiry()
+
+    def _schedule_expiry(self):
+        if self.expiry_timer is not None:
+            self.expiry_timer.cancel()
+            self.expiry_timer = None
+
+        if self.expiry_heap:
+            self.expiry_timer = Timer(max(0, self.expiry_heap[0][0] - time.time()), self._expire)
+            self.expiry_timer.daemon = True
+            self.expiry_timer.start()
+
+    def _expire(self):
+        expired = list()
+        with self._lock:
+            now = time.time()
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                _, _, filter_obj = heapq.heappop(self.expiry_heap)
+                if self.filters.get(filter_obj.filter_string) is filter_obj:
+                    del self.filters[filter_obj.filter_string]
+                    self.matcher.remove(filter_obj)
+                    expired.append(filter_obj.filter_string)
+            self._schedule_expiry()
+
+        if expired:
+            with use_shard(self.subreddit):
+                writer.submit(delete_filters, expired, self.subreddit)
 
     def add_filter(self, filter_string, use_regex, expires):
         filter_obj = Filter(filter_string=filter_string, use_regex=use_regex, subreddit=self.subreddit, expires=expires)
-        self.filters.append(filter_obj)
+        filter_obj.save()
+        self._add(filter_obj)
         return filter_obj
 
     def remove_filter(self, filter_string):
-        filter_obj = FilterModel.get(filter_string=filter_string, subreddit=self.subreddit)
-        filter_obj.delete_instance()
-        for filter_obj in self.filters:
-            if filter_obj.filter_string == filter_string and filter_obj.subreddit == self.subreddit:
-                self.filters.remove(filter_obj)
-                break
+        writer.submit(delete_filter, filter_string, self.subreddit)
+        with self._lock:
+            filter_obj = self.filters.pop(filter_string, None)
+            if filter_obj is not None:
+                self.matcher.remove(filter_obj)
 
     def check_all(self, text):
-        for filter_obj in self.filters:
-            expired = filter_obj.has_expired()
-            if expired:
-                self.remove_filter(filter_obj.filter_string)
-                continue
-            return filter_obj.check_filter(text), filter_obj
-        return False
+        """
+        Check a text against every filter at once
+
+        :param text: text to check
+        :return: the Filter matching the text, None if no filter matches
+        """
+        return self.matcher.match(normalize(text))
+
+    def _item_texts(self, item):
+        title = getattr(item, 'title', None)
+        if title is None:
+            return [item.body] if self.check_comments else []
+        if self.check_selftext and item.selftext:
+            return [title, item.selftext]
+        return [title]
+
+    def check_items(self, items):
+        """
+        Check a batch of submissions and comments against every filter, each text is normalized once and checked in
+        one pass. Comments are only checked if check_comments is set, selftexts if check_selftext is set
+
+        :param items: iterable of praw Submission and Comment instances
+        :return: list of (item, Filter) tuples, one per item matching a filter
+        """
+        checked = [(item, normalize(text)) for item in items for text in self._item_texts(item)]
+        results = self.matcher.match_many([text for _, text in checked])
+
+        hits = OrderedDict()
+        for (item, _), filter_obj in zip(checked, results):
+            if filter_obj is not None and item not in hits:
+                hits[item] = filter_obj
+        return list(hits.items())
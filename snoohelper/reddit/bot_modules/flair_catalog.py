@@ -0,0 +1,106 @@
+import time
+import traceback
+from threading import Timer
+from snoohelper.database.models import FlairTemplateModel
+from snoohelper.database.connection import use_shard
+from snoohelper.utils.reddit import chunks, SQLITE_MAX_VARIABLES
+import snoohelper.database.writer as writer
+
+
+def replace_flair_templates(subreddit, rows):
+    FlairTemplateModel.delete().where(FlairTemplateModel.subreddit == subreddit).execute()
+    for chunk in chunks(rows, SQLITE_MAX_VARIABLES // 5):
+        FlairTemplateModel.insert_many(chunk).execute()
+
+
+class FlairCatalog:
+
+    """
+    Link flair templates of a subreddit, cached in memory and in the database and refreshed in the background every
+    ttl seconds. version changes whenever the templates do
+    Requires 'modflair' permission
+    """
+
+    def __init__(self, r, subreddit, ttl=3600, retry_delay=60):
+        """
+        Load the templates from the database, fetching them from Reddit only if there are none yet
+
+        :param r: instance of praw.Reddit
+        :param subreddit: name of subreddit
+        :param ttl: seconds after which the templates are fetched again
+        :param retry_delay: seconds to wait before retrying a failed refresh
+        """
+        self.r = r
+        self.subreddit = subreddit
+        self.ttl = ttl
+        self.retry_delay = retry_delay
+        self.flairs = list()
+        self.version = 0
+        self.fetched_at = 0
+        self._timer = None
+        self._stopped = False
+
+        self._load_from_database()
+        if not self.flairs:
+            self.refresh()
+        self._schedule(self.fetched_at + self.ttl - time.time())
+
+    def _load_from_database(self):
+        rows = list(FlairTemplateModel.select().where(FlairTemplateModel.subreddit == self.subreddit).
+                    order_by(FlairTemplateModel.position))
+        if rows:
+            self.flairs = [(row.flair_text, row.template_id) for row in rows]
+            self.fetched_at = rows[0].fetched_at.timestamp()
+            self.version += 1
+
+    def fetch(self):
+        """
+        :return: list of (flair text, flair template id) tuples, as listed by the subreddit's link flair endpoint
+        """
+        templates = self.r.get('r/{}/api/link_flair'.format(self.subreddit))
+        return [(template['text'], template['id']) for template in templates]
+
+    def refresh(self):
+        """
+        Fetch the templates and store them if they have changed
+
+        :return: True if the templates have changed
+        """
+        flairs = self.fetch()
+        self.fetched_at = time.time()
+
+        changed = flairs != self.flairs
+        if changed:
+            self.flairs = flairs
+            self.version += 1
+
+        rows = [{'subreddit': self.subreddit, 'template_id': template_id, 'flair_text': flair_text,
+                 'position': position, 'fetched_at': self.fetched_at}
+                for position, (flair_text, template_id) in enumerate(flairs)]
+        with use_shard(self.subreddit):
+            writer.submit(replace_flair_templates, self.subreddit, rows)
+        return changed
+
+    def _schedule(self, delay):
+        if self._stopped:
+            return
+
+        self._timer = Timer(max(0, delay), self._run)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _run(self):
+        try:
+            self.refresh()
+            self._schedule(self.ttl)
+        except Exception:
+            print(traceback.format_exc())
+            self._schedule(self.retry_delay)
+
+    def stop(self):
+        """
+        Stop refreshing the templates in the background
+        """
+        self._stopped = True
+        if self._timer is not None:
+            self._timer.cancel()
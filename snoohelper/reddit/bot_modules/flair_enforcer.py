@@ -1,9 +1,11 @@
 import datetime
+import functools
 import praw
 import praw.exceptions
-from snoohelper.database.models import UnflairedSubmissionModel
+from snoohelper.database.models import UnflairedSubmissionModel, PendingSubmissionModel
+from snoohelper.utils.reddit import chunks, SQLITE_MAX_VARIABLES
+import snoohelper.database.writer as writer
 import time
-from peewee import DoesNotExist
 
 
 class FlairEnforcer:
@@ -14,13 +16,13 @@ class FlairEnforcer:
     Requires 'modflair' and 'privatemessages' permissions (the latter only if comments_flairing is set to True)
     """
 
-    def __init__(self, r, subreddit, sample_submission, grace_period=600, comments_flairing=True):
+    def __init__(self, r, subreddit, flair_catalog, grace_period=600, comments_flairing=True):
         """
         Constructor for FlairEnforcer
 
         :param r: instance of praw.Reddit
         :param subreddit: name of subreddit
-        :param sample_submission: instance of praw.models.Submission of subreddit, to get flair choices
+        :param flair_catalog: instance of FlairCatalog of subreddit, to get flair choices
         :param grace_period: seconds to allow user to assign a flair before removing their submission
         :param comments_flairing: allow user to flair via comment reply
         """
@@ -29,23 +31,112 @@ class FlairEnforcer:
         self.subreddit = subreddit
         self.sub_object = self.r.subreddit(self.subreddit)
         self.sub_mod = self.sub_object.mod
-        self.unflaired_submissions = list()
+        self.unflaired_submissions = dict()
+        self.unflaired_by_comment = dict()
+        self.pending_submissions = dict()
         self.grace_period = grace_period
-        self.flairs = [(flair['flair_text'], flair['flair_template_id']) for flair in sample_submission.flair.choices()]
+        self.flair_catalog = flair_catalog
+        self._flair_templates = dict()
+        self._flair_templates_version = None
         self._load_from_database()
 
+    @property
+    def flairs(self):
+        return self.flair_catalog.flairs
+
+    @property
+    def flair_templates(self):
+        """
+        Casefolded flair text to (flair text, flair template id) map, rebuilt when the catalog's templates change
+        """
+        if self._flair_templates_version != self.flair_catalog.version:
+            self._flair_templates_version = self.flair_catalog.version
+            self._flair_templates = dict((flair_text.casefold(), (flair_text, template_id))
+                                         for flair_text, template_id in self.flairs)
+        return self._flair_templates
+
+    def _track(self, unflaired_submission):
+        self.unflaired_submissions[unflaired_submission.submission_id] = unflaired_submission
+        if unflaired_submission.comment is not None:
+            self.unflaired_by_comment[unflaired_submission.comment.id] = unflaired_submission
+
+    def _untrack(self, unflaired_submission):
+        self.unflaired_submissions.pop(unflaired_submission.submission_id, None)
+        if unflaired_submission.comment is not None:
+            self.unflaired_by_comment.pop(unflaired_submission.comment.id, None)
+
+    def _find_flair(self, body):
+        """
+        Find the flair a reply asks for, either its whole text or one of its words
+
+        :param body: reply body
+        :return: tuple of flair text and flair template id, None if the reply names no flair
+        """
+        words = [word.strip("'").strip('"').casefold() for word in body.split()]
+        for candidate in [' '.join(words)] + words:
+            flair = self.flair_templates.get(candidate)
+            if flair is not None:
+                return flair
+        return None
+
+    def _check_reply(self, reply):
+        """
+        Flair and approve the submission a reply to one of the bot's comments asks for
+
+        :param reply: instance of praw.models.Comment from the inbox
+        """
+        if len(reply.body.split()) >= 4:
+            return
+
+        unflaired_submission = self.unflaired_by_comment.get(reply.parent_id.split('_', 1)[-1])
+        if unflaired_submission is None:
+            # Inbox replies don't always carry link_id, the parent comment lookup above is then the only one
+            link_id = getattr(reply, 'link_id', None)
+            if link_id is None:
+                return
+            unflaired_submission = self.unflaired_submissions.get(link_id.split('_', 1)[-1])
+        if unflaired_submission is None:
+            return
+
+        flair = self._find_flair(reply.body)
+        if flair is None:
+            return
+
+        try:
+            if reply.author.name != unflaired_submission.author:
+                return
+        except AttributeError:
+            self._untrack(unflaired_submission)
+            return
+
+        flair_text, template_id = flair
+        unflaired_submission.submission.flair.select(template_id, flair_text)
+        self.sub_mod.remove(reply)
+        unflaired_submission.approve()
+        self._untrack(unflaired_submission)
+
     def _load_from_database(self):
         """
-        Get tracked unflaired submissions from database
+        Get this subreddit's tracked unflaired submissions and pending submissions from database, without any Reddit
+        request. Their flair and expiry are checked on the next call to check_submissions()
         """
-        for unflaired_submission in UnflairedSubmissionModel.select():
+        query = PendingSubmissionModel.select().where(PendingSubmissionModel.subreddit == self.subreddit)
+        for pending_submission in query:
+            self.pending_submissions[pending_submission.submission_id] = pending_submission.created_utc.timestamp()
+
+        query = UnflairedSubmissionModel.select().where(UnflairedSubmissionModel.subreddit == self.subreddit)
+        for unflaired_submission in query:
+            created_utc = None
+            if unflaired_submission.created_utc is not None:
+                created_utc = unflaired_submission.created_utc.timestamp()
+
             unflaired_submission_obj = UnflairedSubmission(self.r, unflaired_submission.submission_id, self.sub_object,
                                                            self.flairs,
                                                            unflaired_submission.comment_id,
-                                                           self.comments_flairing)
-            deleted = unflaired_submission_obj.delete_if_overtime()
-            if not deleted:
-                self.unflaired_submissions.append(unflaired_submission_obj)
+                                                           self.comments_flairing,
+                                                           created_utc=created_utc,
+                                                           author=unflaired_submission.author)
+            self._track(unflaired_submission_obj)
 
     def check_submissions(self, force_approve=False, force_check=False):
         """
@@ -55,68 +146,75 @@ class FlairEnforcer:
         :param force_approve: Approve all tracked submissions. For debugging purposes.
         :param force_check: Check regardless of whether the PM is marked unread
         """
+        self._check_pending()
+
         if self.comments_flairing:
-            new_replies = self.r.inbox.comment_replies(limit=20)
-            for reply in new_replies:
+            for reply in self.r.inbox.comment_replies(limit=20):
                 if reply.new or force_check:
-
-                    body = reply.body.split()
-                    if len(body) < 4:
-                        comment = self.r.comment(reply.id)
-                        submission = comment.submission
-                        unflaired_submission = None
-
-                        for unflaired_submission_instance in self.unflaired_submissions:
-                            try:
-                                if unflaired_submission_instance.submission == submission.id or\
-                                    unflaired_submission_instance.submission.id == submission.id or\
-                                        unflaired_submission_instance.comment.id == comment.id:
-                                    unflaired_submission = unflaired_submission_instance
-                                    break
-                            except AttributeError:
-                                continue
-
-                        if unflaired_submission is None:
-                            reply.mark_read()
-                            continue
-
-                        for word in body:
-                            word = word.lower()
-                            word = word.strip("'")
-                            word = word.strip('"')
-
-                            for tup in self.flairs:
-
-                                try:
-                                    if word == tup[0].lower() and comment.author.name == submission.author.name:
-                                        submission.flair.select(tup[1], tup[0])
-                                        self.sub_mod.remove(comment)
-                                        unflaired_submission.approve()
-                                        self.unflaired_submissions.remove(unflaired_submission)
-
-                                except AttributeError:
-                                    self.unflaired_submissions.remove(unflaired_submission)
+                    self._check_reply(reply)
                     reply.mark_read()
 
-        for unflaired_submission in self.unflaired_submissions:
-            is_flaired = False
+        self._refresh_tracked(force_approve)
 
-            try:
-                is_flaired = unflaired_submission.check_if_flaired()
-            except AttributeError:
-                self.unflaired_submissions.remove(unflaired_submission)
+    def _refresh_tracked(self, force_approve=False):
+        """
+        Stop tracking the unflaired submissions that are over time, re-fetch the others with /api/info, 100 per
+        request, then approve those that have been flaired and stop tracking those that no longer exist
 
-            if is_flaired or force_approve:
-                unflaired_submission.approve()
-                self.unflaired_submissions.remove(unflaired_submission)
-            else:
-                deleted = unflaired_submission.delete_if_overtime()
-                if deleted:
-                    self.unflaired_submissions.remove(unflaired_submission)
+        :param force_approve: Approve all tracked submissions. For debugging purposes.
+        """
+        for unflaired_submission in list(self.unflaired_submissions.values()):
+            if not force_approve and unflaired_submission.delete_if_overtime():
+                self._untrack(unflaired_submission)
+
+        for chunk in chunks(list(self.unflaired_submissions.values()), 100):
+            by_fullname = dict(('t3_' + unflaired_submission.submission_id, unflaired_submission)
+                               for unflaired_submission in chunk)
+
+            for submission in self.r.info(list(by_fullname)):
+                unflaired_submission = by_fullname.pop(submission.fullname, None)
+                if unflaired_submission is None:
+                    continue
+                unflaired_submission.submission = submission
+                if unflaired_submission.created_utc is None:
+                    unflaired_submission.created_utc = submission.created_utc
+                    writer.submit(save_created_utc, submission.id, submission.created_utc)
+
+                if unflaired_submission.check_if_flaired() or force_approve:
+                    unflaired_submission.approve()
+                    self._untrack(unflaired_submission)
+                elif unflaired_submission.delete_if_overtime():
+                    self._untrack(unflaired_submission)
+
+            for unflaired_submission in by_fullname.values():
+                writer.submit(delete_unflaired_submission, unflaired_submission.submission_id)
+                self._untrack(unflaired_submission)
+
+    def _check_pending(self):
+        """
+        Re-fetch the unflaired submissions whose grace period is over and remove those still lacking a flair
+        Submissions are only seen once in the listings, so the ones still within their grace period are kept here and
+        in the database, to survive restarts
+        """
+        now = time.time()
+        due = [submission_id for submission_id, created_utc in self.pending_submissions.items()
+               if now - created_utc > self.grace_period]
+        if not due:
+            return
+
+        for submission_id in due:
+            del self.pending_submissions[submission_id]
+        writer.submit(delete_pending_submissions, due)
+
+        for chunk in chunks(due, 100):
+            for submission in self.r.info(['t3_' + submission_id for submission_id in chunk]):
+                if submission.link_flair_text is None:
+                    self.add_submission(submission)
 
     def add_submission(self, submission, force=False):
         """
         Removes an unflaired submission if the time elapsed since its creation is longer than grace_period
+        Otherwise keeps it pending until check_submissions finds its grace period is over
 
         :param submission: instance of praw.models.Submission
         :param force: remove submission regardless of grace period
@@ -128,20 +226,48 @@ class FlairEnforcer:
             unflaired_submission_obj = UnflairedSubmission(self.r, submission, self.sub_object, self.flairs,
                                                            comments_flairing=self.comments_flairing)
             comment = unflaired_submission_obj.remove_and_comment()
-            self.unflaired_submissions.append(unflaired_submission_obj)
+            self._track(unflaired_submission_obj)
             return unflaired_submission_obj, comment
 
+        if submission.id not in self.pending_submissions:
+            self.pending_submissions[submission.id] = submission.created_utc
+            writer.submit(save_pending_submission, submission.id, self.subreddit, submission.created_utc)
+
+
+def save_pending_submission(submission_id, subreddit, created_utc):
+    PendingSubmissionModel.insert(submission_id=submission_id, subreddit=subreddit, created_utc=created_utc).\
+        on_conflict('IGNORE').execute()
+
+
+def delete_pending_submissions(submission_ids):
+    for chunk in chunks(submission_ids, SQLITE_MAX_VARIABLES):
+        PendingSubmissionModel.delete().where(PendingSubmissionModel.submission_id << chunk).execute()
+
+
+def delete_unflaired_submission(submission_id):
+    UnflairedSubmissionModel.delete().where(UnflairedSubmissionModel.submission_id == submission_id).execute()
+
+
+def save_created_utc(submission_id, created_utc):
+    UnflairedSubmissionModel.update(created_utc=created_utc).\
+        where(UnflairedSubmissionModel.submission_id == submission_id).execute()
+
 
 class UnflairedSubmission:
 
-    def __init__(self, r, submission, subreddit, flairs, comment=None, comments_flairing=True):
+    def __init__(self, r, submission, subreddit, flairs, comment=None, comments_flairing=True, created_utc=None,
+                 author=None):
         self.r = r
         self._submission = submission
+        self.created_utc = created_utc
+        if created_utc is None and not isinstance(submission, str):
+            self.created_utc = submission.created_utc
         self.sub = subreddit
         self.sub_mod = subreddit.mod
         self.comment = comment
         self.flairs = flairs
         self.comments_flairing = comments_flairing
+        self._author = author
 
         if comment is not None:
             self.comment = r.comment(comment)
@@ -163,8 +289,24 @@ class UnflairedSubmission:
     def submission(self, v):
         self._submission = v
 
+    @property
+    def submission_id(self):
+        if isinstance(self._submission, str):
+            return self._submission
+        return self._submission.id
+
+    @property
+    def author(self):
+        """
+        Name of the submission's author, stored with the submission so that rows loaded from the database don't need
+        fetching it, only rows saved before the author was stored fetch the submission
+        """
+        if self._author is None:
+            self._author = self.submission.author.name
+        return self._author
+
     def remove_and_comment(self):
-        s1 = self.submission.author.name
+        s1 = self.author
         s2 = 'https://www.reddit.com/message/compose/?to=/r/' + self.sub.display_name
 
         comment = generate_flair_comment(s1, s2, self.flairs, self.comments_flairing)
@@ -177,13 +319,14 @@ class UnflairedSubmission:
 
         self.sub_mod.distinguish(self.comment)
         self.sub_mod.remove(self.submission)
-        UnflairedSubmissionModel.create(submission_id=self.submission.id, comment_id=self.comment.id,
-                                        subreddit=self.submission.subreddit.display_name)
+        writer.submit(UnflairedSubmissionModel.create, submission_id=self.submission.id, comment_id=self.comment.id,
+                      subreddit=self.sub.display_name, created_utc=self.created_utc, author=self.author)
         return self.comment
 
     def check_if_flaired(self):
-        self.submission = self.r.submission(self.submission.id)
-
+        """
+        Whether the submission has a flair, as of the last time it was fetched
+        """
         if self.submission.link_flair_text is not None:
             return True
         return False
@@ -198,31 +341,49 @@ class UnflairedSubmission:
         except AttributeError:
             pass
 
-        try:
-            unflaired_submission = UnflairedSubmissionModel.\
-                get(UnflairedSubmissionModel.submission_id == self.submission.id)
-            unflaired_submission.delete_instance()
-        except:
-            pass
+        writer.submit(delete_unflaired_submission, self.submission.id)
 
     def delete_if_overtime(self):
-        delta_time = time.time() - self.submission.created_utc
+        """
+        Stop tracking the submission if it was posted too long ago, unknown ages count as not over time
+
+        :return: True if the submission is over time
+        """
+        if self.created_utc is None:
+            return False
+        delta_time = time.time() - self.created_utc
 
         try:
             if delta_time >= 13600:
                 self.sub_mod.remove(self.comment)
-                unflaired_submission = UnflairedSubmissionModel.get(
-                    UnflairedSubmissionModel.submission_id == self.submission.id)
-                unflaired_submission.delete_instance()
+                writer.submit(delete_unflaired_submission, self.submission.id)
                 return True
             else:
                 return False
-        except (AttributeError, UnflairedSubmissionModel.DoesNotExist, DoesNotExist):
+        except AttributeError:
             return False
 
 
+AUTHOR_PLACEHOLDER = '\x00author\x00'
+
+
 def generate_flair_comment(s1, s2, flairs, comments_flairing=True):
+    """
+    Generate the flair-your-post comment, the text for a given list of flairs is only built once
+
+    :param s1: name of the submission's author
+    :param s2: link to message the moderators
+    :param flairs: list of (flair text, flair template id) tuples
+    :param comments_flairing: whether users can flair by replying to the comment
+    :return: comment text
+    """
+    comment = _flair_comment_template(s2, tuple(tuple(flair) for flair in flairs), comments_flairing)
+    return comment.replace(AUTHOR_PLACEHOLDER, s1)
+
 
+@functools.lru_cache(maxsize=128)
+def _flair_comment_template(s2, flairs, comments_flairing):
+    s1 = AUTHOR_PLACEHOLDER
     s3 = flairs[0][0]
     if comments_flairing:
         comment = ("""**Please read this message in its entirety before contacting the moderators.**
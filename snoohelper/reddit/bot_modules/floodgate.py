@@ -1,62 +1,161 @@
-from collections import Counter
-from wordcloud import STOPWORDS
-from textblob import TextBlob
-
-
-def intersect(lists):
-    ret_set = set(lists[0])
-
-    for index, element in enumerate(lists):
-        if index > 0:
-            ret_set = ret_set & set(element)
-
-    ret_list = list(ret_set)
-    return ret_list, Counter(ret_list)
+import itertools
+import random
+import zlib
+from collections import deque
+from snoohelper.utils.text import STOPWORDS, TOKENIZERS
+
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+class MinHashLSH:
+    """
+    MinHash signatures of sets of terms, indexed in LSH buckets so that similar sets can be found without comparing
+    against every stored set. With b bands of r rows, two sets of Jaccard similarity s share a bucket with probability
+    1 - (1 - s^r)^b
+    """
+
+    def __init__(self, bands=16, rows=4, seed=1):
+        """
+        :param bands: number of bands the signature is split in
+        :param rows: number of signature values per band
+        :param seed: seed of the random hash permutations
+        """
+        rng = random.Random(seed)
+        self.bands = bands
+        self.rows = rows
+        self.permutations = [(rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+                             for _ in range(bands * rows)]
+        self.buckets = [dict() for _ in range(bands)]
+        self.band_keys = dict()
+
+    def signature(self, terms):
+        hashes = [zlib.crc32(term.encode('utf-8')) for term in terms]
+        return [min((a * h + b) % MERSENNE_PRIME for h in hashes) for a, b in self.permutations]
+
+    def insert(self, key, terms):
+        """
+        Index a set of terms and return the keys of the stored sets sharing a bucket with it
+
+        :param key: key identifying the set
+        :param terms: non-empty set of terms
+        :return: set of candidate keys
+        """
+        signature = self.signature(terms)
+        band_keys = [tuple(signature[i * self.rows:(i + 1) * self.rows]) for i in range(self.bands)]
+
+        candidates = set()
+        for buckets, band_key in zip(self.buckets, band_keys):
+            bucket = buckets.setdefault(band_key, set())
+            candidates.update(bucket)
+            bucket.add(key)
+
+        self.band_keys[key] = band_keys
+        return candidates
+
+    def remove(self, key):
+        for buckets, band_key in zip(self.buckets, self.band_keys.pop(key, ())):
+            bucket = buckets[band_key]
+            bucket.discard(key)
+            if not bucket:
+                del buckets[band_key]
+
+
+def jaccard(a, b):
+    return len(a & b) / len(a | b)
 
 
 class Floodgate:
-
-    def __init__(self, max_delta_hours=5, most_common_threshold=5, faq_term_count_threshold=4):
-        self.titles_accumulator = list()
+    """
+    Finds clusters of near-duplicate titles posted within a window, e.g. a question that keeps being asked
+    Each incoming title is only compared with the titles sharing an LSH bucket with it and joins the cluster of the
+    most similar one, titles older than max_delta_hours leave their cluster as new ones come in
+    """
+
+    def __init__(self, max_delta_hours=5, most_common_threshold=5, faq_term_count_threshold=4,
+                 similarity_threshold=0.5, tokenizer='builtin'):
+        """
+        :param max_delta_hours: length of the window, in hours
+        :param most_common_threshold: maximum number of clusters returned by a check
+        :param faq_term_count_threshold: number of titles of the window a cluster must have to be returned
+        :param similarity_threshold: minimum Jaccard similarity of the terms of two titles of the same cluster
+        :param tokenizer: 'builtin' for the regex tokenizer, 'textblob' to split titles with TextBlob
+        """
+        self.tokenize = TOKENIZERS[tokenizer]
+        self.titles_accumulator = deque()
+        self.entries = dict()
+        self.clusters = dict()
+        self.touched_clusters = set()
+        self.surfaced_clusters = set()
+        self.lsh = MinHashLSH()
+        self.newest_timestamp = 0
         self.max_delta_hours = max_delta_hours
         self.most_common_threshold = most_common_threshold
         self.faq_term_count_threshold = faq_term_count_threshold
+        self.similarity_threshold = similarity_threshold
+        self._ids = itertools.count()
+
+    def _evict(self):
+        cutoff = self.newest_timestamp - self.max_delta_hours * 3600
+        while self.titles_accumulator and self.entries[self.titles_accumulator[0]][1] < cutoff:
+            entry_id = self.titles_accumulator.popleft()
+            _, _, _, cluster_id = self.entries.pop(entry_id)
+            self.lsh.remove(entry_id)
+
+            cluster = self.clusters[cluster_id]
+            cluster.discard(entry_id)
+            if not cluster:
+                del self.clusters[cluster_id]
+                self.touched_clusters.discard(cluster_id)
+                self.surfaced_clusters.discard(cluster_id)
 
     def accumulate_title(self, title, created_timestamp):
-        title_words = TextBlob(title).words
-        t = (title_words, created_timestamp)
-        self.titles_accumulator.append(t)
-        return t
-
-    def check_all(self):
-
-        delta_hours = 0
-        i = 0
-        titles_to_intersect = list()
-        faq_terms = list()
-        titles_acc_len = len(self.titles_accumulator)
-
-        if titles_acc_len < 3:
+        terms = frozenset(word for word in self.tokenize(title) if word not in STOPWORDS)
+        if not terms:
             return None
 
-        while delta_hours <= self.max_delta_hours and i < titles_acc_len:
-            delta_hours = (self.titles_accumulator[i][1] - self.titles_accumulator[i+1][1]) / 3600
-            titles_to_intersect.append(self.titles_accumulator[i])
-            i += 1
-
-        results_list, results_counter = intersect(titles_to_intersect)
-        most_common_terms = results_counter.most_common(self.most_common_threshold)
-
-        for tup in most_common_terms:
-            if tup[1] >= self.faq_term_count_threshold:
-                faq_terms.append(tup[0])
-
-        print(str(self.titles_accumulator))
-        print(str(results_counter))
+        entry_id = next(self._ids)
+        cluster_id = entry_id
+        best_similarity = self.similarity_threshold
+        for candidate in self.lsh.insert(entry_id, terms):
+            candidate_terms, _, _, candidate_cluster = self.entries[candidate]
+            similarity = jaccard(terms, candidate_terms)
+            if similarity >= best_similarity:
+                best_similarity = similarity
+                cluster_id = candidate_cluster
+
+        t = (terms, created_timestamp, title, cluster_id)
+        self.entries[entry_id] = t
+        self.clusters.setdefault(cluster_id, set()).add(entry_id)
+        self.touched_clusters.add(cluster_id)
+
+        # Titles mostly come in order, walk back from the end for the few that don't
+        index = len(self.titles_accumulator)
+        while index > 0 and self.entries[self.titles_accumulator[index - 1]][1] > created_timestamp:
+            index -= 1
+        self.titles_accumulator.insert(index, entry_id)
+
+        self.newest_timestamp = max(self.newest_timestamp, created_timestamp)
+        self._evict()
+        return t
 
-        if faq_terms:
-            print(str(faq_terms))
-            return faq_terms
+    def check_all(self):
+        """
+        :return: list of the clusters that reached faq_term_count_threshold titles since the last check, largest
+        first, each a list of titles newest first, None if there are none
+        """
+        flooded = [cluster_id for cluster_id in self.touched_clusters
+                   if cluster_id not in self.surfaced_clusters and
+                   len(self.clusters[cluster_id]) >= self.faq_term_count_threshold]
+        self.touched_clusters = set()
+        self.surfaced_clusters.update(flooded)
+
+        flooded.sort(key=lambda cluster_id: len(self.clusters[cluster_id]), reverse=True)
+        results = list()
+        for cluster_id in flooded[:self.most_common_threshold]:
+            entries = sorted((self.entries[entry_id] for entry_id in self.clusters[cluster_id]),
+                             key=lambda entry: entry[1], reverse=True)
+            results.append([title for _, _, title, _ in entries])
+
+        if results:
+            return results
         return None
-
-
@@ -4,16 +4,16 @@ import os
 
 import matplotlib.pyplot as plt
 import numpy as np
-import praw
 import prawcore.exceptions
 from imgurpython import ImgurClient
 from retrying import retry
 from wordcloud import WordCloud, STOPWORDS
 import imgurpython.helpers.error
-from snoohelper.database.models import UserModel
+from snoohelper.database.cache import users
 from snoohelper.utils import credentials
 import snoohelper.utils as utils
 import snoohelper.utils.slack
+from snoohelper.reddit.scheduler import create_reddit
 
 REDDIT_APP_ID = credentials.get_token("REDDIT_APP_ID", "credentials")
 REDDIT_APP_SECRET = credentials.get_token("REDDIT_APP_SECRET", "credentials")
@@ -34,9 +34,9 @@ class SummaryGenerator:
         self.refresh_token = refresh_token
         self.spamcruncher = spamcruncher
         self.botbans = botbans
-        self.r = praw.Reddit(user_agent="Snoohelper 0.1 by /u/Santi871",
-                                 client_id=REDDIT_APP_ID, client_secret=REDDIT_APP_SECRET,
-                                 refresh_token=self.refresh_token)
+        self.r = create_reddit(self.subreddit, user_agent="Snoohelper 0.1 by /u/Santi871",
+                               client_id=REDDIT_APP_ID, client_secret=REDDIT_APP_SECRET,
+                               refresh_token=self.refresh_token)
 
     @retry(stop_max_attempt_number=2)
     def generate_quick_summary(self, username):
@@ -52,7 +52,7 @@ class SummaryGenerator:
                                     title="Error: user not found.", color='danger')
             return response
 
-        user_track, _ = UserModel.get_or_create(username=username.lower(), subreddit=self.subreddit)
+        user_track = users.get_or_create(username, self.subreddit)
 
         combined_karma = user.link_karma + user.comment_karma
         account_creation = str(datetime.datetime.fromtimestamp(user.created_utc))
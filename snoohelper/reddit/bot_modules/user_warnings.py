@@ -1,7 +1,7 @@
 import time
 
 import snoohelper.utils.slack as utils
-from snoohelper.database.models import UserModel
+from snoohelper.database.cache import users
 
 
 class UserWarnings:
@@ -20,7 +20,7 @@ class UserWarnings:
         attachment = None
 
         if isinstance(user, str):
-            user, _ = UserModel.get_or_create(username=user.lower(), subreddit=self.subreddit)
+            user = users.get_or_create(user, self.subreddit)
             if user.warnings_muted:
                 return
 
@@ -69,11 +69,11 @@ class UserWarnings:
             attachment.add_button("Mute user's warnings", value="mutewarnings_" + user.username, style='danger')
 
             user.last_warned = time.time()
-            user.save()
+            users.save(user)
             self.webhook.send_message(message)
 
     def check_user_posts(self, thing):
-        user, _ = UserModel.get_or_create(username=thing.author.name.lower(), subreddit=thing.subreddit.display_name)
+        user = users.get_or_create(thing.author.name, self.subreddit)
 
         if user.tracked:
             message = utils.SlackResponse("New post by user /u/" + user.username)
@@ -94,7 +94,7 @@ class UserWarnings:
             self.webhook.send_message(message)
 
     def send_warning(self, thing):
-        user, _ = UserModel.get_or_create(username=thing.author.name.lower(), subreddit=thing.subreddit.display_name)
+        user = users.get_or_create(thing.author.name, self.subreddit)
         message = utils.SlackResponse("New post by user /u/" + user.username)
 
         try:
@@ -126,12 +126,12 @@ class UserWarnings:
 
     @staticmethod
     def mute_user_warnings(user, subreddit):
-        user = UserModel.get(UserModel.username == user.lower() and UserModel.subreddit == subreddit)
+        user = users.get_or_create(user, subreddit)
         user.warnings_muted = True
-        user.save()
+        users.save(user)
 
     @staticmethod
     def unmute_user_warnings(user, subreddit):
-        user = UserModel.get(UserModel.username == user.lower() and UserModel.subreddit == subreddit)
+        user = users.get_or_create(user, subreddit)
         user.warnings_muted = False
-        user.save()
+        users.save(user)
@@ -0,0 +1,221 @@
+import functools
+import time
+from threading import Lock
+
+import prawcore.exceptions
+
+from snoohelper.utils.reddit import AdaptivePollInterval, get_fullname, get_subreddit_name, MODLOG_ACTIONS
+
+LISTINGS = {'submissions': lambda subreddit: subreddit.new,
+            'comments': lambda subreddit: subreddit.comments}
+for _action in MODLOG_ACTIONS:
+    LISTINGS['modlog:' + _action] = lambda subreddit, action=_action: functools.partial(subreddit.mod.log,
+                                                                                        action=action)
+
+
+class ListingGroup:
+    """
+    Bots of teams that log in to Reddit with the same account. Their listings are polled once for all of them as the
+    multireddit r/a+b+c and the items are handed out to each team by subreddit, so a cycle costs one request per
+    listing instead of one per team
+    Each member keeps its own watermark, the group pages through the multireddit until it has reached the newest
+    item of every member, so members joining or leaving don't reset the catch-up of the others
+    """
+
+    def __init__(self, max_buffer=1000, max_backfill=1000):
+        """
+        :param max_buffer: maximum number of undelivered items kept per team and listing
+        :param max_backfill: maximum number of items fetched from the multireddit in one poll while catching up
+        """
+        self.max_buffer = max_buffer
+        self.max_backfill = max_backfill
+        self.members = dict()
+        self.buffers = dict()
+        self.delivered = dict()
+        self.poll_intervals = dict((listing, AdaptivePollInterval()) for listing in LISTINGS)
+        self.next_polls = dict()
+        self.polling = set()
+        self._lock = Lock()
+
+    @property
+    def multireddit(self):
+        return '+'.join(sorted(self.members))
+
+    def is_shared(self):
+        return len(self.members) > 1
+
+    def add(self, bot):
+        with self._lock:
+            self.members[bot.subreddit_name.lower()] = bot
+
+    def remove(self, bot):
+        """
+        Remove a member and drop what was buffered for it. Once the group is no longer shared its last member polls
+        on its own again from its own watermark, so everything buffered for it is dropped too
+
+        :param bot: instance of SnooHelperBot
+        """
+        key = bot.subreddit_name.lower()
+        with self._lock:
+            self.members.pop(key, None)
+            for member_key, listing in list(self.buffers) + list(self.delivered):
+                if member_key == key or not self.is_shared():
+                    self.buffers.pop((member_key, listing), None)
+                    self.delivered.pop((member_key, listing), None)
+
+    def next_poll(self, listing):
+        """
+        :param listing: name of the listing, e.g. 'submissions'
+        :return: time at which the group polls the listing again
+        """
+        return self.next_polls.get(listing, 0)
+
+    def _marker(self, key, listing):
+        """
+        :return: (fullname, created_utc) of the newest item of a member that was processed or handed out to it,
+                 (None, None) if there is none yet
+        """
+        watermark = self.members[key].watermarks[listing]
+        marker = self.delivered.get((key, listing), (None, None))
+        if watermark.thing_id is not None and (marker[1] is None or watermark.created > marker[1]):
+            marker = (watermark.thing_id, watermark.created)
+        return marker
+
+    def _collect(self, generator, markers, pending, found, limit, until_reached=False):
+        """
+        Sort the items of a multireddit listing by member, skipping those each member has already seen
+
+        :param generator: praw listing generator, newest first
+        :param markers: dict of member key to its marker, see _marker()
+        :param pending: set of the keys of the members that haven't reached their marker yet, updated in place
+        :param found: dict of member key to list of new items, updated in place
+        :param limit: maximum number of items to read
+        :param until_reached: stop reading as soon as every member has reached its marker
+        :return: tuple of number of items read and the last item read, None if there was none
+        """
+        count = 0
+        last = None
+        for item in generator:
+            count += 1
+            last = item
+            key = get_subreddit_name(item).lower()
+            if key in markers:
+                thing_id, created = markers[key]
+                if thing_id is None:
+                    found[key].append(item)
+                elif key in pending:
+                    if get_fullname(item) == thing_id or item.created_utc < created:
+                        pending.discard(key)
+                    else:
+                        found[key].append(item)
+            if count >= limit or (until_reached and not pending):
+                break
+        return count, last
+
+    def _poll(self, bot, listing):
+        fallback = float(getattr(bot.config, 'sleep', 20))
+        poll_interval = self.poll_intervals[listing]
+
+        with self._lock:
+            multireddit = self.multireddit
+            markers = dict((key, self._marker(key, listing)) for key in self.members)
+
+        pending = set(key for key, marker in markers.items() if marker[0] is not None)
+        found = dict((key, list()) for key in markers)
+        listing_func = LISTINGS[listing](bot.thread_r.subreddit(multireddit))
+
+        page_size = min(poll_interval.page_size(fallback), self.max_backfill)
+        count, last = self._collect(listing_func(limit=page_size), markers, pending, found, page_size)
+        if pending and count == page_size and count < self.max_backfill:
+            generator = listing_func(limit=self.max_backfill - count, params={'after': get_fullname(last)})
+            self._collect(generator, markers, pending, found, self.max_backfill - count, until_reached=True)
+
+        with self._lock:
+            for key, member_items in found.items():
+                if key not in self.members:
+                    continue
+                if markers[key][0] is None:
+                    member_items = member_items[:self.members[key].watermarks[listing].initial_limit]
+                if member_items:
+                    buffered = self.buffers.get((key, listing), list())
+                    self.buffers[(key, listing)] = (member_items + buffered)[:self.max_buffer]
+                    self.delivered[(key, listing)] = (get_fullname(member_items[0]), member_items[0].created_utc)
+
+        items = sorted((item for member_items in found.values() for item in member_items),
+                       key=lambda item: item.created_utc, reverse=True)
+        poll_interval.record(items)
+        self.next_polls[listing] = time.time() + poll_interval.interval(fallback)
+
+    def fetch(self, bot, listing):
+        """
+        Get the new items of a listing for a team, polling Reddit for the whole group if the listing is due
+        Only one member polls a listing at a time and the request is made without holding the lock, the other
+        members get whatever is already buffered for them meanwhile
+
+        :param bot: instance of SnooHelperBot, member of the group
+        :param listing: name of the listing, e.g. 'submissions'
+        :return: list of items of the bot's subreddit, newest first
+        """
+        with self._lock:
+            due = time.time() >= self.next_poll(listing) and listing not in self.polling
+            if due:
+                self.polling.add(listing)
+
+        if due:
+            try:
+                self._poll(bot, listing)
+            finally:
+                with self._lock:
+                    self.polling.discard(listing)
+
+        with self._lock:
+            return self.buffers.pop((bot.subreddit_name.lower(), listing), list())
+
+
+class ListingGroups:
+    """
+    Groups bots by the Reddit account they log in with. Teams without a refresh token, or whose account can't be
+    looked up, are never grouped
+    """
+
+    def __init__(self):
+        self.groups = dict()
+        self._lock = Lock()
+
+    def join(self, bot):
+        """
+        Add a bot to the group of its Reddit account
+
+        :param bot: instance of SnooHelperBot
+        :return: ListingGroup instance, None if the team isn't grouped
+        """
+        if not bot.config.reddit_refresh_token:
+            return None
+
+        try:
+            account = bot.thread_r.user.me().name.lower()
+        except (prawcore.exceptions.PrawcoreException, AttributeError):
+            print("Could not look up the Reddit account of /r/" + bot.subreddit_name + ", polling it on its own")
+            return None
+
+        with self._lock:
+            group = self.groups.setdefault(account, ListingGroup())
+        group.add(bot)
+        bot.listing_group = group
+        return group
+
+    def leave(self, bot):
+        """
+        Remove a bot from its group
+
+        :param bot: instance of SnooHelperBot
+        """
+        group = bot.listing_group
+        if group is None:
+            return
+
+        group.remove(bot)
+        bot.listing_group = None
+        with self._lock:
+            if not group.members:
+                self.groups = dict((account, other) for account, other in self.groups.items() if other is not group)
@@ -0,0 +1,93 @@
+import asyncio
+import atexit
+import concurrent.futures
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+
+class AsyncBotRuntime:
+    """
+    Schedules the polling cycle of every bot from a single event loop, instead of keeping one thread per team
+    This is not an asyncio rewrite of the bots: praw is blocking, so init_modules() and each whole run_cycle() run on
+    a thread pool shared by all teams, and the event loop only waits between cycles. A cycle occupies a worker for
+    as long as its Reddit requests take, so the pool size bounds the number of teams polling at the same time and
+    the cycles of further teams queue up behind them
+    """
+
+    def __init__(self, max_concurrency=8):
+        """
+        :param max_concurrency: number of worker threads, the maximum number of bots polling Reddit at the same time
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.loop = asyncio.new_event_loop()
+        self.tasks = dict()
+        self.stopped = False
+
+        self.thread = Thread(target=self._run_loop, daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def add_bot(self, bot):
+        """
+        Start running a bot on the event loop, the bot must have been constructed with start=False
+
+        :param bot: instance of SnooHelperBot
+        :return: concurrent.futures.Future of the bot's coroutine
+        """
+        if self.stopped:
+            raise RuntimeError("AsyncBotRuntime is stopped")
+
+        future = asyncio.run_coroutine_threadsafe(self._run_bot(bot), self.loop)
+        self.tasks[bot] = future
+        return future
+
+    def stop(self, timeout=None):
+        """
+        Halt every bot, wait for their current cycle to end, then stop the event loop and shut down the thread pool
+
+        :param timeout: seconds to wait for the bots and the loop thread, None to wait forever
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+
+        tasks = list(self.tasks.items())
+        for bot, _ in tasks:
+            bot.halt = True
+        concurrent.futures.wait([future for _, future in tasks], timeout)
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+        if not self.thread.is_alive():
+            self.loop.close()
+        self.executor.shutdown(wait=False)
+
+    def _wake(self, halted):
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(halted.set)
+
+    async def _call(self, func):
+        return await self.loop.run_in_executor(self.executor, func)
+
+    async def _run_bot(self, bot):
+        halted = asyncio.Event()
+        bot.add_halt_callback(lambda: self._wake(halted))
+
+        try:
+            await self._call(bot.init_modules)
+
+            while not bot.halt:
+                delay = await self._call(bot.run_cycle)
+                try:
+                    await asyncio.wait_for(halted.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            self.tasks.pop(bot, None)
@@ -0,0 +1,187 @@
+import functools
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from threading import Condition, local
+
+import praw
+import prawcore
+
+LANE_INTERACTIVE = 0
+LANE_MODERATION = 1
+LANE_BACKGROUND = 2
+LANE_NAMES = ('interactive', 'moderation', 'background')
+
+_thread_lane = local()
+
+
+class RequestScheduler:
+    """
+    Token bucket shared by every Reddit client of the process, all of them using the same OAuth application
+    The bucket is resized from the X-Ratelimit-* headers of each response. When tokens run short, waiting requests are
+    granted by priority lane first (interactive, then moderation, then background) and round-robin between teams
+    within a lane
+    """
+
+    def __init__(self, capacity=600, period=600):
+        """
+        :param capacity: requests allowed per period until Reddit tells us otherwise
+        :param period: length in seconds of Reddit's rate limit window
+        """
+        self.capacity = capacity
+        self.period = period
+        self.remaining = capacity
+        self.reset_at = time.time() + period
+        self._cond = Condition()
+        self._lanes = [OrderedDict() for _ in LANE_NAMES]
+        self._stats = [{'granted': 0, 'total_wait': 0.0, 'max_wait': 0.0} for _ in LANE_NAMES]
+
+    def _refill(self):
+        now = time.time()
+        if now >= self.reset_at:
+            self.remaining = self.capacity
+            self.reset_at = now + self.period
+
+    def _next_ticket(self):
+        for lane in self._lanes:
+            for team, tickets in lane.items():
+                return lane, team, tickets[0]
+        return None, None, None
+
+    def acquire(self, lane, team):
+        """
+        Block until a request of a team may be sent
+
+        :param lane: one of LANE_INTERACTIVE, LANE_MODERATION, LANE_BACKGROUND
+        :param team: key identifying the team making the request, for fair sharing
+        """
+        ticket = object()
+        start = time.time()
+
+        with self._cond:
+            self._lanes[lane].setdefault(team, deque()).append(ticket)
+
+            while True:
+                self._refill()
+                queue, next_team, next_ticket = self._next_ticket()
+                if next_ticket is ticket and self.remaining >= 1:
+                    break
+                self._cond.wait(max(0.05, min(1.0, self.reset_at - time.time())))
+
+            queue[team].popleft()
+            if queue[team]:
+                queue.move_to_end(team)
+            else:
+                del queue[team]
+            self.remaining -= 1
+
+            waited = time.time() - start
+            stats = self._stats[lane]
+            stats['granted'] += 1
+            stats['total_wait'] += waited
+            stats['max_wait'] = max(stats['max_wait'], waited)
+            self._cond.notify_all()
+
+    def update(self, headers):
+        """
+        Resize the bucket from the rate limit headers of a Reddit response
+
+        :param headers: response headers
+        """
+        try:
+            remaining = float(headers['x-ratelimit-remaining'])
+            reset = float(headers['x-ratelimit-reset'])
+            used = float(headers.get('x-ratelimit-used', 0))
+        except (KeyError, TypeError, ValueError):
+            return
+
+        with self._cond:
+            self.capacity = max(self.capacity, int(remaining + used))
+            self.remaining = remaining
+            self.reset_at = time.time() + reset
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """
+        :return: dict with the remaining budget and, per lane, queue depth and wait times in seconds
+        """
+        with self._cond:
+            lanes = dict()
+            for name, lane, stats in zip(LANE_NAMES, self._lanes, self._stats):
+                granted = stats['granted']
+                lanes[name] = {'queued': sum(len(tickets) for tickets in lane.values()),
+                               'granted': granted,
+                               'avg_wait': stats['total_wait'] / granted if granted else 0.0,
+                               'max_wait': stats['max_wait']}
+            return {'remaining': self.remaining, 'reset_in': max(0.0, self.reset_at - time.time()), 'lanes': lanes}
+
+
+scheduler = RequestScheduler()
+
+
+class ScheduledRequestor(prawcore.Requestor):
+    """
+    prawcore Requestor that waits for the shared RequestScheduler before every request
+    GET requests go in the background lane and the rest in the moderation lane, unless the calling thread is in
+    an interactive() block
+    """
+
+    def __init__(self, *args, team=None, request_scheduler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.team = team
+        self.request_scheduler = request_scheduler if request_scheduler is not None else scheduler
+
+    def request(self, method, url, *args, **kwargs):
+        lane = current_lane()
+        if lane is None:
+            lane = LANE_BACKGROUND if method.upper() == 'GET' else LANE_MODERATION
+
+        self.request_scheduler.acquire(lane, self.team)
+        response = super().request(method, url, *args, **kwargs)
+        self.request_scheduler.update(response.headers)
+        return response
+
+
+def create_reddit(team, **kwargs):
+    """
+    Construct a praw.Reddit instance whose requests go through the shared RequestScheduler
+
+    :param team: key identifying the team the instance belongs to, e.g. its subreddit name
+    :param kwargs: keyword arguments for praw.Reddit
+    :return: instance of praw.Reddit
+    """
+    return praw.Reddit(requestor_class=ScheduledRequestor, requestor_kwargs={'team': team}, **kwargs)
+
+
+def current_lane():
+    return getattr(_thread_lane, 'lane', None)
+
+
+@contextmanager
+def use_lane(lane):
+    """
+    Context manager that puts the Reddit requests made by this thread in a lane
+
+    :param lane: one of LANE_INTERACTIVE, LANE_MODERATION, LANE_BACKGROUND
+    """
+    previous = current_lane()
+    _thread_lane.lane = lane
+    try:
+        yield
+    finally:
+        _thread_lane.lane = previous
+
+
+def interactive(func):
+    """
+    Decorator for functions answering Slack requests, their Reddit requests go before moderation and background ones
+
+    :param func: function
+    :return: wrapped function
+    """
+    @functools.wraps(func)
+    def wrapped_f(*args, **kwargs):
+        with use_lane(LANE_INTERACTIVE):
+            return func(*args, **kwargs)
+
+    return wrapped_f
@@ -1,16 +1,68 @@
+import math
 import time
+from collections import OrderedDict
+from threading import Thread
 
-from peewee import OperationalError, InterfaceError
+from peewee import OperationalError, InterfaceError, IntegrityError
 from puni import Note
 from retrying import retry
 
-from snoohelper.database.models import AlreadyDoneModel
+from snoohelper.database.models import AlreadyDoneModel, WatermarkModel
+import snoohelper.database.writer as writer
+from snoohelper.database.connection import shard_keys, use_shard
+
+SQLITE_MAX_VARIABLES = 999
+MODLOG_ACTIONS = ('removecomment', 'removelink', 'approvelink', 'approvecomment', 'banuser', 'unbanuser')
 
 
 def clamp(min_value, max_value, x):
     return max(min(x, max_value), min_value)
 
 
+def retry_if_database_busy(exc):
+    if isinstance(exc, (OperationalError, InterfaceError)):
+        print("Failed to write: " + str(exc))
+        return True
+    return False
+
+
+def chunks(seq, size):
+    """
+    Split a sequence into lists of at most size elements
+
+    :param seq: sequence to split
+    :param size: maximum chunk length
+    :return: generator of lists
+    """
+    seq = list(seq)
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def get_fullname(thing):
+    """
+    Fullname of a Reddit item as used by the 'after' listing parameter, modlog entries only have an id
+
+    :param thing: praw model instance
+    :return: fullname string
+    """
+    try:
+        return thing.fullname
+    except AttributeError:
+        return thing.id
+
+
+def get_subreddit_name(thing):
+    """
+    Display name of the subreddit of a Reddit item, modlog entries hold it as a plain string
+
+    :param thing: praw model instance
+    :return: subreddit display name
+    """
+    subreddit = thing.subreddit
+    return getattr(subreddit, 'display_name', subreddit)
+
+
 def calculate_sleep(subscribers):
     """
     Calculates SlackTeam.sleep based on the subscribers number
@@ -86,40 +138,361 @@ def get_scopes(form_data):
     return scopes, form_data
 
 
+def _insert_already_done(rows):
+    for chunk in chunks(rows, SQLITE_MAX_VARIABLES // 3):
+        AlreadyDoneModel.insert_many(chunk).on_conflict('IGNORE').execute()
+
+
+def _delete_expired(subreddit, cutoff, chunk_size):
+    expired = AlreadyDoneModel.select(AlreadyDoneModel.id).\
+        where(AlreadyDoneModel.subreddit == subreddit, AlreadyDoneModel.timestamp < cutoff).limit(chunk_size)
+    return AlreadyDoneModel.delete().where(AlreadyDoneModel.id << expired).execute()
+
+
+def _save_watermark(subreddit, listing, thing_id, created):
+    query = WatermarkModel.update(thing_id=thing_id, created=created).\
+        where(WatermarkModel.subreddit == subreddit, WatermarkModel.listing == listing)
+    if not query.execute():
+        WatermarkModel.create(subreddit=subreddit, listing=listing, thing_id=thing_id, created=created)
+
+
 class AlreadyDoneHelper:
     """
     Utility class for easy management of Reddit items or posts that have already been checked
+
+    Keeps a bounded in-memory seen-set per subreddit in front of AlreadyDoneModel, so that steady-state polling answers
+    "seen?" from memory and only writes ids that are actually new
     """
     @retry(stop_max_attempt_number=6, wait_fixed=3000)
-    def __init__(self, logger=None):
+    def __init__(self, subreddit=None, max_size=20000, max_age=604800):
         """
-        Construct AlreadyDoneHelper. Cleans up id's older than a week
+        Construct AlreadyDoneHelper and warm the seen-set from the database
+        Expired ids are cleaned up by AlreadyDonePruner
 
-        :param logger: logging.Logger instance
+        :param subreddit: subreddit display name to warm the seen-set for, None to skip warming
+        :param max_size: maximum number of ids remembered per subreddit
+        :param max_age: seconds an id is remembered for, matches the database retention
         """
-        query = AlreadyDoneModel.delete().where((time.time() - AlreadyDoneModel.timestamp) > 604800)
-        num = query.execute()
+        self.max_size = max_size
+        self.max_age = max_age
+        self._seen = dict()
 
-        if num:
-            if logger is not None:
-                logger.info("AlreadyDoneHelper: cleaned up %s ids." % str(num))
-            print("AlreadyDoneHelper: cleaned up %s ids." % str(num))
+        if subreddit is not None:
+            self.warm(subreddit)
+
+    def _get_seen(self, subreddit):
+        try:
+            return self._seen[subreddit]
+        except KeyError:
+            seen = OrderedDict()
+            self._seen[subreddit] = seen
+            return seen
 
-    @staticmethod
-    def add(thing_id, subreddit):
+    def _remember(self, thing_id, subreddit, timestamp):
+        seen = self._get_seen(subreddit)
+        seen[thing_id] = timestamp
+        seen.move_to_end(thing_id)
+
+        cutoff = time.time() - self.max_age
+        while seen:
+            oldest_id, oldest_ts = next(iter(seen.items()))
+            if len(seen) > self.max_size or oldest_ts < cutoff:
+                del seen[oldest_id]
+            else:
+                break
+
+    def warm(self, subreddit):
+        """
+        Load the ids already stored for a subreddit into the seen-set, newest last
+
+        :param subreddit: subreddit display name
+        """
+        query = AlreadyDoneModel.select(AlreadyDoneModel.thing_id, AlreadyDoneModel.timestamp).\
+            where(AlreadyDoneModel.subreddit == subreddit).\
+            order_by(AlreadyDoneModel.timestamp.desc()).limit(self.max_size)
+
+        for row in reversed(list(query)):
+            self._remember(row.thing_id, subreddit, row.timestamp.timestamp())
+
+    def is_done(self, thing_id, subreddit):
+        """
+        Whether an id has already been checked, answered from memory
+
+        :param thing_id: Reddit item/post id
+        :param subreddit: subreddit display name
+        :return: True if the id has been seen before
+        """
+        seen = self._get_seen(subreddit)
+        timestamp = seen.get(thing_id)
+        return timestamp is not None and time.time() - timestamp <= self.max_age
+
+    @retry(stop_max_attempt_number=5, wait_exponential_multiplier=500, wait_exponential_max=5000,
+           retry_on_exception=retry_if_database_busy)
+    def add_many(self, thing_ids, subreddit):
+        """
+        Look up a whole listing batch of ids at once and return the ones that were not seen before
+        The new ids are handed to the DatabaseWriter, which inserts them with INSERT OR IGNORE
+
+        :param thing_ids: iterable of Reddit item/post ids, e.g. the ids of one listing page
+        :param subreddit: subreddit display name
+        :return: list of the new ids, in the order they were given
+        """
+        candidates = list()
+        unique_ids = set()
+        for thing_id in thing_ids:
+            if thing_id not in unique_ids and not self.is_done(thing_id, subreddit):
+                candidates.append(thing_id)
+                unique_ids.add(thing_id)
+
+        if not candidates:
+            return list()
+
+        now = time.time()
+        new_ids = list()
+        for chunk in chunks(candidates, SQLITE_MAX_VARIABLES):
+            existing = set(row.thing_id for row in
+                           AlreadyDoneModel.select(AlreadyDoneModel.thing_id).
+                           where(AlreadyDoneModel.thing_id << chunk))
+            new_ids.extend(thing_id for thing_id in chunk if thing_id not in existing)
+
+        if new_ids:
+            rows = [{'thing_id': thing_id, 'timestamp': now, 'subreddit': subreddit} for thing_id in new_ids]
+            writer.submit(_insert_already_done, rows)
+
+        for thing_id in candidates:
+            self._remember(thing_id, subreddit, now)
+        return new_ids
+
+    def add(self, thing_id, subreddit):
         """
         Attempts to insert AlreadyDoneModel instance to database
-        Raises IntegrityError if the id already exists in database
+        Raises IntegrityError if the id has already been seen
 
         :param thing_id: Reddit item/post id
         :param subreddit: subreddit display name
         """
+        if not self.add_many([thing_id], subreddit):
+            raise IntegrityError("%s already done" % thing_id)
+
+
+class AlreadyDonePruner:
+    """
+    Periodically deletes AlreadyDoneModel rows older than the retention period on a background thread
+    Deletes in bounded chunks per subreddit so that the database write lock is never held for long
+    """
+    _instance = None
+
+    def __init__(self, interval=3600, max_age=604800, chunk_size=500, logger=None):
+        """
+        :param interval: seconds between prune runs
+        :param max_age: retention period in seconds
+        :param chunk_size: maximum number of rows deleted per statement
+        :param logger: logging.Logger instance
+        """
+        self.interval = interval
+        self.max_age = max_age
+        self.chunk_size = chunk_size
+        self.logger = logger
+        self.halt = False
+
+    @classmethod
+    def start(cls, **kwargs):
+        """
+        Start the process-wide pruner thread if it is not running yet
+
+        :return: AlreadyDonePruner instance
+        """
+        if cls._instance is None:
+            cls._instance = cls(**kwargs)
+            thread = Thread(target=cls._instance.run, daemon=True)
+            thread.start()
+        return cls._instance
+
+    def prune(self):
+        """
+        Delete expired rows, one chunk per DatabaseWriter operation
+
+        :return: tuple of number of rows deleted and seconds taken
+        """
+        start = time.time()
+        cutoff = start - self.max_age
+        num = 0
+
+        for shard in shard_keys():
+            with use_shard(shard):
+                subreddits = [row.subreddit for row in
+                              AlreadyDoneModel.select(AlreadyDoneModel.subreddit).distinct()]
+                for subreddit in subreddits:
+                    while True:
+                        deleted = writer.submit(_delete_expired, subreddit, cutoff, self.chunk_size).wait()
+                        num += deleted
+                        if deleted < self.chunk_size:
+                            break
+
+        elapsed = time.time() - start
+        if num:
+            message = "AlreadyDonePruner: cleaned up %s ids in %.2f seconds." % (str(num), elapsed)
+            if self.logger is not None:
+                self.logger.info(message)
+            print(message)
+        return num, elapsed
 
-        while True:
+    def run(self):
+        while not self.halt:
             try:
-                AlreadyDoneModel.create(thing_id=thing_id, timestamp=time.time(), subreddit=subreddit)
-                break
+                self.prune()
             except (OperationalError, InterfaceError):
-                print("Failed to write")
-                time.sleep(1)
+                print("AlreadyDonePruner: database busy, retrying next run")
+            time.sleep(self.interval)
+
+
+class AdaptivePollInterval:
+    """
+    Picks the poll interval and page size of a listing from the measured arrival rate of its items
+    Quiet listings are polled about as often as a new item is expected, busy ones often enough that a poll never
+    fills more than half a page, and both aim for target_latency when that doesn't waste requests
+    """
+    def __init__(self, target_latency=60, min_interval=15, max_interval=300, min_page=10, max_page=100,
+                 smoothing=0.3):
+        """
+        :param target_latency: desired seconds between an item being posted and the bot seeing it
+        :param min_interval: minimum seconds between polls
+        :param max_interval: maximum seconds between polls
+        :param min_page: minimum number of items requested per page
+        :param max_page: maximum number of items Reddit returns per page
+        :param smoothing: weight of the latest poll in the moving average of the arrival rate
+        """
+        self.target_latency = target_latency
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_page = min_page
+        self.max_page = max_page
+        self.smoothing = smoothing
+        self.rate = None
+        self.last_poll = None
+
+    def record(self, items, now=None):
+        """
+        Update the arrival rate with the new items found by a poll
+
+        :param items: new items found by the poll, newest first
+        :param now: time of the poll, defaults to now
+        """
+        if now is None:
+            now = time.time()
+
+        if self.last_poll is None:
+            if len(items) >= 2:
+                span = items[0].created_utc - items[-1].created_utc
+                if span > 0:
+                    self.rate = (len(items) - 1) / span
+        else:
+            elapsed = now - self.last_poll
+            if elapsed > 0:
+                observed = len(items) / elapsed
+                if self.rate is None:
+                    self.rate = observed
+                else:
+                    self.rate = self.smoothing * observed + (1 - self.smoothing) * self.rate
+        self.last_poll = now
+
+    def interval(self, fallback):
+        """
+        :param fallback: interval to use while there is no arrival rate yet, e.g. from calculate_sleep()
+        :return: seconds to wait before the next poll
+        """
+        if self.rate is None:
+            return fallback
+        if self.rate <= 0:
+            return self.max_interval
+
+        interval = min(max(self.target_latency, 1 / self.rate), self.max_interval)
+        interval = min(interval, self.max_page / 2 / self.rate)
+        return clamp(self.min_interval, self.max_interval, interval)
+
+    def page_size(self, fallback):
+        """
+        :param fallback: interval to use while there is no arrival rate yet
+        :return: number of items to request on the first page of the next poll
+        """
+        if self.rate is None:
+            return self.max_page
+        expected = self.rate * self.interval(fallback)
+        return int(clamp(self.min_page, self.max_page, math.ceil(expected * 1.5) + 1))
+
+
+class ListingWatermark:
+    """
+    Persisted newest processed item of a subreddit listing, so that each poll only fetches what is newer than it
+    and keeps paginating until it reaches it, backfilling whatever was missed while the bot was down
+    """
+    def __init__(self, subreddit, listing, initial_limit=100, probe_limit=25, max_backfill=1000):
+        """
+        Construct ListingWatermark and load the stored watermark, if any
+
+        :param subreddit: subreddit display name
+        :param listing: name of the listing, e.g. 'submissions', 'comments' or 'modlog:banuser'
+        :param initial_limit: number of items to fetch when there is no watermark yet
+        :param probe_limit: size of the first page requested on every poll
+        :param max_backfill: maximum number of items fetched in one poll while catching up
+        """
+        self.subreddit = subreddit
+        self.listing = listing
+        self.initial_limit = initial_limit
+        self.probe_limit = probe_limit
+        self.max_backfill = max_backfill
+        self.thing_id = None
+        self.created = None
+
+        try:
+            watermark = WatermarkModel.get(WatermarkModel.subreddit == subreddit, WatermarkModel.listing == listing)
+            self.thing_id = watermark.thing_id
+            self.created = watermark.created.timestamp()
+        except WatermarkModel.DoesNotExist:
+            pass
+
+    def _reached(self, item):
+        return get_fullname(item) == self.thing_id or item.created_utc < self.created
+
+    def _collect(self, generator, items):
+        for item in generator:
+            if self._reached(item):
+                return True
+            items.append(item)
+            if len(items) >= self.max_backfill:
+                return True
+        return False
+
+    def fetch(self, listing_func):
+        """
+        Fetch the items newer than the watermark, newest first
+
+        :param listing_func: praw listing method accepting limit and params, e.g. praw.models.Subreddit.new
+        :return: list of items
+        """
+        if self.thing_id is None:
+            return list(listing_func(limit=self.initial_limit))
+
+        items = list()
+        reached = self._collect(listing_func(limit=self.probe_limit), items)
+
+        if not reached and len(items) == self.probe_limit:
+            generator = listing_func(limit=self.max_backfill - len(items),
+                                     params={'after': get_fullname(items[-1])})
+            self._collect(generator, items)
+        return items
+
+    def advance(self, items):
+        """
+        Move the watermark to the newest of the processed items and persist it
+
+        :param items: items returned by fetch(), newest first
+        """
+        if not items:
+            return
+
+        newest = items[0]
+        self.thing_id = get_fullname(newest)
+        self.created = newest.created_utc
 
+        writer.submit(_save_watermark, self.subreddit, self.listing, self.thing_id, self.created)
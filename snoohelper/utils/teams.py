@@ -2,6 +2,8 @@ import configparser
 import snoohelper.utils as utils
 import snoohelper.utils.reddit
 from snoohelper.reddit.bot import SnooHelperBot
+from snoohelper.reddit.runtime import AsyncBotRuntime
+from snoohelper.reddit.combined import ListingGroups
 from .slack import IncomingWebhook
 import os
 
@@ -87,16 +89,22 @@ class SlackTeamsController:
     Utility class for easy management of SlackTeams. Stores current teams in a dict and implements methods for adding
     and removing teams as well as adding a Reddit bot to a team
     """
-    def __init__(self, filename, db_name, vars_from_env=False, build_teams=True):
+    def __init__(self, filename, db_name, vars_from_env=False, build_teams=True, async_runtime=False):
         """
         Construct the SlackTeams already present in the teams .ini file as well as their respective bots
         Holds current SlackTeams in self.teams dict, keys being the team's name
         :param filename: name of the .ini file containing the configuration of all the teams
+        :param async_runtime: run all bots on a single asyncio event loop instead of one thread per bot
         """
         self.teams = dict()
         self.filename = filename
         self.db_name = db_name
         self.vars_from_env = vars_from_env
+        self.runtime = None
+        self.listing_groups = ListingGroups()
+
+        if async_runtime:
+            self.runtime = AsyncBotRuntime()
 
         if build_teams:
             self.build_teams()
@@ -144,8 +152,13 @@ class SlackTeamsController:
         :param team_name: name of the team to add the bot to
         :return: instance of SnooHelperBot
         """
-        bot = SnooHelperBot(self.teams[team_name], self.db_name)
+        bot = SnooHelperBot(self.teams[team_name], self.db_name, start=False)
         self.teams[team_name].bot = bot
+        self.listing_groups.join(bot)
+        if self.runtime is not None:
+            self.runtime.add_bot(bot)
+        else:
+            bot.start()
         subscribers = self.teams[team_name].bot.subreddit.subscribers
         sleep = utils.reddit.calculate_sleep(subscribers)
         self.teams[team_name].set("sleep", sleep, save_to_disk)
@@ -193,6 +206,7 @@ class SlackTeamsController:
         """
         try:
             self.teams[team_name].bot.halt = True
+            self.listing_groups.leave(self.teams[team_name].bot)
         except AttributeError:
             pass
 
@@ -0,0 +1,161 @@
+import re
+import unicodedata
+from collections import OrderedDict, deque
+
+WORD_PATTERN = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are aren't as at be because been before being below between both
+but by can can't cannot could couldn't did didn't do does doesn't doing don't down during each few for from further
+get got had hadn't has hasn't have haven't having he he'd he'll he's her here here's hers herself him himself his how
+how's i i'd i'll i'm i've if in into is isn't it it's its itself just let's me more most mustn't my myself no nor not
+of off on once only or other ought our ours ourselves out over own same shan't she she'd she'll she's should
+shouldn't so some such than that that's the their theirs them themselves then there there's these they they'd
+they'll they're they've this those through to too under until up very was wasn't we we'd we'll we're we've were
+weren't what what's when when's where where's which while who who's whom why why's will with won't would wouldn't
+you you'd you'll you're you've your yours yourself yourselves
+""".split())
+
+
+def normalize(text):
+    """
+    Normalize a text for matching: Unicode NFKC, casefolded, runs of whitespace collapsed to a single space
+
+    :param text: text to normalize
+    :return: normalized text
+    """
+    return ' '.join(unicodedata.normalize('NFKC', text).casefold().split())
+
+
+def tokenize(text):
+    """
+    Split a text into lowercase words, apostrophes inside words are kept
+
+    :param text: text to split
+    :return: list of words
+    """
+    return WORD_PATTERN.findall(text.lower())
+
+
+def textblob_tokenize(text):
+    """
+    Split a text into lowercase words with TextBlob, which is only imported on first use
+
+    :param text: text to split
+    :return: list of words
+    """
+    from textblob import TextBlob
+    return [word.lower() for word in TextBlob(text).words]
+
+
+TOKENIZERS = {'builtin': tokenize, 'textblob': textblob_tokenize}
+
+
+class AhoCorasick:
+    """
+    Aho-Corasick automaton, finds the occurrences of any number of keywords in a text in a single pass over it
+    Keywords come and go as filters are added and removed, the trie and its transition table, with the failure links
+    folded in, are rebuilt from the live keywords on the first search after a change
+    """
+
+    def __init__(self):
+        self._keywords = OrderedDict()
+        self._tables = ([dict()], [()])
+        self._dirty = False
+
+    def add(self, keyword, value):
+        """
+        Add a keyword, empty keywords are ignored
+
+        :param keyword: string to look for
+        :param value: value reported when the keyword is found
+        """
+        if not keyword:
+            return
+
+        self._keywords.setdefault(keyword, list()).append(value)
+        self._dirty = True
+
+    def remove(self, keyword, value):
+        """
+        Remove a keyword added with add(), does nothing if it isn't present
+
+        :param keyword: string that was added
+        :param value: value it was added with
+        """
+        values = self._keywords.get(keyword)
+        if values is None or value not in values:
+            return
+
+        values.remove(value)
+        if not values:
+            del self._keywords[keyword]
+        self._dirty = True
+
+    def _build(self):
+        goto = [dict()]
+        outputs = [list()]
+        for keyword, values in self._keywords.items():
+            node = 0
+            for char in keyword:
+                child = goto[node].get(char)
+                if child is None:
+                    child = len(goto)
+                    goto.append(dict())
+                    outputs.append(list())
+                    goto[node][char] = child
+                node = child
+            outputs[node].extend(values)
+
+        fail = [0] * len(goto)
+        matches = [tuple(values) for values in outputs]
+        transitions = [dict(goto[0])] + [None] * (len(goto) - 1)
+        queue = deque(goto[0].values())
+        for child in goto[0].values():
+            transitions[child] = dict(goto[0])
+            transitions[child].update(goto[child])
+
+        while queue:
+            node = queue.popleft()
+            for char, child in goto[node].items():
+                queue.append(child)
+                fail[child] = transitions[fail[node]].get(char, 0)
+                matches[child] += matches[fail[child]]
+                transitions[child] = dict(transitions[fail[child]])
+                transitions[child].update(goto[child])
+
+        self._tables = (transitions, matches)
+        self._dirty = False
+
+    def iter_matches(self, text):
+        """
+        :param text: text to search
+        :return: generator of (end index, value) tuples, in the order the keywords end in the text
+        """
+        if self._dirty:
+            self._build()
+
+        transitions, matches = self._tables
+        state = 0
+
+        for i, char in enumerate(text):
+            state = transitions[state].get(char, 0)
+            for value in matches[state]:
+                yield i, value
+
+    def first(self, text):
+        """
+        :param text: text to search
+        :return: value of the keyword ending first in the text, None if no keyword occurs in it
+        """
+        if self._dirty:
+            self._build()
+
+        transitions, matches = self._tables
+        state = 0
+
+        for char in text:
+            state = transitions[state].get(char, 0)
+            if matches[state]:
+                return matches[state][0]
+        return None
@@ -1,3 +1,4 @@
+import json
 import random
 import string
 import time
@@ -10,6 +11,7 @@ import snoohelper.utils as utils
 from snoohelper.utils.credentials import get_token
 import snoohelper.utils.slack
 import snoohelper.utils.reddit
+from snoohelper.reddit.scheduler import scheduler
 from .form import SubredditSelectForm, ModulesSelectForm
 
 SLACK_APP_ID = get_token("SLACK_APP_ID", "credentials")
@@ -137,6 +139,15 @@ def create_app(teams_controller, handler):
         else:
             return "Invalid request token."
 
+    @new_app.route('/stats/scheduler', methods=['GET'])
+    def scheduler_stats():
+        # Same token as the Slack endpoints, passed as ?token=
+        token = request.args.get('token')
+        if token is None or token != SLACK_COMMANDS_TOKEN:
+            return Response(response="Invalid request token.", status=403)
+
+        return Response(response=json.dumps(scheduler.snapshot()), mimetype="application/json")
+
     return new_app
 
 
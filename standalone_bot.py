@@ -3,11 +3,12 @@
 from snoohelper.utils.teams import SlackTeamsController
 
 TESTING = False
+ASYNC_RUNTIME = False
 
 
 def main():
     if not TESTING:
-        SlackTeamsController("teams.ini", 'snoohelper_master.db')
+        SlackTeamsController("teams.ini", 'snoohelper_master.db', async_runtime=ASYNC_RUNTIME)
     else:
         SlackTeamsController("teams_test.ini", 'snoohelper_test.db')
 
@@ -2,12 +2,35 @@ import unittest
 import os
 from snoohelper.utils.teams import SlackTeamsController
 from snoohelper.utils.credentials import get_token
-from snoohelper.reddit.bot_modules.flair_enforcer import UnflairedSubmission
+from snoohelper.reddit.bot_modules.flair_enforcer import UnflairedSubmission, FlairEnforcer
+from snoohelper.reddit.bot_modules.flair_catalog import FlairCatalog
 from snoohelper.webapp.requests_handler import RequestsHandler
 from snoohelper.webapp.webapp import create_app
 import snoohelper.utils.exceptions
 import snoohelper.utils.slack
+from snoohelper.utils.text import AhoCorasick, normalize
+from snoohelper.reddit.bot_modules.floodgate import Floodgate, MinHashLSH
+from snoohelper.reddit.bot_modules.filters import Filter, FilterMatcher, FiltersController
+from snoohelper.reddit.bot import SnooHelperBot
+from snoohelper.utils.reddit import AdaptivePollInterval, ListingWatermark, AlreadyDoneHelper, AlreadyDonePruner
+from snoohelper.database.models import db, WatermarkModel, UserModel, UnflairedSubmissionModel, \
+    PendingSubmissionModel, AlreadyDoneModel, FilterModel, FlairTemplateModel, index_exists
+from snoohelper.database.connection import init_database, create_database, create_tables, use_shard, shard_keys
+import snoohelper.database.connection as connection
+from snoohelper.database.shard_tool import split_master
+from snoohelper.reddit.runtime import AsyncBotRuntime
+from snoohelper.reddit.combined import ListingGroup, ListingGroups
+import snoohelper.database.writer as writer
+from snoohelper.database.cache import UserCache
+from snoohelper.reddit.scheduler import RequestScheduler, ScheduledRequestor, use_lane, LANE_INTERACTIVE, \
+    LANE_MODERATION, LANE_BACKGROUND
+from peewee import OperationalError, IntegrityError
+import shutil
+import tempfile
+import threading
 import time
+from types import SimpleNamespace
+from unittest import mock
 
 
 def create_dummy_command_request(command):
@@ -113,5 +136,1688 @@ class SnooHelperTest(unittest.TestCase):
         result = self.app.get("/reddit/oauthcallback")
         self.assertEqual(result.status_code, 302)
 
+
+class TextTest(unittest.TestCase):
+
+    def test_normalize(self):
+        self.assertEqual(normalize("ＦＲＥＥ  ﬁve\tDollars\n"), "free five dollars")
+        self.assertEqual(normalize("Straße"), "strasse")
+        self.assertEqual(normalize("x²"), "x2")
+        self.assertEqual(normalize("   "), "")
+
+    def test_aho_corasick_matches(self):
+        automaton = AhoCorasick()
+        for keyword in ("he", "she", "his", "hers"):
+            automaton.add(keyword, keyword)
+
+        self.assertEqual(list(automaton.iter_matches("ushers")), [(3, "she"), (3, "he"), (5, "hers")])
+        self.assertEqual(automaton.first("ushers"), "she")
+        self.assertEqual(automaton.first("this"), "his")
+        self.assertIsNone(automaton.first("nothing"))
+
+    def test_aho_corasick_add_and_remove(self):
+        automaton = AhoCorasick()
+        automaton.add("", "empty")
+        self.assertIsNone(automaton.first("anything"))
+
+        automaton.add("spam", 1)
+        self.assertEqual(automaton.first("no spam"), 1)
+
+        automaton.add("spa", 2)
+        automaton.add("spam", 3)
+        self.assertEqual(list(automaton.iter_matches("spam")), [(2, 2), (3, 1), (3, 3)])
+
+        automaton.remove("spam", 1)
+        automaton.remove("spam", 4)
+        automaton.remove("ham", 1)
+        self.assertEqual(list(automaton.iter_matches("spam")), [(2, 2), (3, 3)])
+
+        automaton.remove("spa", 2)
+        automaton.remove("spam", 3)
+        self.assertIsNone(automaton.first("spam"))
+
+    def test_aho_corasick_prunes_removed_keywords(self):
+        automaton = AhoCorasick()
+        automaton.add("spam", 1)
+        automaton.add("eggs", 2)
+        automaton.first("")
+        self.assertEqual(len(automaton._tables[0]), 9)
+
+        automaton.remove("spam", 1)
+        self.assertEqual(automaton.first("spam and eggs"), 2)
+        self.assertEqual(len(automaton._tables[0]), 5)
+
+
+class FilterMatcherTest(unittest.TestCase):
+
+    @staticmethod
+    def make_filter(filter_string, use_regex=False):
+        return Filter(filter_string=filter_string, subreddit='test', use_regex=use_regex, expires=0)
+
+    def test_keywords(self):
+        matcher = FilterMatcher()
+        giveaway = self.make_filter("giveaway,FREE STUFF")
+        crypto = self.make_filter("bitcoin")
+        matcher.add(giveaway)
+        matcher.add(crypto)
+
+        self.assertIs(matcher.match(normalize("Huge ＦＲＥＥ  stuff inside")), giveaway)
+        self.assertIs(matcher.match(normalize("Bitcoin giveaway")), crypto)
+        self.assertIsNone(matcher.match(normalize("Weekly discussion thread")))
+        self.assertEqual(matcher.match_many([normalize("giveaway"), normalize("hello"), normalize("BITCOIN")]),
+                         [giveaway, None, crypto])
+
+    def test_combined_and_separate_patterns(self):
+        matcher = FilterMatcher()
+        price = self.make_filter(r"\$\d+,buy now", use_regex=True)
+        repeated = self.make_filter(r"(\w)\1{3}", use_regex=True)
+        named = self.make_filter(r"(?P<word>spam) (?P=word)", use_regex=True)
+        matcher.add(price)
+        matcher.add(repeated)
+        matcher.add(named)
+
+        self.assertIsNone(matcher.match(normalize("Nothing to see")))
+        self.assertIsNotNone(matcher.combined)
+        self.assertEqual(len(matcher.patterns), 2)
+        self.assertEqual(len(matcher.separate_patterns), 2)
+
+        self.assertIs(matcher.match(normalize("Only $20")), price)
+        self.assertIs(matcher.match(normalize("BUY NOW")), price)
+        self.assertIs(matcher.match(normalize("Soooooo good")), repeated)
+        self.assertIs(matcher.match(normalize("spam SPAM")), named)
+
+    def test_remove(self):
+        matcher = FilterMatcher()
+        keyword = self.make_filter("giveaway")
+        pattern = self.make_filter(r"\$\d+", use_regex=True)
+        separate = self.make_filter(r"(\w)\1{3}", use_regex=True)
+        for filter_obj in (keyword, pattern, separate):
+            matcher.add(filter_obj)
+        self.assertIs(matcher.match(normalize("$5 giveaway")), keyword)
+
+        matcher.remove(keyword)
+        self.assertIs(matcher.match(normalize("$5 giveaway")), pattern)
+
+        matcher.remove(pattern)
+        self.assertIsNone(matcher.match(normalize("$5 giveaway")))
+        self.assertIsNone(matcher.combined)
+        self.assertIs(matcher.match(normalize("aaaa")), separate)
+
+        matcher.remove(separate)
+        self.assertIsNone(matcher.match(normalize("aaaa")))
+
+    def test_invalid_pattern(self):
+        matcher = FilterMatcher()
+        broken = self.make_filter(r"(unclosed,[a-,valid\d", use_regex=True)
+        matcher.add(broken)
+
+        self.assertEqual(len(matcher.patterns), 1)
+        self.assertIs(matcher.match(normalize("valid1")), broken)
+        self.assertIsNone(matcher.match(normalize("(unclosed")))
+
+    def test_check_filter(self):
+        self.assertTrue(self.make_filter("giveaway").check_filter("GIVEAWAY time"))
+        self.assertFalse(self.make_filter("giveaway").check_filter("give away"))
+        self.assertTrue(self.make_filter(r"^\[meta\]", use_regex=True).check_filter("[META] rules"))
+
+        filter_obj = self.make_filter("giveaway")
+        filter_obj.check_filter("first")
+        matcher = filter_obj._matcher
+        self.assertTrue(filter_obj.check_filter("giveaway"))
+        self.assertIs(filter_obj._matcher, matcher)
+
+
+class FloodgateTest(unittest.TestCase):
+
+    start = 1500000000
+    repeated_titles = ["Forgot my password, how do I reset it?", "I forgot my password and can't reset it",
+                       "Forgot password - reset not working", "Reset forgot password???",
+                       "Forgot password again, how to reset"]
+    other_titles = ["Weekly discussion thread", "Look at this sunset I photographed", "Patch notes for version 2.1",
+                    "Best budget keyboard?", "My cat learned to open doors"]
+
+    def test_minhash_lsh(self):
+        lsh = MinHashLSH(seed=1)
+        self.assertEqual(lsh.insert('a', frozenset(['reset', 'password', 'help'])), set())
+        self.assertEqual(lsh.insert('b', frozenset(['reset', 'password', 'help'])), {'a'})
+        self.assertEqual(lsh.insert('c', frozenset(['sunset', 'photographed'])), set())
+
+        lsh.remove('a')
+        self.assertEqual(lsh.insert('d', frozenset(['reset', 'password', 'help'])), {'b'})
+        lsh.remove('b')
+        lsh.remove('c')
+        lsh.remove('d')
+        self.assertTrue(all(not buckets for buckets in lsh.buckets))
+
+    def test_clusters_near_duplicates(self):
+        floodgate = Floodgate(faq_term_count_threshold=4)
+        titles = [title for pair in zip(self.repeated_titles, self.other_titles) for title in pair]
+        for i, title in enumerate(titles):
+            floodgate.accumulate_title(title, self.start + i * 60)
+
+        self.assertEqual(floodgate.check_all(), [list(reversed(self.repeated_titles))])
+        self.assertEqual(len(floodgate.clusters), len(self.other_titles) + 1)
+
+    def test_surfaces_cluster_once(self):
+        floodgate = Floodgate(faq_term_count_threshold=4)
+        for i, title in enumerate(self.repeated_titles[:3]):
+            floodgate.accumulate_title(title, self.start + i * 60)
+        self.assertIsNone(floodgate.check_all())
+
+        floodgate.accumulate_title(self.repeated_titles[3], self.start + 180)
+        self.assertEqual(len(floodgate.check_all()), 1)
+        self.assertIsNone(floodgate.check_all())
+
+        floodgate.accumulate_title(self.repeated_titles[4], self.start + 240)
+        self.assertIsNone(floodgate.check_all())
+
+    def test_clusters_reported_to_team(self):
+        bot = SimpleNamespace(floodgate=Floodgate(faq_term_count_threshold=4), webhook=FakeWebhook(),
+                              subreddit_name='test')
+        for i, title in enumerate(self.repeated_titles[:4]):
+            bot.floodgate.accumulate_title(title, self.start + i * 60)
+
+        self.assertEqual(SnooHelperBot.check_floodgate(bot), [list(reversed(self.repeated_titles[:4]))])
+        self.assertEqual(len(bot.webhook.messages), 1)
+        attachment = bot.webhook.messages[0].attachments[0].attachment_dict
+        self.assertEqual(attachment['title'], "4 submissions like: " + self.repeated_titles[3])
+
+        self.assertIsNone(SnooHelperBot.check_floodgate(bot))
+        self.assertEqual(len(bot.webhook.messages), 1)
+
+    def test_window_eviction(self):
+        floodgate = Floodgate(max_delta_hours=1, faq_term_count_threshold=3)
+        for i, title in enumerate(self.repeated_titles[:2]):
+            floodgate.accumulate_title(title, self.start + i * 60)
+        floodgate.accumulate_title(self.other_titles[0], self.start + 3000)
+        self.assertEqual(len(floodgate.entries), 3)
+
+        floodgate.accumulate_title(self.repeated_titles[2], self.start + 3630)
+        self.assertEqual(len(floodgate.entries), 3)
+        self.assertEqual(len(floodgate.titles_accumulator), 3)
+        self.assertIsNone(floodgate.check_all())
+
+        floodgate.accumulate_title(self.other_titles[1], self.start + 8000)
+        self.assertEqual([floodgate.entries[entry_id][2] for entry_id in floodgate.titles_accumulator],
+                         [self.other_titles[1]])
+        self.assertEqual(len(floodgate.clusters), 1)
+        self.assertEqual(sum(len(bucket) for buckets in floodgate.lsh.buckets for bucket in buckets.values()),
+                         floodgate.lsh.bands)
+
+    def test_out_of_order_titles(self):
+        floodgate = Floodgate(max_delta_hours=1)
+        for offset, title in zip((300, 100, 200, 0), self.other_titles):
+            floodgate.accumulate_title(title, self.start + offset)
+
+        timestamps = [floodgate.entries[entry_id][1] for entry_id in floodgate.titles_accumulator]
+        self.assertEqual(timestamps, sorted(timestamps))
+        self.assertIsNone(floodgate.accumulate_title("the and of", self.start))
+
+
+class FakeItem:
+
+    def __init__(self, number, created_utc, subreddit='test'):
+        self.id = 'i{}'.format(number)
+        self.fullname = 't3_' + self.id
+        self.created_utc = created_utc
+        self.subreddit = subreddit
+
+
+def make_items(first, count, start_time, spacing=10, subreddit='test'):
+    """
+    :return: list of count FakeItem instances posted every spacing seconds from start_time, newest first
+    """
+    return [FakeItem(first + i, start_time + i * spacing, subreddit) for i in reversed(range(count))]
+
+
+class FakeListing:
+    """
+    Serves a list of items, newest first, like a praw listing method accepting limit and params
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.calls = list()
+
+    def post(self, items):
+        self.items = items + self.items
+
+    def __call__(self, limit=100, params=None):
+        self.calls.append((limit, params))
+        start = 0
+        if params is not None and 'after' in params:
+            start = [item.fullname for item in self.items].index(params['after']) + 1
+        return iter(self.items[start:start + limit])
+
+
+class AdaptivePollIntervalTest(unittest.TestCase):
+
+    def test_fallback_without_rate(self):
+        poll_interval = AdaptivePollInterval()
+        self.assertEqual(poll_interval.interval(20), 20)
+        self.assertEqual(poll_interval.page_size(20), poll_interval.max_page)
+
+        poll_interval.record([FakeItem(0, 1000)], now=1000)
+        self.assertIsNone(poll_interval.rate)
+        self.assertEqual(poll_interval.interval(20), 20)
+
+    def test_first_poll_rate_from_timestamps(self):
+        poll_interval = AdaptivePollInterval()
+        poll_interval.record(make_items(0, 11, 1000, spacing=10), now=1100)
+        self.assertAlmostEqual(poll_interval.rate, 0.1)
+        self.assertEqual(poll_interval.interval(20), 60)
+        self.assertEqual(poll_interval.page_size(20), 10)
+
+    def test_busy_listing(self):
+        poll_interval = AdaptivePollInterval()
+        poll_interval.record(make_items(0, 21, 1000, spacing=0.5), now=1010)
+        self.assertAlmostEqual(poll_interval.rate, 2)
+        self.assertEqual(poll_interval.interval(20), 25)
+        self.assertEqual(poll_interval.page_size(20), 76)
+
+        poll_interval.record(make_items(21, 500, 1010, spacing=0.01), now=1015)
+        self.assertEqual(poll_interval.interval(20), poll_interval.min_interval)
+        self.assertEqual(poll_interval.page_size(20), poll_interval.max_page)
+
+    def test_quiet_listing(self):
+        poll_interval = AdaptivePollInterval()
+        poll_interval.record(make_items(0, 2, 1000, spacing=200), now=1200)
+        self.assertEqual(poll_interval.interval(20), 200)
+        self.assertEqual(poll_interval.page_size(20), poll_interval.min_page)
+
+        poll_interval = AdaptivePollInterval()
+        poll_interval.record(make_items(0, 2, 1000, spacing=5000), now=6000)
+        self.assertEqual(poll_interval.interval(20), poll_interval.max_interval)
+
+    def test_moving_average(self):
+        poll_interval = AdaptivePollInterval(smoothing=0.5)
+        poll_interval.record(make_items(0, 11, 1000, spacing=10), now=1100)
+        poll_interval.record(make_items(11, 30, 1100, spacing=1), now=1200)
+        self.assertAlmostEqual(poll_interval.rate, 0.5 * 0.3 + 0.5 * 0.1)
+
+        poll_interval = AdaptivePollInterval()
+        poll_interval.record([], now=1000)
+        poll_interval.record([], now=1100)
+        self.assertEqual(poll_interval.rate, 0)
+        self.assertEqual(poll_interval.interval(20), poll_interval.max_interval)
+
+
+class ListingWatermarkTest(unittest.TestCase):
+
+    subreddit = 'snoohelperwatermarktest'
+    listing = 'submissions'
+
+    @classmethod
+    def setUpClass(cls):
+        init_database("snoohelper_test.db")
+
+    def setUp(self):
+        writer.submit(WatermarkModel.delete().where(WatermarkModel.subreddit == self.subreddit).execute).wait()
+        self.watermark = ListingWatermark(self.subreddit, self.listing, initial_limit=100, probe_limit=25,
+                                          max_backfill=40)
+        self.listing_func = FakeListing(make_items(0, 150, 100000))
+
+    def catch_up(self):
+        self.watermark.advance(self.watermark.fetch(self.listing_func))
+        self.listing_func.calls = list()
+
+    def test_initial_fetch(self):
+        items = self.watermark.fetch(self.listing_func)
+        self.assertEqual(len(items), 100)
+        self.assertEqual(items[0].fullname, 't3_i149')
+        self.assertEqual(self.listing_func.calls, [(100, None)])
+
+    def test_fetch_only_new_items(self):
+        self.catch_up()
+        self.listing_func.post(make_items(150, 5, 200000))
+
+        items = self.watermark.fetch(self.listing_func)
+        self.assertEqual([item.fullname for item in items], ['t3_i{}'.format(i) for i in range(154, 149, -1)])
+        self.assertEqual(self.listing_func.calls, [(25, None)])
+        self.assertEqual(self.watermark.fetch(self.listing_func), items)
+
+    def test_backfill(self):
+        self.catch_up()
+        self.listing_func.post(make_items(150, 30, 200000))
+
+        items = self.watermark.fetch(self.listing_func)
+        self.assertEqual(len(items), 30)
+        self.assertEqual(items[-1].fullname, 't3_i150')
+        self.assertEqual(self.listing_func.calls, [(25, None), (15, {'after': items[24].fullname})])
+
+    def test_max_backfill(self):
+        self.catch_up()
+        self.listing_func.post(make_items(150, 60, 200000))
+
+        items = self.watermark.fetch(self.listing_func)
+        self.assertEqual(len(items), 40)
+        self.assertEqual(items[0].fullname, 't3_i209')
+
+    def test_deleted_watermark_item(self):
+        self.catch_up()
+        self.listing_func.items.pop(0)
+        self.listing_func.post(make_items(150, 3, 200000))
+
+        items = self.watermark.fetch(self.listing_func)
+        self.assertEqual([item.fullname for item in items], ['t3_i152', 't3_i151', 't3_i150'])
+
+    def test_advance(self):
+        self.watermark.advance([])
+        self.assertIsNone(self.watermark.thing_id)
+
+        self.catch_up()
+        self.assertEqual(self.watermark.thing_id, 't3_i149')
+        self.assertEqual(self.watermark.created, self.listing_func.items[0].created_utc)
+
+        writer.submit(lambda: None).wait()
+        stored = ListingWatermark(self.subreddit, self.listing)
+        self.assertEqual(stored.thing_id, 't3_i149')
+        self.assertEqual(stored.created, self.listing_func.items[0].created_utc)
+
+
+def rate_limit_headers(remaining, reset=600, used=0):
+    return {'x-ratelimit-remaining': str(remaining), 'x-ratelimit-reset': str(reset), 'x-ratelimit-used': str(used)}
+
+
+class FakeResponse:
+
+    def __init__(self, headers):
+        self.headers = headers
+
+
+class FakeSession:
+    """
+    Stands in for the requests session of a prawcore Requestor, records the requests instead of sending them
+    """
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.requests = list()
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        return FakeResponse(self.headers)
+
+    def close(self):
+        pass
+
+
+class RequestSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = RequestScheduler(capacity=10, period=600)
+        self.scheduler.update(rate_limit_headers(0))
+        self.granted = list()
+
+    def queue_request(self, lane, team, name):
+        queued = sum(lane_stats['queued'] for lane_stats in self.scheduler.snapshot()['lanes'].values())
+
+        def acquire():
+            self.scheduler.acquire(lane, team)
+            self.granted.append(name)
+
+        thread = threading.Thread(target=acquire, daemon=True)
+        thread.start()
+        deadline = time.time() + 5
+        while sum(lane_stats['queued'] for lane_stats in self.scheduler.snapshot()['lanes'].values()) == queued:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+        return thread
+
+    def grant_one(self, thread):
+        self.scheduler.update(rate_limit_headers(1))
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_lane_priority(self):
+        background = self.queue_request(LANE_BACKGROUND, 'a', 'background')
+        moderation = self.queue_request(LANE_MODERATION, 'a', 'moderation')
+        interactive = self.queue_request(LANE_INTERACTIVE, 'b', 'interactive')
+
+        self.grant_one(interactive)
+        self.grant_one(moderation)
+        self.grant_one(background)
+        self.assertEqual(self.granted, ['interactive', 'moderation', 'background'])
+
+    def test_round_robin_between_teams(self):
+        first_a = self.queue_request(LANE_MODERATION, 'a', 'a1')
+        second_a = self.queue_request(LANE_MODERATION, 'a', 'a2')
+        first_b = self.queue_request(LANE_MODERATION, 'b', 'b1')
+
+        self.grant_one(first_a)
+        self.grant_one(first_b)
+        self.grant_one(second_a)
+        self.assertEqual(self.granted, ['a1', 'b1', 'a2'])
+
+    def test_update_from_headers(self):
+        self.scheduler.update(rate_limit_headers(400, reset=120, used=200))
+        self.assertEqual(self.scheduler.remaining, 400)
+        self.assertEqual(self.scheduler.capacity, 600)
+        self.assertAlmostEqual(self.scheduler.reset_at - time.time(), 120, delta=1)
+
+        self.scheduler.update({'x-ratelimit-remaining': 'abc', 'x-ratelimit-reset': '10'})
+        self.scheduler.update({})
+        self.assertEqual(self.scheduler.remaining, 400)
+
+    def test_snapshot(self):
+        self.scheduler.update(rate_limit_headers(5))
+        self.scheduler.acquire(LANE_BACKGROUND, 'a')
+        snapshot = self.scheduler.snapshot()
+        self.assertEqual(snapshot['remaining'], 4)
+        self.assertEqual(snapshot['lanes']['background']['granted'], 1)
+        self.assertEqual(snapshot['lanes']['interactive']['queued'], 0)
+
+    def test_scheduled_requestor(self):
+        self.scheduler.update(rate_limit_headers(10))
+        session = FakeSession(rate_limit_headers(42, reset=300))
+        requestor = ScheduledRequestor(user_agent="SnooHelper tests", session=session, team='a',
+                                       request_scheduler=self.scheduler)
+
+        requestor.request('GET', 'https://oauth.reddit.com/r/test/new')
+        requestor.request('POST', 'https://oauth.reddit.com/api/remove')
+        with use_lane(LANE_INTERACTIVE):
+            requestor.request('GET', 'https://oauth.reddit.com/user/test/about')
+
+        lanes = self.scheduler.snapshot()['lanes']
+        self.assertEqual([lanes[name]['granted'] for name in ('interactive', 'moderation', 'background')], [1, 1, 1])
+        self.assertEqual(len(session.requests), 3)
+        self.assertEqual(self.scheduler.remaining, 42)
+
+
+class DatabaseWriterTest(unittest.TestCase):
+
+    subreddit = 'snoohelperwritertest'
+
+    @classmethod
+    def setUpClass(cls):
+        init_database("snoohelper_test.db")
+
+    def setUp(self):
+        self.writer = writer.DatabaseWriter(max_batch=4, max_delay=0.2, retries=2)
+        self.batches = list()
+        commit = self.writer._commit
+
+        def recording_commit(batch):
+            self.batches.append(len(batch))
+            return commit(batch)
+
+        self.writer._commit = recording_commit
+        self.writer.submit(self.delete_rows).wait()
+        self.batches = list()
+
+    def tearDown(self):
+        self.writer.close()
+
+    def delete_rows(self):
+        WatermarkModel.delete().where(WatermarkModel.subreddit == self.subreddit).execute()
+
+    def insert_row(self, listing):
+        WatermarkModel.create(subreddit=self.subreddit, listing=listing, thing_id=listing, created=0)
+        return listing
+
+    def stored_listings(self):
+        return sorted(row.listing for row in WatermarkModel.select().where(WatermarkModel.subreddit == self.subreddit))
+
+    def block(self):
+        """
+        Keep the writer thread busy on an operation of its own until the returned event is set
+        """
+        started = threading.Event()
+        released = threading.Event()
+
+        def blocking():
+            started.set()
+            released.wait(5)
+
+        self.writer.submit(blocking)
+        started.wait(5)
+        return released
+
+    def test_batches(self):
+        released = self.block()
+        pending = [self.writer.submit(self.insert_row, str(i)) for i in range(10)]
+        released.set()
+
+        self.assertEqual([write.wait(5) for write in pending], [str(i) for i in range(10)])
+        self.assertEqual(self.batches, [1, 4, 4, 2])
+        self.assertEqual(self.stored_listings(), sorted(str(i) for i in range(10)))
+
+    def test_failed_operation_is_isolated(self):
+        def insert_and_fail():
+            self.insert_row('failed')
+            raise ValueError("invalid")
+
+        released = self.block()
+        first = self.writer.submit(self.insert_row, 'first')
+        failed = self.writer.submit(insert_and_fail)
+        last = self.writer.submit(self.insert_row, 'last')
+        released.set()
+
+        self.assertEqual(first.wait(5), 'first')
+        self.assertRaises(ValueError, failed.wait, 5)
+        self.assertEqual(last.wait(5), 'last')
+        self.assertEqual(self.batches, [1, 3])
+        self.assertEqual(self.stored_listings(), ['first', 'last'])
+
+    def test_retry_while_busy(self):
+        attempts = list()
+
+        def busy_once():
+            attempts.append(time.time())
+            if len(attempts) == 1:
+                raise OperationalError("database is locked")
+            return 'done'
+
+        released = self.block()
+        inserted = self.writer.submit(self.insert_row, 'retried')
+        busy = self.writer.submit(busy_once)
+        released.set()
+
+        self.assertEqual(busy.wait(5), 'done')
+        self.assertEqual(inserted.wait(5), 'retried')
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(self.stored_listings(), ['retried'])
+
+    def test_gives_up_after_retries(self):
+        def always_busy():
+            raise OperationalError("database is locked")
+
+        self.assertRaises(OperationalError, self.writer.submit(always_busy).wait, 5)
+        self.assertEqual(len(self.batches), 2)
+
+    def test_wait_timeout(self):
+        released = self.block()
+        pending = self.writer.submit(self.insert_row, 'late')
+        self.assertRaises(TimeoutError, pending.wait, 0.05)
+        released.set()
+        self.assertEqual(pending.wait(5), 'late')
+
+    def test_flush_and_close(self):
+        released = self.block()
+        pending = [self.writer.submit(self.insert_row, str(i)) for i in range(3)]
+        threading.Timer(0.1, released.set).start()
+        self.writer.flush(5)
+        self.assertTrue(all(write._done.is_set() for write in pending))
+
+        queued = self.writer.submit(self.insert_row, 'queued')
+        self.writer.close(5)
+        self.assertFalse(self.writer.thread.is_alive())
+        self.assertEqual(queued.wait(0), 'queued')
+        self.assertRaises(RuntimeError, self.writer.submit, self.insert_row, 'closed')
+
+
+class ShardRouterTest(unittest.TestCase):
+
+    def setUp(self):
+        writer.flush()
+        self.previous = db.obj, connection._router
+        self.tmp_dir = tempfile.mkdtemp()
+        self.master_name = os.path.join(self.tmp_dir, "master.db")
+        self.shard_dir = os.path.join(self.tmp_dir, "shards")
+        db.initialize(None)
+        connection._router = None
+        init_database(self.master_name, sharding=True, shard_dir=self.shard_dir)
+        self.router = connection._router
+
+    def tearDown(self):
+        for database in [self.router.master_database] + list(self.router.shard_databases.values()):
+            database.close()
+        db.initialize(self.previous[0])
+        connection._router = self.previous[1]
+        shutil.rmtree(self.tmp_dir)
+
+    @staticmethod
+    def add_watermark(subreddit, thing_id):
+        WatermarkModel.create(subreddit=subreddit, listing='new', thing_id=thing_id, created=1000)
+
+    def test_shard_key_and_path(self):
+        self.assertEqual(self.router.shard_key("AskScience"), "askscience")
+        self.assertEqual(self.router.shard_path("../ask-science"), os.path.join(self.shard_dir, "askscience.db"))
+
+    def test_use_shard_routes_queries(self):
+        with use_shard("AskScience"):
+            self.add_watermark("AskScience", "t3_a")
+            self.assertEqual(connection.current_shard(), "askscience")
+        self.add_watermark("pics", "t3_b")
+
+        self.assertIsNone(connection.current_shard())
+        self.assertTrue(os.path.exists(os.path.join(self.shard_dir, "askscience.db")))
+        self.assertEqual([row.thing_id for row in WatermarkModel.select()], ["t3_b"])
+        with use_shard("askscience"):
+            self.assertEqual([row.thing_id for row in WatermarkModel.select()], ["t3_a"])
+        self.assertEqual(shard_keys(), [None, "askscience"])
+
+    def test_shard_selection_is_per_thread(self):
+        seen = list()
+
+        def other_thread():
+            seen.append(connection.current_shard())
+            seen.append([row.thing_id for row in WatermarkModel.select()])
+            db.close()
+
+        self.add_watermark("pics", "t3_b")
+        with use_shard("AskScience"):
+            thread = threading.Thread(target=other_thread)
+            thread.start()
+            thread.join()
+            self.assertEqual(connection.current_shard(), "askscience")
+        self.assertEqual(seen, [None, ["t3_b"]])
+
+    def test_split_master_counts_inserted_rows(self):
+        self.add_watermark("AskScience", "t3_a")
+        UserModel.create(username="someone", subreddit="AskScience", bans=2)
+        self.add_watermark("pics", "t3_b")
+
+        self.assertEqual(split_master(self.master_name, self.shard_dir), {"askscience": 2, "pics": 1})
+        with use_shard("AskScience"):
+            self.assertEqual(UserModel.get(UserModel.username == "someone").bans, 2)
+            self.assertEqual(WatermarkModel.select().count(), 1)
+        self.assertEqual(WatermarkModel.select().count(), 2)
+
+        self.assertEqual(split_master(self.master_name, self.shard_dir), {"askscience": 0, "pics": 0})
+
+
+class DuplicateUsersMigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        writer.flush()
+        self.previous = db.obj, connection._router
+        self.tmp_dir = tempfile.mkdtemp()
+        self.database = create_database(os.path.join(self.tmp_dir, "old.db"))
+        db.initialize(self.database)
+        connection._router = None
+
+        UserModel.create_table(True)
+        db.execute_sql('DROP INDEX "usermodel_username_subreddit"')
+        UserModel.create(username="someone", subreddit="pics", bans=1, removed_comments=2)
+        UserModel.create(username="someone", subreddit="pics", bans=1, tracked=True)
+        UserModel.create(username="someone", subreddit="AskScience", bans=1)
+
+    def tearDown(self):
+        self.database.close()
+        db.initialize(self.previous[0])
+        connection._router = self.previous[1]
+        shutil.rmtree(self.tmp_dir)
+
+    def test_duplicates_merged_before_unique_index(self):
+        self.assertFalse(index_exists(UserModel, ('username', 'subreddit'), unique=True))
+        create_tables()
+
+        self.assertTrue(index_exists(UserModel, ('username', 'subreddit'), unique=True))
+        user = UserModel.get(UserModel.username == "someone", UserModel.subreddit == "pics")
+        self.assertEqual((user.bans, user.removed_comments, user.tracked), (2, 2, True))
+        self.assertEqual(UserModel.select().count(), 2)
+
+    def test_merge_runs_once(self):
+        create_tables()
+        with mock.patch.object(connection, 'merge_duplicate_users') as merge:
+            create_tables()
+        merge.assert_not_called()
+
+
+class FakeBot:
+
+    def __init__(self, delay=0.01, cycle_time=0.0, fail=False):
+        self.delay = delay
+        self.cycle_time = cycle_time
+        self.fail = fail
+        self.cycles = 0
+        self.threads = set()
+        self.initialized = threading.Event()
+        self.cycled = threading.Event()
+        self._halt = False
+        self._halt_callbacks = list()
+
+    @property
+    def halt(self):
+        return self._halt
+
+    @halt.setter
+    def halt(self, value):
+        self._halt = value
+        if value:
+            for callback in self._halt_callbacks:
+                callback()
+
+    def add_halt_callback(self, callback):
+        self._halt_callbacks.append(callback)
+
+    def init_modules(self):
+        self.initialized.set()
+
+    def run_cycle(self):
+        self.threads.add(threading.current_thread().name)
+        if self.fail:
+            raise ValueError("cycle failed")
+        time.sleep(self.cycle_time)
+        self.cycles += 1
+        self.cycled.set()
+        return self.delay
+
+
+class AsyncBotRuntimeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.runtime = AsyncBotRuntime(max_concurrency=2)
+
+    def tearDown(self):
+        self.runtime.stop(timeout=5)
+
+    def test_cycles_run_on_worker_threads(self):
+        bot = FakeBot()
+        self.runtime.add_bot(bot)
+        self.assertTrue(bot.cycled.wait(5))
+        self.assertTrue(bot.initialized.is_set())
+        self.assertNotIn(threading.current_thread().name, bot.threads)
+        self.assertNotIn(self.runtime.thread.name, bot.threads)
+
+    def test_halt_wakes_bot_up(self):
+        bot = FakeBot(delay=60)
+        future = self.runtime.add_bot(bot)
+        self.assertTrue(bot.cycled.wait(5))
+        bot.halt = True
+        future.result(timeout=5)
+        self.assertEqual(bot.cycles, 1)
+        self.assertNotIn(bot, self.runtime.tasks)
+
+    def test_pool_bounds_concurrent_cycles(self):
+        bots = [FakeBot(delay=60, cycle_time=0.3) for _ in range(3)]
+        start = time.time()
+        for bot in bots:
+            self.runtime.add_bot(bot)
+        for bot in bots:
+            self.assertTrue(bot.cycled.wait(5))
+        self.assertGreaterEqual(time.time() - start, 0.6)
+
+    def test_failing_bot_is_dropped(self):
+        bot = FakeBot(fail=True)
+        self.runtime.add_bot(bot).result(timeout=5)
+        self.assertNotIn(bot, self.runtime.tasks)
+
+    def test_stop(self):
+        bots = [FakeBot(delay=60) for _ in range(2)]
+        futures = [self.runtime.add_bot(bot) for bot in bots]
+        for bot in bots:
+            self.assertTrue(bot.cycled.wait(5))
+
+        self.runtime.stop(timeout=5)
+        self.assertTrue(all(bot.halt for bot in bots))
+        self.assertTrue(all(future.done() for future in futures))
+        self.assertFalse(self.runtime.thread.is_alive())
+        self.assertTrue(self.runtime.loop.is_closed())
+        self.assertRaises(RuntimeError, self.runtime.add_bot, FakeBot())
+
+
+class FakeGroupReddit:
+
+    def __init__(self, listing, account='SnooHelper'):
+        self.listing = listing
+        self.requested = list()
+        self.user = SimpleNamespace(me=lambda: SimpleNamespace(name=account))
+
+    def subreddit(self, name):
+        self.requested.append(name)
+        return SimpleNamespace(new=self.listing)
+
+
+def make_group_bot(subreddit, reddit, token='token', thing_id=None, created=None):
+    watermark = SimpleNamespace(thing_id=thing_id, created=created, initial_limit=50)
+    return SimpleNamespace(subreddit_name=subreddit, thread_r=reddit, listing_group=None,
+                           config=SimpleNamespace(sleep=20, reddit_refresh_token=token),
+                           watermarks={'submissions': watermark})
+
+
+def process(bot, items):
+    watermark = bot.watermarks['submissions']
+    watermark.thing_id, watermark.created = items[0].fullname, items[0].created_utc
+
+
+class ListingGroupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.listing = FakeListing(list())
+        self.reddit = FakeGroupReddit(self.listing)
+        self.group = ListingGroup()
+
+    def add_bot(self, subreddit, thing_id=None, created=None):
+        bot = make_group_bot(subreddit, self.reddit, thing_id=thing_id, created=created)
+        self.group.add(bot)
+        return bot
+
+    def poll(self, bot):
+        self.group.next_polls['submissions'] = 0
+        return self.group.fetch(bot, 'submissions')
+
+    @staticmethod
+    def interleave(*lists):
+        return sorted((item for items in lists for item in items), key=lambda item: item.created_utc, reverse=True)
+
+    def test_fan_out(self):
+        a, b = self.add_bot('A'), self.add_bot('B')
+        a_items = make_items(0, 3, 1000, subreddit='A')
+        b_items = make_items(10, 2, 1005, subreddit='B')
+        self.listing.post(self.interleave(a_items, b_items, make_items(20, 2, 1001, subreddit='C')))
+
+        self.assertTrue(self.group.is_shared())
+        self.assertEqual(self.group.fetch(a, 'submissions'), a_items)
+        self.assertEqual(self.group.fetch(b, 'submissions'), b_items)
+        self.assertEqual(self.reddit.requested, ['a+b'])
+        self.assertEqual(len(self.listing.calls), 1)
+
+    def test_pages_until_every_member_is_reached(self):
+        a_seen = make_items(0, 5, 1000, subreddit='A')
+        a = self.add_bot('A', a_seen[0].fullname, a_seen[0].created_utc)
+        b = self.add_bot('B', 't3_old', 500)
+        a_new = make_items(5, 3, 1100, subreddit='A')
+        b_new = make_items(100, 150, 2000, subreddit='B')
+        self.listing.post(self.interleave(a_seen, a_new, b_new))
+
+        self.assertEqual(self.group.fetch(a, 'submissions'), a_new)
+        self.assertEqual(self.group.fetch(b, 'submissions'), b_new)
+        self.assertEqual(self.listing.calls, [(100, None), (900, {'after': b_new[99].fullname})])
+
+    def test_no_redelivery_before_processing(self):
+        a, b = self.add_bot('A'), self.add_bot('B')
+        first = make_items(0, 3, 1000, subreddit='A')
+        self.listing.post(first)
+        self.assertEqual(self.poll(a), first)
+
+        second = make_items(3, 2, 2000, subreddit='A')
+        self.listing.post(second)
+        self.assertEqual(self.poll(a), second)
+        self.assertEqual(self.poll(b), list())
+
+    def test_members_keep_their_place_when_others_join_or_leave(self):
+        a, b = self.add_bot('A'), self.add_bot('B')
+        self.listing.post(self.interleave(make_items(0, 3, 1000, subreddit='A'),
+                                          make_items(10, 3, 1000, subreddit='B')))
+        process(a, self.poll(a))
+        process(b, self.group.fetch(b, 'submissions'))
+
+        self.group.remove(b)
+        c = self.add_bot('C')
+        self.group.remove(c)
+        c = self.add_bot('C')
+        new = make_items(20, 2, 2000, subreddit='A')
+        self.listing.post(new)
+        self.assertEqual(self.poll(a), new)
+        self.assertEqual(self.reddit.requested[-1], 'a+c')
+
+    def test_last_member_drops_group_state(self):
+        a, b = self.add_bot('A'), self.add_bot('B')
+        self.listing.post(make_items(0, 3, 1000, subreddit='B'))
+        self.poll(a)
+        self.group.remove(a)
+        self.assertFalse(self.group.is_shared())
+        self.assertEqual(self.group.buffers, dict())
+        self.assertEqual(self.group.delivered, dict())
+
+
+class ListingGroupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.groups = ListingGroups()
+        self.listing = FakeListing(list())
+
+    def make_bot(self, subreddit, account='SnooHelper', token='token'):
+        return make_group_bot(subreddit, FakeGroupReddit(self.listing, account), token=token)
+
+    def test_grouped_by_account(self):
+        a = self.make_bot('A', token='token a')
+        b = self.make_bot('B', account='snoohelper', token='token b')
+        c = self.make_bot('C', account='other')
+
+        group = self.groups.join(a)
+        self.assertIs(self.groups.join(b), group)
+        self.assertIsNot(self.groups.join(c), group)
+        self.assertIs(a.listing_group, group)
+        self.assertEqual(group.multireddit, 'a+b')
+
+    def test_ungrouped_bots(self):
+        no_token = self.make_bot('A', token='')
+        unknown = self.make_bot('B')
+        unknown.thread_r.user = SimpleNamespace(me=lambda: None)
+
+        self.assertIsNone(self.groups.join(no_token))
+        self.assertIsNone(self.groups.join(unknown))
+        self.assertIsNone(unknown.listing_group)
+
+    def test_leave(self):
+        a, b = self.make_bot('A'), self.make_bot('B')
+        group = self.groups.join(a)
+        self.groups.join(b)
+
+        self.groups.leave(a)
+        self.assertIsNone(a.listing_group)
+        self.assertEqual(list(self.groups.groups), ['snoohelper'])
+        self.groups.leave(b)
+        self.assertEqual(self.groups.groups, dict())
+        self.assertEqual(group.members, dict())
+
+
+class FakeThing:
+    """
+    Submission, or comment when title is None, hashable like praw models
+    """
+
+    def __init__(self, thing_id, title=None, selftext='', body='', author='someone'):
+        self.id = thing_id
+        self.title = title
+        self.selftext = selftext
+        self.body = body
+        self.author = None if author is None else SimpleNamespace(name=author)
+        self.permalink = 'https://www.reddit.com/r/test/comments/' + thing_id
+        if title is None:
+            del self.title
+
+
+class FakeWebhook:
+
+    def __init__(self):
+        self.messages = list()
+
+    def send_message(self, message):
+        self.messages.append(message)
+
+
+class FiltersControllerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        init_database("snoohelper_test.db")
+
+    def make_controller(self, check_selftext=False, check_comments=False):
+        controller = FiltersController('filterscontrollertest', check_selftext=check_selftext,
+                                       check_comments=check_comments)
+        controller._add(Filter(filter_string="giveaway", subreddit='filterscontrollertest', use_regex=False,
+                               expires=0))
+        return controller
+
+    def setUp(self):
+        self.submission = FakeThing('s1', title="Weekly thread", selftext="Free GIVEAWAY inside")
+        self.comment = FakeThing('c1', body="enter the giveaway")
+        self.clean = FakeThing('s2', title="Nothing to see", selftext="really")
+
+    def test_titles_only(self):
+        controller = self.make_controller()
+        titled = FakeThing('s3', title="Giveaway!")
+        self.assertEqual([item for item, _ in controller.check_items([self.submission, self.comment, titled])],
+                         [titled])
+
+    def test_selftext_and_comments(self):
+        controller = self.make_controller(check_selftext=True, check_comments=True)
+        hits = controller.check_items([self.submission, self.comment, self.clean])
+        self.assertEqual([item for item, _ in hits], [self.submission, self.comment])
+        self.assertEqual(hits[0][1].filter_string, "giveaway")
+
+    def test_hits_reported_in_one_message(self):
+        bot = SimpleNamespace(filters_controller=self.make_controller(check_selftext=True, check_comments=True),
+                              webhook=FakeWebhook(), subreddit_name='test')
+        hits = SnooHelperBot.check_filters(bot, [self.submission, self.comment, self.clean])
+
+        self.assertEqual(set(hits), {self.submission, self.comment})
+        self.assertEqual(len(bot.webhook.messages), 1)
+        attachments = bot.webhook.messages[0].attachments
+        self.assertEqual([attachment.attachment_dict['title'] for attachment in attachments],
+                         ["Weekly thread", "Comment by /u/someone"])
+
+        SnooHelperBot.check_filters(bot, [self.clean])
+        self.assertEqual(len(bot.webhook.messages), 1)
+
+
+class FakeModeration:
+
+    def __init__(self):
+        self.calls = list()
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.calls.append((name,) + args)
+
+
+class FakeSubmission:
+
+    def __init__(self, submission_id, author='someone', link_flair_text=None, created_utc=None):
+        self.id = submission_id
+        self.fullname = 't3_' + submission_id
+        self.author = SimpleNamespace(name=author)
+        self.link_flair_text = link_flair_text
+        self.created_utc = time.time() if created_utc is None else created_utc
+        self.selected = list()
+        self.flair = SimpleNamespace(select=lambda template_id, text: self.selected.append((template_id, text)))
+
+
+class FakeFlairReddit:
+    """
+    Reddit instance of a FlairEnforcer, records the submissions it is asked to fetch
+    """
+
+    def __init__(self, subreddit):
+        self.mod = FakeModeration()
+        self.sub = SimpleNamespace(display_name=subreddit, mod=self.mod)
+        self.fetched = list()
+        self.info_calls = list()
+        self.submissions = dict()
+        self.inbox = SimpleNamespace(comment_replies=lambda limit: [])
+
+    def subreddit(self, name):
+        return self.sub
+
+    def submission(self, submission_id):
+        self.fetched.append(submission_id)
+        return self.submissions.setdefault(submission_id, FakeSubmission(submission_id))
+
+    def comment(self, comment_id):
+        return SimpleNamespace(id=comment_id)
+
+    def info(self, fullnames):
+        self.info_calls.append(len(fullnames))
+        self.fetched.extend(fullnames)
+        return [self.submissions[fullname[3:]] for fullname in fullnames if fullname[3:] in self.submissions]
+
+
+class FlairEnforcerTest(unittest.TestCase):
+
+    subreddit = 'flairenforcertest'
+
+    @classmethod
+    def setUpClass(cls):
+        init_database("snoohelper_test.db")
+
+    def setUp(self):
+        UnflairedSubmissionModel.delete().where(UnflairedSubmissionModel.subreddit == self.subreddit).execute()
+        PendingSubmissionModel.delete().where(PendingSubmissionModel.subreddit == self.subreddit).execute()
+        UnflairedSubmissionModel.create(submission_id='s1', comment_id='c1', subreddit=self.subreddit,
+                                        created_utc=time.time(), author='someone')
+        self.reddit = FakeFlairReddit(self.subreddit)
+        self.catalog = SimpleNamespace(flairs=[('Question', 'tq'), ('Meta Talk', 'tm')], version=1)
+        self.enforcer = FlairEnforcer(self.reddit, self.subreddit, self.catalog)
+
+    def tearDown(self):
+        writer.flush()
+        UnflairedSubmissionModel.delete().where(UnflairedSubmissionModel.subreddit == self.subreddit).execute()
+        PendingSubmissionModel.delete().where(PendingSubmissionModel.subreddit == self.subreddit).execute()
+
+    def reply(self, body, author='someone', parent_id='t1_c1'):
+        return SimpleNamespace(body=body, author=SimpleNamespace(name=author), parent_id=parent_id)
+
+    def test_load_from_database_without_requests(self):
+        unflaired_submission = self.enforcer.unflaired_submissions['s1']
+        self.assertIs(self.enforcer.unflaired_by_comment['c1'], unflaired_submission)
+        self.assertEqual(unflaired_submission.author, 'someone')
+        self.assertEqual(self.reddit.fetched, list())
+
+    def test_load_scoped_to_subreddit(self):
+        UnflairedSubmissionModel.create(submission_id='other1', comment_id='oc1', subreddit='otherflairtest',
+                                        created_utc=time.time())
+        try:
+            enforcer = FlairEnforcer(self.reddit, self.subreddit, self.catalog)
+        finally:
+            UnflairedSubmissionModel.delete().where(UnflairedSubmissionModel.subreddit == 'otherflairtest').execute()
+        self.assertEqual(list(enforcer.unflaired_submissions), ['s1'])
+
+    def test_submission_fetched_lazily(self):
+        unflaired_submission = self.enforcer.unflaired_submissions['s1']
+        self.assertEqual(unflaired_submission.submission_id, 's1')
+        self.assertFalse(unflaired_submission.delete_if_overtime())
+        self.assertEqual(self.reddit.fetched, list())
+
+        self.assertIs(unflaired_submission.submission, self.reddit.submissions['s1'])
+        self.assertIs(unflaired_submission.submission, self.reddit.submissions['s1'])
+        self.assertEqual(self.reddit.fetched, ['s1'])
+
+    def test_find_flair(self):
+        self.assertEqual(self.enforcer._find_flair('question'), ('Question', 'tq'))
+        self.assertEqual(self.enforcer._find_flair('"meta talk"'), ('Meta Talk', 'tm'))
+        self.assertEqual(self.enforcer._find_flair('it is a "Question"'), ('Question', 'tq'))
+        self.assertIsNone(self.enforcer._find_flair('meta'))
+
+        self.catalog.flairs = [('Other', 'to')]
+        self.catalog.version = 2
+        self.assertEqual(self.enforcer._find_flair('other'), ('Other', 'to'))
+        self.assertIsNone(self.enforcer._find_flair('question'))
+
+    def test_check_reply_flairs_and_approves(self):
+        self.enforcer._check_reply(self.reply('Question'))
+
+        self.assertEqual(self.reddit.submissions['s1'].selected, [('tq', 'Question')])
+        self.assertEqual([call[0] for call in self.reddit.mod.calls], ['remove', 'approve', 'remove'])
+        self.assertEqual(self.enforcer.unflaired_submissions, dict())
+        self.assertEqual(self.enforcer.unflaired_by_comment, dict())
+
+    def test_check_reply_ignored(self):
+        for reply in (self.reply('please flair it as a Question'), self.reply('Question', author='other'),
+                      self.reply('nothing'), self.reply('Question', parent_id='t1_unknown')):
+            self.enforcer._check_reply(reply)
+
+        self.assertEqual(self.reddit.mod.calls, list())
+        self.assertIn('s1', self.enforcer.unflaired_submissions)
+
+    def test_check_reply_by_link_id(self):
+        reply = self.reply('question', parent_id='t1_other')
+        reply.link_id = 't3_s1'
+        self.enforcer._check_reply(reply)
+        self.assertEqual(self.reddit.submissions['s1'].selected, [('tq', 'Question')])
+
+    def test_author_saved(self):
+        submission = FakeSubmission('s2', author='poster', created_utc=time.time() - 3600)
+        self.reddit.submissions['s2'] = submission
+        submission.reply = lambda text: SimpleNamespace(id='c2')
+
+        self.enforcer.add_submission(submission)
+        writer.flush()
+        self.assertEqual(UnflairedSubmissionModel.get(UnflairedSubmissionModel.submission_id == 's2').author, 'poster')
+
+    def track(self, submission_id, created_utc=None, comment_id=None):
+        UnflairedSubmissionModel.create(submission_id=submission_id, comment_id=comment_id or 'c' + submission_id,
+                                        subreddit=self.subreddit, created_utc=created_utc, author='someone')
+
+    def stored_submissions(self):
+        writer.flush()
+        query = UnflairedSubmissionModel.select().where(UnflairedSubmissionModel.subreddit == self.subreddit)
+        return dict((row.submission_id, row.created_utc) for row in query)
+
+    def test_refresh_tracked(self):
+        now = time.time()
+        self.track('flaired', now)
+        self.track('deleted', now)
+        self.track('overtime', now - 20000)
+        self.track('unknown_age')
+        self.reddit.submissions['s1'] = FakeSubmission('s1')
+        self.reddit.submissions['flaired'] = FakeSubmission('flaired', link_flair_text='Question')
+        self.reddit.submissions['unknown_age'] = FakeSubmission('unknown_age', created_utc=now - 60)
+        enforcer = FlairEnforcer(self.reddit, self.subreddit, self.catalog)
+
+        enforcer._refresh_tracked()
+        self.assertEqual(sorted(enforcer.unflaired_submissions), ['s1', 'unknown_age'])
+        self.assertEqual(self.reddit.info_calls, [4])
+        self.assertNotIn('t3_overtime', self.reddit.fetched)
+        self.assertIn(('approve', self.reddit.submissions['flaired']), self.reddit.mod.calls)
+
+        stored = self.stored_submissions()
+        self.assertEqual(sorted(stored), ['s1', 'unknown_age'])
+        self.assertAlmostEqual(stored['unknown_age'].timestamp(), now - 60, delta=1)
+        self.assertEqual(enforcer.unflaired_submissions['unknown_age'].created_utc, now - 60)
+
+    def test_refresh_tracked_in_batches(self):
+        for i in range(149):
+            self.track('b{}'.format(i), time.time())
+        enforcer = FlairEnforcer(self.reddit, self.subreddit, self.catalog)
+
+        enforcer._refresh_tracked()
+        self.assertEqual(self.reddit.info_calls, [100, 50])
+        self.assertEqual(enforcer.unflaired_submissions, dict())
+
+    def test_pending_submissions_survive_restart(self):
+        submission = FakeSubmission('s3', created_utc=time.time() - 60)
+        submission.reply = lambda text: SimpleNamespace(id='c3')
+        self.reddit.submissions['s3'] = submission
+        self.enforcer.add_submission(submission)
+        self.enforcer.add_submission(submission)
+        writer.flush()
+        self.assertEqual(self.enforcer.pending_submissions, {'s3': submission.created_utc})
+        self.assertEqual(PendingSubmissionModel.select().where(PendingSubmissionModel.subreddit == self.subreddit)
+                         .count(), 1)
+
+        restarted = FlairEnforcer(self.reddit, self.subreddit, self.catalog, grace_period=30)
+        self.assertEqual(list(restarted.pending_submissions), ['s3'])
+        restarted._check_pending()
+        writer.flush()
+
+        self.assertEqual(restarted.pending_submissions, dict())
+        self.assertIn('s3', restarted.unflaired_submissions)
+        self.assertIn(('remove', submission), self.reddit.mod.calls)
+        self.assertEqual(PendingSubmissionModel.select().where(PendingSubmissionModel.subreddit == self.subreddit)
+                         .count(), 0)
+
+    def test_flaired_pending_submission_is_dropped(self):
+        submission = FakeSubmission('s4', created_utc=time.time() - 60)
+        self.enforcer.add_submission(submission)
+        submission.link_flair_text = 'Question'
+        self.reddit.submissions['s4'] = submission
+
+        self.enforcer.grace_period = 30
+        self.enforcer._check_pending()
+        self.assertEqual(self.enforcer.pending_submissions, dict())
+        self.assertNotIn('s4', self.enforcer.unflaired_submissions)
+
+
+class AlreadyDoneHelperTest(unittest.TestCase):
+
+    subreddit = 'alreadydonetest'
+
+    @classmethod
+    def setUpClass(cls):
+        init_database("snoohelper_test.db")
+
+    def setUp(self):
+        writer.flush()
+        AlreadyDoneModel.delete().where(AlreadyDoneModel.subreddit == self.subreddit).execute()
+        self.prefix = 'adt{}_'.format(int(time.time() * 1000))
+
+    def tearDown(self):
+        writer.flush()
+        AlreadyDoneModel.delete().where(AlreadyDoneModel.subreddit == self.subreddit).execute()
+
+    def ids(self, count):
+        return [self.prefix + str(i) for i in range(count)]
+
+    def test_seen_set_bounded_by_size(self):
+        helper = AlreadyDoneHelper(max_size=3)
+        now = time.time()
+        for thing_id in self.ids(5):
+            helper._remember(thing_id, self.subreddit, now)
+
+        self.assertEqual(list(helper._seen[self.subreddit]), self.ids(5)[2:])
+        self.assertFalse(helper.is_done(self.ids(5)[0], self.subreddit))
+        self.assertTrue(helper.is_done(self.ids(5)[4], self.subreddit))
+        self.assertFalse(helper.is_done(self.ids(5)[4], 'othersubreddit'))
+
+    def test_seen_set_bounded_by_age(self):
+        helper = AlreadyDoneHelper(max_age=100)
+        old, recent = self.ids(2)
+        helper._remember(old, self.subreddit, time.time() - 150)
+        helper._remember(recent, self.subreddit, time.time() - 50)
+
+        self.assertEqual(list(helper._seen[self.subreddit]), [recent])
+        self.assertTrue(helper.is_done(recent, self.subreddit))
+
+        helper._seen[self.subreddit][recent] = time.time() - 101
+        self.assertFalse(helper.is_done(recent, self.subreddit))
+
+    def test_warm_loads_newest_ids(self):
+        now = time.time()
+        ids = self.ids(4)
+        AlreadyDoneModel.insert_many([{'thing_id': thing_id, 'timestamp': now - 40 + i * 10,
+                                       'subreddit': self.subreddit} for i, thing_id in enumerate(ids)]).execute()
+
+        helper = AlreadyDoneHelper(self.subreddit, max_size=2)
+        self.assertEqual(list(helper._seen[self.subreddit]), ids[2:])
+        self.assertTrue(all(helper.is_done(thing_id, self.subreddit) for thing_id in ids[2:]))
+
+    def stored_ids(self):
+        writer.flush()
+        query = AlreadyDoneModel.select().where(AlreadyDoneModel.subreddit == self.subreddit)
+        return set(row.thing_id for row in query)
+
+    def test_add_many(self):
+        helper = AlreadyDoneHelper()
+        ids = self.ids(4)
+        self.assertEqual(helper.add_many([ids[2], ids[0], ids[2], ids[1]], self.subreddit), [ids[2], ids[0], ids[1]])
+        self.assertEqual(self.stored_ids(), set(ids[:3]))
+
+        self.assertEqual(helper.add_many(ids, self.subreddit), [ids[3]])
+        self.assertEqual(helper.add_many(ids, self.subreddit), list())
+        self.assertEqual(self.stored_ids(), set(ids))
+
+    def test_add_many_checks_database(self):
+        ids = self.ids(3)
+        AlreadyDoneHelper().add_many(ids[:2], self.subreddit)
+        writer.flush()
+
+        helper = AlreadyDoneHelper()
+        self.assertEqual(helper.add_many(ids, self.subreddit), [ids[2]])
+        self.assertTrue(all(helper.is_done(thing_id, self.subreddit) for thing_id in ids))
+
+    def test_add(self):
+        helper = AlreadyDoneHelper()
+        thing_id = self.ids(1)[0]
+        helper.add(thing_id, self.subreddit)
+        self.assertRaises(IntegrityError, helper.add, thing_id, self.subreddit)
+
+
+class AlreadyDonePrunerTest(unittest.TestCase):
+
+    subreddits = ('prunertesta', 'prunertestb')
+
+    @classmethod
+    def setUpClass(cls):
+        init_database("snoohelper_test.db")
+
+    def setUp(self):
+        writer.flush()
+        AlreadyDoneModel.delete().where(AlreadyDoneModel.subreddit << list(self.subreddits)).execute()
+
+    def tearDown(self):
+        AlreadyDoneModel.delete().where(AlreadyDoneModel.subreddit << list(self.subreddits)).execute()
+
+    def test_prune_in_chunks(self):
+        now = time.time()
+        prefix = 'pt{}_'.format(int(now * 1000))
+        rows = list()
+        for subreddit in self.subreddits:
+            for i in range(5):
+                rows.append({'thing_id': '{}{}_{}'.format(prefix, subreddit, i), 'subreddit': subreddit,
+                             'timestamp': now - 1000 if i < 3 else now})
+        AlreadyDoneModel.insert_many(rows).execute()
+
+        submitted = list()
+        submit = writer.submit
+
+        def recording_submit(func, *args, **kwargs):
+            submitted.append(func.__name__)
+            return submit(func, *args, **kwargs)
+
+        pruner = AlreadyDonePruner(max_age=500, chunk_size=2)
+        with mock.patch.object(writer, 'submit', recording_submit):
+            num, _ = pruner.prune()
+
+        self.assertGreaterEqual(num, 6)
+        self.assertGreaterEqual(submitted.count('_delete_expired'), 4)
+        for subreddit in self.subreddits:
+            remaining = AlreadyDoneModel.select().where(AlreadyDoneModel.subreddit == subreddit)
+            self.assertEqual(sorted(row.thing_id[-1] for row in remaining), ['3', '4'])
+
+
+class UserCacheTest(unittest.TestCase):
+
+    subreddit = 'usercachetest'
+
+    @classmethod
+    def setUpClass(cls):
+        init_database("snoohelper_test.db")
+
+    def setUp(self):
+        writer.flush()
+        UserModel.delete().where(UserModel.subreddit == self.subreddit).execute()
+        self.cache = UserCache(max_size=3)
+
+    def tearDown(self):
+        writer.flush()
+        UserModel.delete().where(UserModel.subreddit == self.subreddit).execute()
+
+    def count_queries(self):
+        return mock.patch.object(db.obj, 'execute_sql', wraps=db.obj.execute_sql)
+
+    def test_get_remembers_missing_users(self):
+        with self.count_queries() as execute_sql:
+            self.assertIsNone(self.cache.get('Nobody', self.subreddit))
+            self.assertIsNone(self.cache.get('nobody', self.subreddit))
+        self.assertEqual(execute_sql.call_count, 1)
+
+    def test_get_or_create_and_save(self):
+        user = self.cache.get_or_create('Someone', self.subreddit)
+        self.assertEqual(user.username, 'someone')
+        self.assertIs(self.cache.get('SOMEONE', self.subreddit), user)
+
+        user.bans += 1
+        self.cache.save(user)
+        writer.flush()
+        self.assertEqual(UserModel.get(UserModel.username == 'someone', UserModel.subreddit == self.subreddit).bans, 1)
+
+        self.cache.invalidate('someone', self.subreddit)
+        reread = self.cache.get('someone', self.subreddit)
+        self.assertIsNot(reread, user)
+        self.assertEqual(reread.bans, 1)
+
+    def test_least_recently_used_evicted(self):
+        for username in ('a', 'b', 'c'):
+            self.cache.get(username, self.subreddit)
+        self.cache.get('a', self.subreddit)
+        self.cache.get('d', self.subreddit)
+
+        self.assertEqual(list(self.cache._users), [(self.subreddit, 'c'), (self.subreddit, 'a'), (self.subreddit, 'd')])
+
+    def test_prefetch_reads_misses_in_one_query(self):
+        UserModel.create(username='a', subreddit=self.subreddit)
+        UserModel.create(username='b', subreddit=self.subreddit, tracked=True)
+        cache = UserCache()
+        cached = cache.get('a', self.subreddit)
+
+        with self.count_queries() as execute_sql:
+            users = cache.prefetch(['A', 'b', 'c', 'b'], self.subreddit)
+        self.assertEqual(execute_sql.call_count, 1)
+        self.assertEqual(set(users), {'a', 'b', 'c'})
+        self.assertIs(users['a'], cached)
+        self.assertTrue(users['b'].tracked)
+        self.assertIsNone(users['c'])
+
+        with self.count_queries() as execute_sql:
+            self.assertIs(cache.get('b', self.subreddit), users['b'])
+            self.assertIsNone(cache.get('c', self.subreddit))
+            self.assertEqual(cache.prefetch(['a', 'b', 'c'], self.subreddit), users)
+        self.assertEqual(execute_sql.call_count, 0)
+
+    def test_add_to_counters(self):
+        UserModel.create(username='a', subreddit=self.subreddit, removed_comments=2, tracked=True)
+        cache = UserCache()
+        before = cache.get('a', self.subreddit)
+
+        users = cache.add_to_counters({'A': {'removed_comments': 3, 'bans': 1}, 'b': {'removed_submissions': 2}},
+                                      self.subreddit)
+        self.assertEqual([(user.username, user.removed_comments, user.bans, user.removed_submissions, user.tracked)
+                          for user in users], [('a', 5, 1, 0, True), ('b', 0, 0, 2, False)])
+        self.assertIs(cache.get('a', self.subreddit), users[0])
+        self.assertIsNot(users[0], before)
+        self.assertEqual(before.removed_comments, 2)
+
+        before.warnings_muted = True
+        cache.save(before)
+        writer.flush()
+        user = UserModel.get(UserModel.username == 'a', UserModel.subreddit == self.subreddit)
+        self.assertEqual((user.removed_comments, user.bans, user.warnings_muted), (5, 1, True))
+        self.assertEqual(cache.add_to_counters(dict(), self.subreddit), list())
+
+
+class ScanModlogTest(unittest.TestCase):
+
+    subreddit = 'scanmodlogtest'
+
+    @classmethod
+    def setUpClass(cls):
+        init_database("snoohelper_test.db")
+
+    def setUp(self):
+        writer.flush()
+        UserModel.delete().where(UserModel.subreddit == self.subreddit).execute()
+        AlreadyDoneModel.delete().where(AlreadyDoneModel.subreddit == self.subreddit).execute()
+        self.prefix = 'sml{}_'.format(int(time.time() * 1000))
+        self.checked = list()
+        self.requested = list()
+        self.entries = list()
+        log = SimpleNamespace(log=self.modlog)
+        self.bot = SimpleNamespace(subreddit_name=self.subreddit, subreddit=SimpleNamespace(mod=log), un=None,
+                                   already_done_helper=AlreadyDoneHelper(),
+                                   user_warnings=SimpleNamespace(check_user_offenses=self.checked.append),
+                                   watermarks=dict())
+        self.bot._fetch = lambda listing, listing_func: list(listing_func(limit=100))
+
+    def modlog(self, action=None, limit=None):
+        self.requested.append(action)
+        return iter(self.entries)
+
+    def tearDown(self):
+        writer.flush()
+        UserModel.delete().where(UserModel.subreddit == self.subreddit).execute()
+        AlreadyDoneModel.delete().where(AlreadyDoneModel.subreddit == self.subreddit).execute()
+
+    def entry(self, number, action, target_author, details=''):
+        return SimpleNamespace(id=self.prefix + str(number), action=action, target_author=target_author,
+                               details=details, description='', _mod='mod')
+
+    def scan(self, action, entries):
+        self.entries = entries
+        self.bot.watermarks['modlog:' + action] = mock.Mock()
+        with mock.patch('snoohelper.reddit.bot.is_banned', return_value=False) as is_banned:
+            self.assertEqual(SnooHelperBot.scan_modlog(self.bot, action), entries)
+        self.bot.watermarks['modlog:' + action].advance.assert_called_once_with(entries)
+        self.assertEqual(self.requested[-1], action)
+        return is_banned
+
+    def counters(self, field):
+        return dict((user.username, getattr(user, field)) for user in
+                    UserModel.select().where(UserModel.subreddit == self.subreddit))
+
+    def test_removals_counted_per_user(self):
+        self.bot.already_done_helper.add(self.prefix + '0', self.subreddit)
+        entries = [self.entry(0, 'removecomment', 'Alice'), self.entry(1, 'removecomment', 'Alice'),
+                   self.entry(2, 'removecomment', 'alice'), self.entry(3, 'removecomment', 'Bob'),
+                   self.entry(4, 'removelink', 'Bob')]
+        self.scan('removecomment', entries)
+
+        self.assertEqual(self.counters('removed_comments'), {'alice': 2, 'bob': 1})
+        self.assertEqual(self.counters('removed_submissions'), {'alice': 0, 'bob': 0})
+        self.assertEqual(sorted(user.username for user in self.checked), ['alice', 'bob'])
+
+        self.checked.clear()
+        self.scan('removecomment', entries)
+        self.assertEqual(self.counters('removed_comments'), {'alice': 2, 'bob': 1})
+        self.assertEqual(self.checked, list())
+
+    def test_bans(self):
+        is_banned = self.scan('banuser', [self.entry(0, 'banuser', 'Carol', details='3 days')])
+        self.assertEqual(self.counters('bans'), {'carol': 1})
+        is_banned.assert_called_once_with(self.bot.subreddit, 'Carol')
+
+    def test_actions_without_counters(self):
+        self.scan('unbanuser', [self.entry(0, 'unbanuser', 'Dave')])
+        self.assertEqual(self.counters('bans'), dict())
+        self.assertEqual(self.checked, list())
+
+
+class FilterExpiryTest(unittest.TestCase):
+
+    subreddit = 'filterexpirytest'
+
+    @classmethod
+    def setUpClass(cls):
+        init_database("snoohelper_test.db")
+
+    def setUp(self):
+        writer.flush()
+        FilterModel.delete().where(FilterModel.subreddit == self.subreddit).execute()
+        self.controller = FiltersController(self.subreddit)
+
+    def tearDown(self):
+        if self.controller.expiry_timer is not None:
+            self.controller.expiry_timer.cancel()
+        writer.flush()
+        FilterModel.delete().where(FilterModel.subreddit == self.subreddit).execute()
+
+    def wait_for_expiry(self, filter_string, timeout=5):
+        deadline = time.time() + timeout
+        while filter_string in self.controller.filters and time.time() < deadline:
+            time.sleep(0.02)
+        writer.flush()
+
+    def stored_filters(self):
+        return sorted(row.filter_string for row in FilterModel.select().where(FilterModel.subreddit == self.subreddit))
+
+    def test_expired_filters_removed(self):
+        self.controller.add_filter('later', False, time.time() + 60)
+        self.controller.add_filter('soon', False, time.time() + 0.2)
+        self.controller.add_filter('never', False, 0)
+        self.assertEqual(self.controller.check_all('soon').filter_string, 'soon')
+
+        self.wait_for_expiry('soon')
+        self.assertIsNone(self.controller.check_all('soon'))
+        self.assertEqual(self.controller.check_all('later').filter_string, 'later')
+        self.assertEqual(list(self.controller.filters), ['later', 'never'])
+        self.assertEqual(self.stored_filters(), ['later', 'never'])
+        self.assertEqual([filter_obj.filter_string for _, _, filter_obj in self.controller.expiry_heap], ['later'])
+        self.assertTrue(self.controller.expiry_timer.is_alive())
+
+    def test_replaced_filter_kept(self):
+        self.controller.add_filter('spam', False, time.time() + 0.1)
+        self.controller._add(Filter('spam', self.subreddit, False, 0))
+        time.sleep(0.3)
+        self.assertEqual(self.controller.check_all('spam').expires, 0)
+        self.assertEqual(self.controller.expiry_heap, list())
+
+    def test_loaded_filters_expire(self):
+        FilterModel.create(filter_string='old', subreddit=self.subreddit, expires=time.time() - 10)
+        FilterModel.create(filter_string='current', subreddit=self.subreddit, expires=0)
+        self.controller = FiltersController(self.subreddit)
+
+        self.wait_for_expiry('old')
+        self.assertEqual(list(self.controller.filters), ['current'])
+        self.assertEqual(self.stored_filters(), ['current'])
+
+
+class FakeFlairEndpoint:
+
+    def __init__(self, templates):
+        self.templates = templates
+        self.urls = list()
+        self.failures = 0
+
+    def get(self, url):
+        self.urls.append(url)
+        if self.failures:
+            self.failures -= 1
+            raise OSError("unavailable")
+        return [{'text': text, 'id': template_id} for text, template_id in self.templates]
+
+
+class FlairCatalogTest(unittest.TestCase):
+
+    subreddit = 'flaircatalogtest'
+
+    @classmethod
+    def setUpClass(cls):
+        init_database("snoohelper_test.db")
+
+    def setUp(self):
+        writer.flush()
+        FlairTemplateModel.delete().where(FlairTemplateModel.subreddit == self.subreddit).execute()
+        self.reddit = FakeFlairEndpoint([('Question', 'tq'), ('Meta', 'tm')])
+        self.catalogs = list()
+
+    def tearDown(self):
+        for catalog in self.catalogs:
+            catalog.stop()
+        writer.flush()
+        FlairTemplateModel.delete().where(FlairTemplateModel.subreddit == self.subreddit).execute()
+
+    def make_catalog(self, **kwargs):
+        catalog = FlairCatalog(self.reddit, self.subreddit, **kwargs)
+        self.catalogs.append(catalog)
+        return catalog
+
+    def stored_flairs(self):
+        writer.flush()
+        query = FlairTemplateModel.select().where(FlairTemplateModel.subreddit == self.subreddit).\
+            order_by(FlairTemplateModel.position)
+        return [(row.flair_text, row.template_id) for row in query]
+
+    def test_fetched_once_then_loaded(self):
+        catalog = self.make_catalog()
+        self.assertEqual(catalog.flairs, [('Question', 'tq'), ('Meta', 'tm')])
+        self.assertEqual(self.reddit.urls, ['r/flaircatalogtest/api/link_flair'])
+        self.assertEqual(self.stored_flairs(), catalog.flairs)
+
+        loaded = self.make_catalog()
+        self.assertEqual(loaded.flairs, catalog.flairs)
+        self.assertEqual(loaded.version, 1)
+        self.assertAlmostEqual(loaded.fetched_at, catalog.fetched_at, delta=1)
+        self.assertEqual(len(self.reddit.urls), 1)
+
+    def test_change_detection(self):
+        catalog = self.make_catalog()
+        self.assertFalse(catalog.refresh())
+        self.assertEqual(catalog.version, 1)
+
+        self.reddit.templates = [('Meta', 'tm')]
+        self.assertTrue(catalog.refresh())
+        self.assertEqual(catalog.version, 2)
+        self.assertEqual(self.stored_flairs(), [('Meta', 'tm')])
+
+    def test_background_refresh(self):
+        catalog = self.make_catalog(ttl=0.1, retry_delay=0.1)
+        self.reddit.failures = 1
+        self.reddit.templates = [('Other', 'to')]
+
+        deadline = time.time() + 5
+        while catalog.version < 2 and time.time() < deadline:
+            time.sleep(0.02)
+        self.assertEqual(catalog.flairs, [('Other', 'to')])
+        self.assertGreaterEqual(len(self.reddit.urls), 3)
+
+        catalog.stop()
+        time.sleep(0.05)
+        calls = len(self.reddit.urls)
+        time.sleep(0.3)
+        self.assertEqual(len(self.reddit.urls), calls)
+
+
 if __name__ == '__main__':
     unittest.main()